@@ -8,7 +8,8 @@ from flask import Flask
 
 from app import database
 
-from . import auth, film, home, person, user
+from . import (api, auth, authgate, authstate, cache, facets, film, home, instrument,
+	person, search, stats, typeahead, user)
 
 TEMPLATES_AUTO_RELOAD = True
 
@@ -37,9 +38,45 @@ def create_app(config=None) -> Flask:
 		print(k, v)
 		app.config[k] = v
 	
+	# snapshot can be the path to a prebuilt catalog made by `flask build-snapshot`
+	# to skip importing the csv. Otherwise, init_db can be true to rebuild the
+	# database on startup, or 'incremental' to only update the films that changed
+	# since the last startup
+	database.init_app(app)
+	instrument.init_app(app)
+	authstate.init_app(app)
+	authgate.init_app(app)
+	cache.init_app(app)
+	auth.init_app(app)
+	film.init_app(app)
+	facets.init_app(app)
+	typeahead.init_app(app)
+	
 	with app.app_context():
-		if config.get('init_db', False):
-			database.init_db(config.get('testing', False))
+		if config.get('snapshot'):
+			database.use_snapshot(
+				config['snapshot'], config.get('snapshot_mode', 'copy')
+			)
+		elif config.get('init_db', False):
+			database.init_db(
+				config.get('testing', False),
+				incremental=config['init_db'] == 'incremental',
+			)
+		# Bring databases from older versions up to date
+		database.migrate_db()
+		# warm builds the in-memory indexes now rather than on the first request
+		# that needs them, which makes startup slower
+		if config.get('warm', False):
+			facets.warm()
+			typeahead.warm()
+	# Workers forked from a preloaded app open their own connections
+	database.close_pools(app)
+	
+	# Register commands
+	app.cli.add_command(database.init_db_command)
+	app.cli.add_command(database.sync_db_command)
+	app.cli.add_command(database.build_snapshot_command)
+	app.cli.add_command(database.refresh_catalog_command)
 	
 	# Register blueprints
 	app.register_blueprint(home.bp)
@@ -47,6 +84,9 @@ def create_app(config=None) -> Flask:
 	app.register_blueprint(person.bp)
 	app.register_blueprint(auth.bp)
 	app.register_blueprint(user.bp)
+	app.register_blueprint(search.bp)
+	app.register_blueprint(api.bp)
+	app.register_blueprint(stats.bp)
 	
 	# Setup database
 	# with app.app_context():
@@ -0,0 +1,200 @@
+"""
+A read-only JSON API over the catalog and comments.
+
+The list endpoints, /api/films and /api/films/<film_id>/comments, stream newline
+delimited JSON, one object per line, straight from the SQLite cursor a batch of
+rows at a time, so pulling the whole catalog takes the same memory as pulling one
+page of it. The JSON for each row is built by SQLite. /api/films is in film_id
+order, and a pull that was interrupted can be resumed with ?after=<last film_id>.
+"""
+
+import sqlite3
+from typing import Iterator
+from urllib.parse import unquote_plus
+
+from flask import Blueprint, jsonify, request, stream_with_context
+from flask.wrappers import Response
+
+from app import conditional
+from app.database import get_db
+from app.film import film_exists
+from app.person import person_exists
+
+bp = Blueprint("api", __name__, url_prefix="/api")
+
+# How many rows are fetched from the cursor and sent at a time
+STREAM_BATCH = 500
+
+FILM_JSON = """
+    json_object(
+        'film_id', Film.film_id,
+        'title', title,
+        'film_type', film_type,
+        'release_year', release_year,
+        'date_added', date_added,
+        'rating', rating,
+        'duration', duration,
+        'film_desc', film_desc,
+        'genres', json((
+            select json_group_array(genre_name) from Listed
+            where Listed.film_id = Film.film_id
+        )),
+        'countries', json((
+            select json_group_array(country_name) from Produced
+            where Produced.film_id = Film.film_id
+        )),
+        'directors', json((
+            select json_group_array(person_name) from Directed
+            where Directed.film_id = Film.film_id
+        )),
+        'cast', json((
+            select json_group_array(person_name) from Acted
+            where Acted.film_id = Film.film_id
+        ))
+    )
+"""
+
+FILMS_SQL = f"""
+    select {FILM_JSON} from Film
+    where film_id > :after
+    order by film_id
+    limit :limit
+"""
+
+FILM_SQL = f"""
+    select json_set({FILM_JSON}, '$.comment_count', :comment_count)
+    from Film where film_id = :film_id
+"""
+
+PERSON_SQL = f"""
+    select json_object(
+        'name', :name,
+        'directed', json((
+            select json_group_array(json({FILM_JSON}))
+            from Directed join Film using (film_id) where person_name = :name
+        )),
+        'acted', json((
+            select json_group_array(json({FILM_JSON}))
+            from Acted join Film using (film_id) where person_name = :name
+        ))
+    )
+    where exists (select 1 from Directed where person_name = :name)
+        or exists (select 1 from Acted where person_name = :name)
+"""
+
+COMMENTS_SQL = """
+    select json_object(
+        'comment_id', comment_id,
+        'user_id', user_id_,
+        'username', username,
+        'date', date_,
+        'body', body
+    )
+    from Comment natural join User
+    where film_id = ?
+    order by date_ desc, comment_id desc
+"""
+
+
+def error(message: str, status: int) -> Response:
+    response = jsonify(error=message)
+    response.status_code = status
+    return response
+
+
+def json_response(body: str) -> Response:
+    return Response(body, mimetype="application/json")
+
+
+def stream_rows(cursor: sqlite3.Cursor) -> Iterator[str]:
+    """Yields the JSON in the first column of each row, a batch of lines at a time"""
+    try:
+        while True:
+            rows = cursor.fetchmany(STREAM_BATCH)
+            if not rows:
+                break
+            yield "".join(row[0] + "\n" for row in rows)
+    finally:
+        cursor.close()
+
+
+def ndjson_response(cursor: sqlite3.Cursor) -> Response:
+    return Response(
+        stream_with_context(stream_rows(cursor)), mimetype="application/x-ndjson"
+    )
+
+
+@bp.route("/films", methods=["GET"])
+def films():
+    """Streams every film after `after`, or the first `limit` of them"""
+    after = request.args.get("after", "")
+    try:
+        limit = int(request.args.get("limit", -1))
+    except ValueError:
+        return error("limit must be a number", 400)
+
+    db = get_db(readonly=True)
+    validators = conditional.validators(conditional.catalog_version(db))
+    response = conditional.not_modified(validators)
+    if response:
+        return response
+
+    cursor = db.execute(FILMS_SQL, {"after": after, "limit": limit})
+    return conditional.respond(ndjson_response(cursor), validators)
+
+
+@bp.route("/films/<film_id>", methods=["GET"])
+def film(film_id: str):
+    db = get_db(readonly=True)
+    if not film_exists(db, film_id):
+        return error("Film does not exist", 404)
+    comments_version = conditional.film_comments_version(db, film_id)
+    validators = conditional.validators(
+        conditional.catalog_version(db), comments_version
+    )
+    response = conditional.not_modified(validators)
+    if response:
+        return response
+
+    row = db.execute(
+        FILM_SQL, {"film_id": film_id, "comment_count": comments_version.comments}
+    ).fetchone()
+    if not row:
+        return error("Film does not exist", 404)
+    return conditional.respond(json_response(row[0]), validators)
+
+
+@bp.route("/films/<film_id>/comments", methods=["GET"])
+def film_comments(film_id: str):
+    """Streams every comment on the film, newest first"""
+    db = get_db(readonly=True)
+    if not film_exists(db, film_id):
+        return error("Film does not exist", 404)
+    validators = conditional.validators(
+        conditional.catalog_version(db), conditional.film_comments_version(db, film_id)
+    )
+    response = conditional.not_modified(validators)
+    if response:
+        return response
+
+    cursor = db.execute(COMMENTS_SQL, [film_id])
+    return conditional.respond(ndjson_response(cursor), validators)
+
+
+@bp.route("/person/<name>", methods=["GET"])
+def person(name: str):
+    """The films the person directed and acted in"""
+    db = get_db(readonly=True)
+    # Names are encoded the same way as for the person page
+    name = unquote_plus(name)
+    if not person_exists(db, name):
+        return error("Person does not exist", 404)
+    validators = conditional.validators(conditional.catalog_version(db))
+    response = conditional.not_modified(validators)
+    if response:
+        return response
+
+    row = db.execute(PERSON_SQL, {"name": name}).fetchone()
+    if not row:
+        return error("Person does not exist", 404)
+    return conditional.respond(json_response(row[0]), validators)
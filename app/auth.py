@@ -2,48 +2,36 @@ import json
 import secrets
 from base64 import b64decode, b64encode
 from hashlib import blake2b
-from sys import modules
+from time import monotonic
 from time import time as now
-from typing import NamedTuple, Optional, TypeAlias
+from typing import Optional, TypeAlias
 
-from flask import Blueprint, redirect, request, session
+from flask import Blueprint, current_app, g, redirect, request, session
 from flask.helpers import url_for
 from flask.templating import render_template
 from flask.wrappers import Response
 from nacl.exceptions import BadSignatureError
 from nacl.signing import VerifyKey
-from sortedcontainers import SortedDict
 
+from app import cache
+from app.authgate import gated
+from app.authstate import ChallengeInfo, get_state, session_cutoffs
 from app.database import get_db
 
 bp = Blueprint("auth", __name__, url_prefix="/auth")
 
 CHALLENGE_TIME_LIM = 30.0
-
-this = modules[__name__]
+# A session's last_seen is only written again once it is this many seconds old
+SESSION_TOUCH_SECONDS = 300
+# A worker rereads SessVersion at most this often, so a session deleted by another
+# worker can be used from this one's cache for up to this many seconds
+SESSION_VERSION_SECONDS = 1.0
 
 # Typing
 SessId: TypeAlias = str
 Challenge: TypeAlias = str
 
 
-class ChallengeInfo(NamedTuple):
-    challenge: str
-    sess_id: str
-    exp_time: float
-
-
-# Maps challenges to session ids and expiration times
-this.active_challenges = dict()
-# Maps the time the challenge expires to challenges
-# We are mapping this way to make it easier to discard all expired challenges
-# and discard completed challenges
-this.challenge_expires = SortedDict()
-
-# maps sess_id to user_id
-this.sessions = dict()
-
-
 def sess_id() -> SessId:
     """Gets the session id of the current user. If the current user has no session id,
     one is generated and returned
@@ -57,41 +45,24 @@ def sess_id() -> SessId:
     return session["sess_id"]
 
 
-def pop_challenge(
-    challenge: Optional[Challenge] = None, exp_time: Optional[float] = None
-) -> ChallengeInfo:
-    """Removes and returns a challenge from the active challenges. If only one argument
-    is provided, the other will be inferred. If neither is provided, a KeyError will be
-    raised.
+def pop_challenge(challenge: Challenge) -> Optional[ChallengeInfo]:
+    """Removes and returns a challenge if it was issued to the current session and
+    hasn't expired. Otherwise, the challenge is left alone and None is returned.
 
     Args:
-        challenge (Optional[Challenge], optional): The challenge string to remove.
-        exp_time (Optional[float], optional): The time the challenge expires.
+        challenge (Challenge): The challenge string to remove.
 
     Returns:
-        ChallengeInfo: Information about the challenge that was removed.
+        Optional[ChallengeInfo]: Information about the challenge that was removed.
     """
-    # Infer the challenge from the exp_time if it is not provided
-    if challenge is None:
-        challenge = this.challenge_expires[exp_time]
-    # Get the challenge info and remove it from the expiration list
-    sess_id, exp_time = this.active_challenges.pop(challenge)
-    del this.challenge_expires[exp_time]
-
-    return ChallengeInfo(challenge, sess_id, exp_time)
+    return get_state().pop_challenge(challenge, sess_id())
 
 
-def expire_challenges() -> None:
-    """Invalidates all challenges that are past their expirations"""
-    # Get the number of challenges that are expired
-    n_challenges = this.challenge_expires.bisect(now())
-    # Iterate over all the expiry times
-    # We cannot use .items()  because of the way that SortedDict is implemented
-    # The reason I am converting this into a list instead of just using the
-    # iterable is because I will be modifying challenge_expires
-    for exp_time in list(this.challenge_expires.islice(0, n_challenges)):
-        # Remove these challenges from everything
-        pop_challenge(exp_time=exp_time)
+def expire_challenges() -> int:
+    """Invalidates all challenges that are past their expirations and returns how many
+    there were. This is also done by the background sweep.
+    """
+    return get_state().expire_challenges()
 
 
 def generate_challenge(time_lim: float = CHALLENGE_TIME_LIM) -> Challenge:
@@ -104,17 +75,29 @@ def generate_challenge(time_lim: float = CHALLENGE_TIME_LIM) -> Challenge:
 
     Returns:
         str: The new challenge.
-    """
-    expire_challenges()
 
+    Raises:
+        ChallengeLimitError: If too many challenges are outstanding, either in total
+            or for the current session.
+    """
     challenge = f"authchallenge_{secrets.token_urlsafe(256//8)}"
-    exp_time = now() + time_lim
-    this.active_challenges[challenge] = (sess_id(), exp_time)
-    this.challenge_expires[exp_time] = challenge
+    get_state().add_challenge(ChallengeInfo(challenge, sess_id(), now() + time_lim))
 
     return challenge
 
 
+def verify_signature(signature_hex: str, pub_key_hex: str) -> Optional[str]:
+    """Returns the message the signature is for, or None if the signature is invalid"""
+    # Construct the key object. We cannot simply get the key object as a parameter since
+    # it will be pulled from the database
+    pub_key = VerifyKey(bytes.fromhex(pub_key_hex))
+    try:
+        # Check the signature
+        return str(pub_key.verify(bytes.fromhex(signature_hex)), "utf-8")
+    except BadSignatureError:
+        return None
+
+
 def complete_challenge(signature_hex: str, pub_key_hex: str) -> bool:
     """
     Validates the challenge-response and returns True if it was successfully completed.
@@ -128,43 +111,61 @@ def complete_challenge(signature_hex: str, pub_key_hex: str) -> bool:
     Returns:
         bool: True if the challenge was completed correctly
     """
-    # First, deregister any expired challenges. This will invalidate this
-    # challenge-response if it is expired.
-    expire_challenges()
-
-    # Construct the key object. We cannot simply get the key object as a parameter since
-    # it will be pulled from the database
-    pub_key = VerifyKey(bytes.fromhex(pub_key_hex))
-    try:
-        # Check the signature
-        challenge = pub_key.verify(bytes.fromhex(signature_hex))
-        challenge = str(challenge, "utf-8")
-    except BadSignatureError:
-        return False
-
-    # Now that we have verified the signature, we need to deregister the challenge and
-    # make sure that its session id corresponds to the current user's
-    challenge_info = pop_challenge(challenge=challenge)
-    if challenge_info.sess_id != sess_id():
-        # The challenge was created by someone other than who is trying to complete it!
-        # We don't want this to have actually deregistered the challenge, as that could
-        # give rise to a DOS attack preventing logins.
-        # Register the challenge again, and make sure it expires at the exact same time
-        # that it would have.
-        this.challenge_expires[challenge_info.exp_time] = challenge_info.challenge
-        this.active_challenges[challenge_info.challenge] = (
-            sess_id(),
-            challenge_info.exp_time,
-        )
+    challenge = verify_signature(signature_hex, pub_key_hex)
+    if challenge is None:
         return False
 
-    return True
+    # Now that we have verified the signature, we need to deregister the challenge. It
+    # is only deregistered if it hasn't expired and its session id corresponds to the
+    # current user's. If it was created by someone other than who is trying to
+    # complete it, it is left registered, since removing it could give rise to a DOS
+    # attack preventing logins.
+    return pop_challenge(challenge) is not None
 
 
 def username_taken(username: str) -> bool:
+    return find_user(username) is not None
+
+
+def find_user(username: str):
+    """Gets the user's id, password hash and salt, or None if there is no such user"""
     db = get_db()
-    user = db.execute("select * from User where username like ?", [username]).fetchall()
-    return bool(user)
+    # Usernames are case-insensitive. This is not done with `like` since that would
+    # treat _ and % in usernames as wildcards
+    return db.execute(
+        """
+            select user_id_, pass_hash, pass_salt from User
+            where username = ? collate nocase
+        """,
+        [username],
+    ).fetchone()
+
+
+def hash_password(password: bytes, salt: bytes) -> str:
+    """Computes the salted hash of KDF(password) that is stored in the User table"""
+    # We are using blake2b instead of a KDF because the password was already fed through
+    # a KDF. So, in effect the password is double-hashed. The first hash (KDF) prevents
+    # the server from knowing the password as it is never transmitted. The second hash
+    # here ensures that the database does contain everything one would need to
+    # authenticate themselves as another user.
+    hash_ = blake2b(salt=salt)
+    hash_.update(password)
+    return str(b64encode(hash_.digest()), "utf-8")
+
+
+def check_password(password: bytes, pass_salt: bytes, pass_hash: str) -> bool:
+    """Checks KDF(password) against the user's salt and hash from the User table"""
+    # -- WARNING --
+    # THIS PORTION IS VERY SENSITIVE
+    # It is EXTREMELY IMPORTANT that we encode the given password instead of
+    # decoding the pass_hash from the db. I doubt that b64encode and b64decode
+    # are timing-safe, and doing this incorrectly could lead to a timing attack.
+    # This could leak the hashed password of a user.
+    password = hash_password(password, b64decode(pass_salt))
+
+    # DO NOT CHANGE THIS TO == OR ANYTHING SIMILAR, we must use compare_digest for
+    # timing safety.
+    return secrets.compare_digest(password, pass_hash)
 
 
 def login_user(user_id: str) -> None:
@@ -174,15 +175,13 @@ def login_user(user_id: str) -> None:
     db = get_db()
     db.execute(
         """
-            insert into Sess(sess_id, user_id_)
-            values(?, ?)
+            insert into Sess(sess_id, user_id_, issued, last_seen)
+            values(?, ?, ?, ?)
         """,
-        [sess_id(), user_id],
+        [sess_id(), user_id, now(), now()],
     )
     db.commit()
-
-    # Add it to the known sessions
-    this.sessions[sess_id()] = user_id
+    forget_sess_info(sess_id())
 
 
 def logout_user() -> None:
@@ -190,20 +189,85 @@ def logout_user() -> None:
     db = get_db()
     db.execute("delete from Sess where sess_id=?", [sess_id()])
     db.commit()
-
-    # Remove the session from the known sessions
-    if sess_id() in this.sessions:
-        del this.sessions[sess_id()]
+    forget_sess_info(sess_id())
 
     # Remove the session cookie
     del session["sess_id"]
 
 
 def get_sess_info():
-    db = get_db()
-    return db.execute(
-        "select * from Sess natural join User where sess_id=?", [sess_id()]
-    ).fetchone()
+    """Gets the current user's session joined with their user, or None if they aren't
+    logged in or their session has expired. This is looked up once per request, and
+    is cached by the worker for up to SESSION_CACHE_SECONDS so that most requests
+    don't query the database for it. The cached copy is only used while no session
+    has been deleted since it was cached, going by sess_version, so a logout or an
+    expiry on another worker is seen within SESSION_VERSION_SECONDS. The session's
+    last_seen is updated when it is looked up, at most every SESSION_TOUCH_SECONDS.
+    """
+    if "sess_info" in g:
+        return g.sess_info
+
+    sess_info = None
+    # Requests without a session can't be logged in, so there is nothing to look up
+    if "sess_id" in session:
+        sessions = cache.get_cache("sessions")
+        version = sess_version()
+        cached = sessions.get(session["sess_id"])
+        if cached is not None and cached[1] == version:
+            sess_info = cached[0]
+        else:
+            db = get_db()
+            generation = sessions.generation
+            sess_info = db.execute(
+                """
+                    select * from Sess natural join User
+                    where sess_id = ? and last_seen > ? and issued > ?
+                """,
+                [session["sess_id"], *session_cutoffs()],
+            ).fetchone()
+            touch_seconds = current_app.config.get(
+                "SESSION_TOUCH_SECONDS", SESSION_TOUCH_SECONDS
+            )
+            if sess_info is not None and sess_info["last_seen"] < now() - touch_seconds:
+                db.execute(
+                    "update Sess set last_seen=? where sess_id=?",
+                    [now(), session["sess_id"]],
+                )
+                db.commit()
+            # Not being logged in isn't cached, so logging in on another worker is
+            # seen right away
+            if sess_info is not None:
+                sessions.set(
+                    session["sess_id"], (sess_info, version), generation=generation
+                )
+    g.sess_info = sess_info
+    return sess_info
+
+
+def sess_version() -> int:
+    """
+    Gets the version in SessVersion, which changes whenever a session is deleted. The
+    worker rereads it at most every SESSION_VERSION_SECONDS, so most requests are
+    answered from the session cache without touching the database.
+    """
+    version, checked = current_app.extensions["sess_version"]
+    interval = current_app.config.get(
+        "SESSION_VERSION_SECONDS", SESSION_VERSION_SECONDS
+    )
+    if monotonic() - checked >= interval:
+        checked = monotonic()
+        (version,) = (
+            get_db().execute("select version from SessVersion where id = 1").fetchone()
+        )
+        # Replaced as one tuple so other threads never see a mismatched pair
+        current_app.extensions["sess_version"] = (version, checked)
+    return version
+
+
+def forget_sess_info(sess_id: SessId) -> None:
+    """Removes the session from the current request's and the worker's caches"""
+    g.pop("sess_info", None)
+    cache.get_cache("sessions").pop(sess_id)
 
 
 # routes
@@ -215,6 +279,7 @@ def auth_page():
 
 
 @bp.route("/register", methods=["POST"])
+@gated
 def register():
     # Get username and password
     try:
@@ -236,14 +301,7 @@ def register():
 
     # Compute a salted hash of the password
     salt = secrets.token_bytes(128 // 8)
-    # We are using blake2b instead of a KDF because the password was already fed through
-    # a KDF. So, in effect the password is double-hashed. The first hash (KDF) prevents
-    # the server from knowing the password as it is never transmitted. The second hash
-    # here ensures that the database does contain everything one would need to
-    # authenticate themselves as another user.
-    hash_ = blake2b(salt=salt)
-    hash_.update(password)
-    pass_hash = str(b64encode(hash_.digest()), "utf-8")
+    pass_hash = hash_password(password, salt)
 
     # Add the new user to the DB
     db = get_db()
@@ -266,6 +324,7 @@ def register():
 
 
 @bp.route("/login", methods=["POST"])
+@gated
 def login():
     # Get the username and hashed password
     try:
@@ -281,29 +340,12 @@ def login():
         print(request.data)
         return Response("Invalid data - must be json", status=406)
 
-    # If the username is not taken, then the username must not exist
-    if not username_taken(username):
-        return Response("Incorrect username", status=404)
-
     # Get the user's info from the DB
-    db = get_db()
-    user_row = db.execute(
-        "select * from User where username like ?", [username]
-    ).fetchone()
-
-    # -- WARNING --
-    # THIS PORTION IS VERY SENSITIVE
-    hash_ = blake2b(salt=b64decode(user_row["pass_salt"]))
-    hash_.update(password)
-    # It is EXTREMELY IMPORTANT that we encode the given password instead of
-    # decoding the pass_hash from the db. I doubt that b64encode and b64decode
-    # are timing-safe, and doing this incorrectly could lead to a timing attack.
-    # This could leak the hashed password of a user.
-    password = str(b64encode(hash_.digest()), "utf-8")
+    user_row = find_user(username)
+    if user_row is None:
+        return Response("Incorrect username", status=404)
 
-    # DO NOT CHANGE THIS TO == OR ANYTHING SIMILAR, we must use compare_digest for
-    # timing safety.
-    if secrets.compare_digest(password, user_row["pass_hash"]):
+    if check_password(password, user_row["pass_salt"], user_row["pass_hash"]):
         login_user(user_row["user_id_"])
         return redirect(url_for("home.home"))
     else:
@@ -314,3 +356,14 @@ def login():
 def logout():
     logout_user()
     return redirect(url_for("home.home"))
+
+
+def init_app(app):
+    app.extensions["sess_version"] = (None, float("-inf"))
+    cache.add_cache(
+        app,
+        "sessions",
+        app.config.get("SESSION_CACHE_ENTRIES", 4096),
+        app.config.get("SESSION_CACHE_BYTES", 4 * 2**20),
+        app.config.get("SESSION_CACHE_SECONDS", 30),
+    )
@@ -0,0 +1,81 @@
+"""
+Admission control for the authentication routes. A worker handles at most
+AUTH_CONCURRENCY logins and registrations, with their password hashing, at a time.
+Any more are answered right away with a 503 and a Retry-After of AUTH_RETRY_AFTER
+seconds instead of waiting, so a storm of logins can't take every thread the worker
+has for rendering the catalog. The number of requests in flight and how many were
+admitted and turned away are served by /_stats/ under "auth".
+"""
+
+import threading
+from functools import wraps
+
+from flask import current_app
+from flask.wrappers import Response
+
+from app import stats
+
+
+class AuthGate:
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.slots = threading.BoundedSemaphore(limit)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.admitted = 0
+        self.rejected = 0
+
+    def enter(self) -> bool:
+        """Takes a slot if one is free and returns whether it did. Never blocks."""
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.rejected += 1
+            return False
+        with self.lock:
+            self.in_flight += 1
+            self.admitted += 1
+        return True
+
+    def leave(self) -> None:
+        with self.lock:
+            self.in_flight -= 1
+        self.slots.release()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "limit": self.limit,
+                "in_flight": self.in_flight,
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+            }
+
+
+def busy_response() -> Response:
+    """Tells the client to try again once fewer logins are in progress"""
+    return Response(
+        "Too many logins are in progress, try again shortly",
+        status=503,
+        headers={"Retry-After": str(current_app.config.get("AUTH_RETRY_AFTER", 1))},
+    )
+
+
+def gated(view):
+    """Runs the view only if the worker's auth gate has a free slot"""
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        gate = current_app.extensions["auth_gate"]
+        if not gate.enter():
+            return busy_response()
+        try:
+            return view(*args, **kwargs)
+        finally:
+            gate.leave()
+
+    return wrapper
+
+
+def init_app(app):
+    gate = app.extensions["auth_gate"] = AuthGate(app.config.get("AUTH_CONCURRENCY", 2))
+    stats.register(app, "auth", gate.stats)
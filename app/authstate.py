@@ -0,0 +1,444 @@
+"""
+Where the authentication challenges are kept, and how expired sessions are swept.
+
+The AUTH_STATE config key picks the backend for the challenges:
+    * 'memory' keeps them in the process. This is only correct when the app runs
+      in a single process, since a challenge issued by one worker can't be
+      completed on another.
+    * 'sqlite' keeps them in the AuthChallenge table, so every worker sees the same
+      ones.
+
+Sessions are always in the Sess table, which every worker reads.
+
+Challenges expire exp_time seconds after the epoch. Expired challenges are never
+handed out. A few of them are removed each time a challenge is added, and the rest
+by the background sweep. At most CHALLENGE_CAPACITY challenges can be outstanding,
+and at most CHALLENGES_PER_SESSION for any one session, so that unauthenticated
+clients can't make the store grow without bound. Adding a challenge past either
+limit raises ChallengeLimitError.
+
+Sessions expire once they haven't been seen for SESSION_IDLE_SECONDS, or once
+SESSION_MAX_SECONDS have passed since they were issued, whichever comes first.
+Expired sessions are never used, and each worker deletes them from the Sess table
+every SESSION_SWEEP_SECONDS on a background thread, SESSION_SWEEP_BATCH rows at a
+time so that other writers never wait on it for long. Expired challenges are swept
+along with them.
+"""
+
+import heapq
+import itertools
+import os
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from time import perf_counter, sleep
+from time import time as now
+from typing import NamedTuple, Optional, Tuple
+
+from flask import current_app
+
+from app import stats
+from app.database import get_db
+
+IDLE_SECONDS = 14 * 24 * 60 * 60
+MAX_SECONDS = 90 * 24 * 60 * 60
+CHALLENGE_CAPACITY = 100000
+CHALLENGES_PER_SESSION = 8
+# How many expired challenges are removed each time a challenge is added
+EXPIRE_BATCH = 8
+
+
+class ChallengeLimitError(ValueError):
+    pass
+
+
+class ChallengeInfo(NamedTuple):
+    challenge: str
+    sess_id: str
+    exp_time: float
+
+
+class ChallengeStore:
+    """
+    The outstanding challenges of one process, at most `capacity` of them and at
+    most `per_session` for any one session. Not thread-safe.
+
+    Expiry times are kept in a heap of (exp_time, sequence number, challenge). The
+    sequence numbers make every entry distinct, so challenges expiring at the same
+    time never collide. Adding a challenge removes up to EXPIRE_BATCH expired ones
+    from the top of the heap, so adding and expiring each cost O(log n) and nothing
+    scans the whole store. Completed challenges are left in the heap and skipped
+    when they reach the top, and the heap is rebuilt once most of it is skipped.
+    """
+
+    def __init__(self, capacity: int, per_session: int):
+        self.capacity = capacity
+        self.per_session = per_session
+        # Maps challenges to (ChallengeInfo, sequence number)
+        self.challenges = {}
+        self.heap = []
+        self.sequence = itertools.count()
+        # Maps sess_id to how many challenges it has outstanding
+        self.session_counts = {}
+        self.rejected = 0
+
+    def __len__(self):
+        return len(self.challenges)
+
+    def add(self, info: ChallengeInfo) -> None:
+        at = now()
+        self.expire(at, EXPIRE_BATCH)
+        if info.challenge in self.challenges:
+            self.remove(info.challenge)
+        if (
+            len(self.challenges) >= self.capacity
+            or self.session_counts.get(info.sess_id, 0) >= self.per_session
+        ):
+            # Make room from the challenges that have expired, if there are any
+            self.expire(at)
+        if len(self.challenges) >= self.capacity:
+            self.rejected += 1
+            raise ChallengeLimitError("Too many challenges are outstanding")
+        if self.session_counts.get(info.sess_id, 0) >= self.per_session:
+            self.rejected += 1
+            raise ChallengeLimitError("The session has too many challenges outstanding")
+
+        sequence = next(self.sequence)
+        self.challenges[info.challenge] = (info, sequence)
+        heapq.heappush(self.heap, (info.exp_time, sequence, info.challenge))
+        self.session_counts[info.sess_id] = self.session_counts.get(info.sess_id, 0) + 1
+
+    def remove(self, challenge: str) -> ChallengeInfo:
+        info, _ = self.challenges.pop(challenge)
+        count = self.session_counts[info.sess_id] - 1
+        if count:
+            self.session_counts[info.sess_id] = count
+        else:
+            del self.session_counts[info.sess_id]
+        if len(self.heap) > 2 * len(self.challenges) + 64:
+            self.heap = [
+                (info.exp_time, sequence, challenge)
+                for challenge, (info, sequence) in self.challenges.items()
+            ]
+            heapq.heapify(self.heap)
+        return info
+
+    def pop(self, challenge: str, sess_id: str) -> Optional[ChallengeInfo]:
+        info, _ = self.challenges.get(challenge, (None, None))
+        if info is None or info.sess_id != sess_id or info.exp_time <= now():
+            return None
+        return self.remove(challenge)
+
+    def expire(self, at: float, limit: Optional[int] = None) -> int:
+        """Removes up to `limit` challenges that expired by `at` and returns how many"""
+        n_expired = 0
+        while self.heap and self.heap[0][0] <= at and n_expired != limit:
+            _, sequence, challenge = heapq.heappop(self.heap)
+            entry = self.challenges.get(challenge)
+            # Otherwise it was completed, or added again, after this entry was pushed
+            if entry is not None and entry[1] == sequence:
+                self.remove(challenge)
+                n_expired += 1
+        return n_expired
+
+    def stats(self) -> dict:
+        return {
+            "outstanding": len(self.challenges),
+            "heap": len(self.heap),
+            "sessions": len(self.session_counts),
+            "capacity": self.capacity,
+            "rejected": self.rejected,
+        }
+
+
+def session_cutoffs() -> Tuple[float, float]:
+    """
+    Sessions last seen at or before the first time, or issued at or before the
+    second, have expired
+    """
+    config = current_app.config
+    at = now()
+    return (
+        at - config.get("SESSION_IDLE_SECONDS", IDLE_SECONDS),
+        at - config.get("SESSION_MAX_SECONDS", MAX_SECONDS),
+    )
+
+
+class AuthState(ABC):
+    """The operations every backend supports"""
+
+    @classmethod
+    def from_config(cls, config) -> "AuthState":
+        return cls()
+
+    @abstractmethod
+    def add_challenge(self, info: ChallengeInfo) -> None:
+        """Raises ChallengeLimitError if there are too many challenges outstanding"""
+
+    @abstractmethod
+    def pop_challenge(self, challenge: str, sess_id: str) -> Optional[ChallengeInfo]:
+        """
+        Removes and returns the challenge if it was issued to sess_id and hasn't
+        expired. Otherwise it is left alone, so that someone else trying to complete
+        it can't stop its session from logging in, and None is returned.
+        """
+
+    @abstractmethod
+    def expire_challenges(self, limit: Optional[int] = None) -> int:
+        """Removes up to `limit` expired challenges and returns how many there were"""
+
+    @abstractmethod
+    def challenge_stats(self) -> dict: ...
+
+
+class MemoryAuthState(AuthState):
+    def __init__(
+        self,
+        capacity: int = CHALLENGE_CAPACITY,
+        per_session: int = CHALLENGES_PER_SESSION,
+    ):
+        self.lock = threading.Lock()
+        self.challenges = ChallengeStore(capacity, per_session)
+
+    @classmethod
+    def from_config(cls, config) -> "MemoryAuthState":
+        return cls(
+            config.get("CHALLENGE_CAPACITY", CHALLENGE_CAPACITY),
+            config.get("CHALLENGES_PER_SESSION", CHALLENGES_PER_SESSION),
+        )
+
+    def add_challenge(self, info: ChallengeInfo) -> None:
+        with self.lock:
+            self.challenges.add(info)
+
+    def pop_challenge(self, challenge: str, sess_id: str) -> Optional[ChallengeInfo]:
+        with self.lock:
+            return self.challenges.pop(challenge, sess_id)
+
+    def expire_challenges(self, limit: Optional[int] = None) -> int:
+        with self.lock:
+            return self.challenges.expire(now(), limit)
+
+    def challenge_stats(self) -> dict:
+        with self.lock:
+            return self.challenges.stats()
+
+
+class SqliteAuthState(AuthState):
+    """
+    Keeps everything in the database through the request's connection. Every change
+    is committed right away so the other workers see it.
+    """
+
+    def __init__(
+        self,
+        capacity: int = CHALLENGE_CAPACITY,
+        per_session: int = CHALLENGES_PER_SESSION,
+    ):
+        self.capacity = capacity
+        self.per_session = per_session
+        self.rejected = 0
+
+    @classmethod
+    def from_config(cls, config) -> "SqliteAuthState":
+        return cls(
+            config.get("CHALLENGE_CAPACITY", CHALLENGE_CAPACITY),
+            config.get("CHALLENGES_PER_SESSION", CHALLENGES_PER_SESSION),
+        )
+
+    def add_challenge(self, info: ChallengeInfo) -> None:
+        db = get_db()
+        # Deleting first takes the write lock, so the limits are checked and the
+        # challenge added without another worker adding one in between
+        at = now()
+        self.delete_expired(db, at, EXPIRE_BATCH)
+        error = None
+        if (
+            db.execute(
+                "select count(*) from AuthChallenge where sess_id=? and exp_time > ?",
+                [info.sess_id, at],
+            ).fetchone()[0]
+            >= self.per_session
+        ):
+            error = "The session has too many challenges outstanding"
+        elif self.count(db) >= self.capacity:
+            # Make room from the challenges that have expired, if there are any
+            self.delete_expired(db, at)
+            if self.count(db) >= self.capacity:
+                error = "Too many challenges are outstanding"
+        if error:
+            db.commit()
+            self.rejected += 1
+            raise ChallengeLimitError(error)
+        db.execute("insert or replace into AuthChallenge values(?, ?, ?)", info)
+        db.commit()
+
+    @staticmethod
+    def count(db: sqlite3.Connection) -> int:
+        return db.execute("select count(*) from AuthChallenge").fetchone()[0]
+
+    @staticmethod
+    def delete_expired(
+        db: sqlite3.Connection, at: float, limit: Optional[int] = None
+    ) -> int:
+        """Deletes up to `limit` challenges that expired by `at`, without committing"""
+        return db.execute(
+            """
+            delete from AuthChallenge where rowid in (
+                select rowid from AuthChallenge where exp_time <= ? limit ?
+            )
+            """,
+            [at, -1 if limit is None else limit],
+        ).rowcount
+
+    def pop_challenge(self, challenge: str, sess_id: str) -> Optional[ChallengeInfo]:
+        # Checking and removing it in one statement means that only one worker can
+        # ever complete it
+        db = get_db()
+        row = db.execute(
+            """
+            delete from AuthChallenge
+            where challenge = ? and sess_id = ? and exp_time > ?
+            returning challenge, sess_id, exp_time
+            """,
+            [challenge, sess_id, now()],
+        ).fetchone()
+        db.commit()
+        return ChallengeInfo(*row) if row else None
+
+    def expire_challenges(self, limit: Optional[int] = None) -> int:
+        db = get_db()
+        n_expired = self.delete_expired(db, now(), limit)
+        db.commit()
+        return n_expired
+
+    def challenge_stats(self) -> dict:
+        return {
+            "outstanding": self.count(get_db()),
+            "capacity": self.capacity,
+            "rejected": self.rejected,
+        }
+
+
+BACKENDS = {
+    "memory": MemoryAuthState,
+    "sqlite": SqliteAuthState,
+}
+
+
+def sweep_sessions(
+    db: sqlite3.Connection, idle_before: float, issued_before: float, limit: int
+) -> int:
+    """
+    Deletes up to `limit` expired sessions from the Sess table and commits, so that
+    the write lock is only held for one small batch. Returns how many were deleted.
+    """
+    n_deleted = db.execute(
+        """
+        delete from Sess where rowid in (
+            select rowid from Sess where last_seen <= ? or issued <= ? limit ?
+        )
+        """,
+        [idle_before, issued_before, limit],
+    ).rowcount
+    db.commit()
+    return n_deleted
+
+
+class SessionSweeper:
+    """
+    Deletes the expired sessions every `interval` seconds on a background thread.
+    The thread is started by the first request each process handles, so that
+    workers forked from a preloaded app each get their own.
+    """
+
+    def __init__(self, app, interval: float, batch_size: int, pause: float):
+        self.app = app
+        self.interval = interval
+        self.batch_size = batch_size
+        # How long to wait between batches, to let other writers in
+        self.pause = pause
+        self.lock = threading.Lock()
+        self.pid = None
+        self.stopped = threading.Event()
+        self.sweeps = 0
+        self.swept = 0
+        self.sweep_seconds = 0.0
+        self.errors = 0
+
+    def start(self) -> None:
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                threading.Thread(
+                    target=self.run, name="session-sweeper", daemon=True
+                ).start()
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            try:
+                self.sweep()
+            except sqlite3.Error:
+                self.errors += 1
+                self.app.logger.exception("Could not sweep expired sessions")
+
+    def sweep(self) -> int:
+        """
+        Deletes every expired session and challenge, a batch at a time, and returns
+        how many sessions there were
+        """
+        start = perf_counter()
+        n_swept = 0
+        with self.app.app_context():
+            idle_before, issued_before = session_cutoffs()
+            db = get_db()
+            while True:
+                n_deleted = sweep_sessions(
+                    db, idle_before, issued_before, self.batch_size
+                )
+                n_swept += n_deleted
+                if n_deleted < self.batch_size:
+                    break
+                sleep(self.pause)
+            while get_state().expire_challenges(self.batch_size) == self.batch_size:
+                sleep(self.pause)
+        self.sweeps += 1
+        self.swept += n_swept
+        self.sweep_seconds = perf_counter() - start
+        return n_swept
+
+    def stats(self) -> dict:
+        return {
+            "sweeps": self.sweeps,
+            "swept": self.swept,
+            "last_sweep_seconds": self.sweep_seconds,
+            "errors": self.errors,
+        }
+
+
+def get_state() -> AuthState:
+    return current_app.extensions["auth_state"]
+
+
+def init_app(app):
+    backend = app.config.get("AUTH_STATE", "memory")
+    if backend not in BACKENDS:
+        raise ValueError(
+            f"AUTH_STATE must be one of {', '.join(BACKENDS)}, not {backend!r}"
+        )
+    app.extensions["auth_state"] = BACKENDS[backend].from_config(app.config)
+
+    sweeper = app.extensions["session_sweeper"] = SessionSweeper(
+        app,
+        app.config.get("SESSION_SWEEP_SECONDS", 600),
+        app.config.get("SESSION_SWEEP_BATCH", 500),
+        app.config.get("SESSION_SWEEP_PAUSE", 0.05),
+    )
+    if sweeper.interval:
+        app.before_request(sweeper.start)
+    stats.register(app, "sessions", sweeper.stats)
+    stats.register(
+        app, "challenges", lambda: app.extensions["auth_state"].challenge_stats()
+    )
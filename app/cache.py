@@ -0,0 +1,139 @@
+"""
+In-memory caches shared by a worker's threads.
+
+Each cache is a bounded LRU: once it holds more than its maximum number of entries
+or its maximum number of bytes, the least recently used entries are evicted. A cache
+can also be given a ttl, after which its entries are treated as missing. The
+caches' hit, miss and eviction counts are served by /_stats/ under "caches" so
+that the limits can be sized from real traffic.
+"""
+
+import sys
+import threading
+from collections import OrderedDict
+from time import monotonic
+from typing import Optional
+
+from flask import current_app
+
+from app import stats
+
+
+class LRUCache:
+    """
+    A thread-safe LRU cache bounded by entry count and by size in bytes. If ttl is
+    given, entries are only returned for ttl seconds after they were set.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int, ttl: Optional[float] = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # Maps keys to (value, size, expiry time), least recently used first
+        self.entries = OrderedDict()
+        self.bytes = 0
+        # Incremented whenever entries are invalidated
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value, size, expires = self.entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and expires <= monotonic():
+                del self.entries[key]
+                self.bytes -= size
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, size: int = None, generation: int = None) -> None:
+        """
+        Adds the value to the cache, evicting the least recently used entries to
+        make room for it. size defaults to sys.getsizeof(value), which is only the
+        size of the value itself and not of anything it refers to. Values bigger
+        than the whole cache are not stored.
+
+        If generation is given, the value is only stored if nothing has been
+        invalidated since self.generation was that. Read the generation before
+        loading the value so that a value loaded before an invalidation can't be
+        stored after it.
+        """
+        if size is None:
+            size = sys.getsizeof(value)
+        expires = monotonic() + self.ttl if self.ttl is not None else None
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            if key in self.entries:
+                self.bytes -= self.entries.pop(key)[1]
+            if size > self.max_bytes:
+                return
+            self.entries[key] = (value, size, expires)
+            self.bytes += size
+            while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+                _, (_, evicted_size, _) = self.entries.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+
+    def pop(self, key) -> None:
+        """Removes the key from the cache if it is there"""
+        with self.lock:
+            if key in self.entries:
+                self.bytes -= self.entries.pop(key)[1]
+                self.invalidations += 1
+            self.generation += 1
+
+    def clear(self) -> None:
+        with self.lock:
+            self.invalidations += len(self.entries)
+            self.entries.clear()
+            self.bytes = 0
+            self.generation += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else None,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "expirations": self.expirations,
+            }
+
+
+def add_cache(
+    app, name: str, max_entries: int, max_bytes: int, ttl: Optional[float] = None
+) -> LRUCache:
+    """Creates a cache for the app that can be looked up with get_cache(name)"""
+    cache = LRUCache(max_entries, max_bytes, ttl)
+    app.extensions["caches"][name] = cache
+    return cache
+
+
+def get_cache(name: str) -> LRUCache:
+    return current_app.extensions["caches"][name]
+
+
+def init_app(app):
+    caches = app.extensions["caches"] = {}
+    stats.register(
+        app, "caches", lambda: {name: cache.stats() for name, cache in caches.items()}
+    )
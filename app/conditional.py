@@ -0,0 +1,142 @@
+"""
+Conditional GET support for the catalog pages.
+
+A page's ETag is derived from the versions of everything shown on it: the catalog
+version, the versions of any comments on it, and the logged in user, since the
+navigation bar and the comment boxes depend on who is looking. Routes compute the
+validators with a few primary key lookups and answer matching conditional requests
+with a 304 before running their queries or rendering anything:
+
+    validators = conditional.validators(conditional.catalog_version(db))
+    response = conditional.not_modified(validators)
+    if response:
+        return response
+    ...
+    return conditional.respond(render_template(...), validators)
+
+Responses vary on the session cookie. Pages for logged in users are private and
+have no Last-Modified, since logging in changes the page without changing when its
+content was last modified.
+"""
+
+import sqlite3
+from datetime import datetime
+from hashlib import blake2b
+from typing import NamedTuple, Optional
+
+from flask import make_response, request
+from flask.wrappers import Response
+
+from app import database
+from app.auth import get_sess_info
+
+
+class Version(NamedTuple):
+    version: object
+    modified: Optional[datetime]
+    # The number of comments, for the versions of comments
+    comments: Optional[int] = None
+
+
+class Validators(NamedTuple):
+    etag: str
+    last_modified: Optional[datetime]
+    private: bool
+
+
+def parse_modified(modified: Optional[str]) -> Optional[datetime]:
+    return datetime.fromisoformat(modified) if modified else None
+
+
+def catalog_version(db: sqlite3.Connection) -> Version:
+    """The catalog's version and when it last changed"""
+    meta = database.catalog_meta(db)
+    return Version(meta.get("version"), parse_modified(meta.get("modified")))
+
+
+def film_comments_version(db: sqlite3.Connection, film_id: str) -> Version:
+    """
+    The version and number of the comments on a film. The version is 0 if it has
+    never had any.
+    """
+    row = db.execute(
+        "select version, modified, comments from FilmCommentVersion where film_id=?",
+        [film_id],
+    ).fetchone()
+    if not row:
+        return Version(0, None, 0)
+    return Version(row[0], parse_modified(row[1]), row[2])
+
+
+def user_comments_version(db: sqlite3.Connection, user_id: str) -> Version:
+    """
+    The version and number of a user's comments. The version is 0 if they have
+    never had any.
+    """
+    row = db.execute(
+        "select version, modified, comments from UserCommentVersion where user_id_=?",
+        [user_id],
+    ).fetchone()
+    if not row:
+        return Version(0, None, 0)
+    return Version(row[0], parse_modified(row[1]), row[2])
+
+
+def validators(*versions: Version) -> Optional[Validators]:
+    """
+    Computes the validators for a page made from the given versions, as seen by
+    the current user. Returns None if the catalog isn't versioned, in which case
+    the page can't be validated.
+    """
+    if any(version.version is None for version in versions):
+        return None
+
+    sess_info = get_sess_info()
+    user_id = sess_info["user_id_"] if sess_info else None
+    tag = repr(([version.version for version in versions], user_id))
+    modified = [version.modified for version in versions if version.modified]
+    return Validators(
+        etag=blake2b(tag.encode("utf-8"), digest_size=16).hexdigest(),
+        last_modified=max(modified) if modified and not user_id else None,
+        private=user_id is not None,
+    )
+
+
+def add_validators(response: Response, validators: Optional[Validators]) -> Response:
+    if validators is None:
+        return response
+    response.set_etag(validators.etag)
+    if validators.last_modified:
+        response.last_modified = validators.last_modified
+    response.vary.add("Cookie")
+    # Caches may keep the page, but have to check that it is still current
+    response.cache_control.no_cache = True
+    if validators.private:
+        response.cache_control.private = True
+    else:
+        response.cache_control.public = True
+    return response
+
+
+def not_modified(validators: Optional[Validators]) -> Optional[Response]:
+    """
+    Returns a 304 response if the request is conditional and the client's copy of
+    the page is current, and otherwise None.
+    """
+    if validators is None:
+        return None
+    # If-None-Match takes precedence over If-Modified-Since
+    if request.if_none_match:
+        current = request.if_none_match.contains_weak(validators.etag)
+    elif request.if_modified_since and validators.last_modified:
+        current = validators.last_modified <= request.if_modified_since
+    else:
+        current = False
+    if not current:
+        return None
+    return add_validators(Response(status=304), validators)
+
+
+def respond(body, validators: Optional[Validators]) -> Response:
+    """Makes a response from the body with the validators attached"""
+    return add_validators(make_response(body), validators)
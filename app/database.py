@@ -1,61 +1,672 @@
 import os
+import secrets
+import shutil
 import sqlite3
+import threading
+import weakref
 from os import environ
 from tempfile import mkstemp
+from time import monotonic
+from urllib.parse import quote
 
 import click
-import populate_db
 from flask import current_app, g
 from flask.cli import with_appcontext
 
+from app import instrument, migrations
 
-def connect_db() -> sqlite3.Connection:
+# populate_db (and with it, pandas) is only imported by the functions that build
+# the catalog so that serving from a prebuilt snapshot starts quickly
+
+CATALOG_TABLES = ('Film', 'Directed', 'Acted', 'Produced', 'Listed',
+	'FilmFingerprint', 'CatalogMeta', 'FilmSearch')
+# These live in USER_DATABASE if it is configured, and otherwise alongside the catalog
+USER_TABLES = ('User', 'Sess', 'Comment')
+
+
+# Pragmas applied to every new connection. The profile is picked with the
+# SQLITE_PROFILE environment variable or config key, and a dict of pragmas can be
+# given instead of a name.
+SQLITE_PROFILES = {
+	'default': {},
+	'performance': {
+		# Readers don't block behind writers, and writers don't block readers
+		'journal_mode': 'wal',
+		# This is safe with WAL, only the last commits can be lost on power loss
+		'synchronous': 'normal',
+		'mmap_size': 256 * 2**20,
+		# Negative sizes are in KiB
+		'cache_size': -64 * 2**10,
+		'temp_store': 'memory',
+		'busy_timeout': 5000,
+	},
+}
+# These pragmas are set separately for each attached database
+SCHEMA_PRAGMAS = ('journal_mode', 'synchronous', 'mmap_size', 'cache_size')
+
+
+class CatalogValidationError(RuntimeError):
+	...
+
+
+class CatalogRefreshError(RuntimeError):
+	...
+
+
+def database_path() -> str:
+	"""The path to the catalog database. This will use the tempfile if specified in the config"""
+	return environ.get('DATABASE', current_app.config['DATABASE'])
+
+def user_database_path() -> str:
+	"""The path to the database holding the user tables"""
+	return current_app.config.get('USER_DATABASE') or database_path()
+
+def read_script(name) -> str:
+	with current_app.open_resource(f'../{name}') as f:
+		return f.read().decode('utf-8')
+
+
+def sqlite_profile() -> dict:
+	"""The pragmas to apply to new connections"""
+	profile = environ.get(
+		'SQLITE_PROFILE', current_app.config.get('SQLITE_PROFILE', 'default')
+	)
+	if isinstance(profile, dict):
+		return profile
+	return SQLITE_PROFILES[profile]
+
+def apply_profile(db: sqlite3.Connection, profile: dict, readonly=False):
+	schemas = ['main']
+	if current_app.config.get('USER_DATABASE'):
+		schemas.append('userdata')
+
+	for pragma, value in profile.items():
+		# The journal mode is stored in the file, so only writers can change it
+		if pragma == 'journal_mode' and readonly:
+			continue
+		if pragma in SCHEMA_PRAGMAS:
+			for schema in schemas:
+				db.execute(f'pragma {schema}.{pragma}={value}').fetchall()
+		else:
+			db.execute(f'pragma {pragma}={value}').fetchall()
+
+def file_uri(path, readonly=False) -> str:
+	uri = f'file:{quote(os.path.abspath(path))}'
+	return f'{uri}?mode=ro' if readonly else uri
+
+
+class PooledConnection(sqlite3.Connection):
+	"""
+	A connection that remembers which catalog file it was opened on. When
+	QUERY_STATS is on, the statements it executes are timed by app.instrument.
+	"""
+
+	catalog_key = None
+
+	def execute(self, sql, parameters=(), /):
+		if instrument.current_stats() is not None:
+			return self.cursor(instrument.TimedCursor).execute(sql, parameters)
+		return super().execute(sql, parameters)
+
+
+def connect_db(readonly=False) -> sqlite3.Connection:
 	"""
-	Initializes the connection to a temporary database
+	Opens a new connection to the database and applies the configured SQLite
+	profile to it.
+
+	Args:
+		readonly (bool): Opens the database in read-only mode. Any writes through
+			the connection will raise an sqlite3.OperationalError.
 
 	Returns:
 		sqlite3.Connection: The database connection
 	"""
-	# Make the tempfile
-	db_fd, db_path = mkstemp()
 	# Connect to the database. This will use the tempfile if specified in the config
 	db = sqlite3.connect(
-		environ.get('DATABASE', current_app.config['DATABASE'])
+		file_uri(database_path(), readonly),
+		uri=True,
+		factory=PooledConnection,
+		cached_statements=current_app.config.get('SQLITE_CACHED_STATEMENTS', 256),
 	)
 	db.row_factory = sqlite3.Row
-	g.db_fd = db_fd
-	g.db_path = db_path
+	# Keep the user tables in their own database so the catalog can be swapped out
+	# from under them. SQLite looks tables up in attached databases too, so queries
+	# don't need to know where the tables are.
+	if current_app.config.get('USER_DATABASE'):
+		db.execute(
+			'attach database ? as userdata',
+			[file_uri(user_database_path(), readonly)],
+		)
+	apply_profile(db, sqlite_profile(), readonly)
 	return db
 
-def get_db() -> sqlite3.Connection:
-	if not hasattr(g, 'db'):
-		g.db = connect_db()
-	return g.db
-
-def close_db():
-	print('Closing db')
-	if hasattr(g, 'db'):
-		g.db.close()
-	# Clean up the temp files
-	if hasattr(g, 'db_fd'):
-		os.close(g.db_fd)
-	if hasattr(g, 'db_path'):
-		os.unlink(g.db_path)
-
-def init_db(testing=False):
+
+class IdleList(list):
+	"""
+	A thread's idle connections. Unlike a plain list, it can be kept in a WeakSet,
+	where it is told apart from the other threads' lists by identity.
+	"""
+
+	__eq__ = object.__eq__
+	__hash__ = object.__hash__
+
+
+class ConnectionPool:
+	"""
+	Keeps a few warm connections for each thread so that requests don't pay for
+	opening and closing one. Each connection also keeps its own cache of prepared
+	statements. Connections are only ever used by the thread that opened them.
+	"""
+
+	def __init__(self, size: int = 2, readonly=False, recheck_seconds: float = 1.0):
+		self.size = size
+		self.readonly = readonly
+		# The catalog key and when it was last read. It is reread at most every
+		# recheck_seconds, so a refresh by another process is noticed within that.
+		self.recheck_seconds = recheck_seconds
+		self.checked_key = (None, float('-inf'))
+		self.local = threading.local()
+		self.pid = os.getpid()
+		# The idle lists of every live thread, so that they can all be closed before
+		# forking. A thread's list, and with it its connections, goes away when the
+		# thread does.
+		self.lock = threading.Lock()
+		self.idle_lists = weakref.WeakSet()
+
+	def idle(self) -> list:
+		"""The connections that are ready to be handed out on this thread"""
+		# Connections inherited from the parent of a forked worker must not be used
+		if self.pid != os.getpid():
+			self.local = threading.local()
+			self.pid = os.getpid()
+			self.lock = threading.Lock()
+			self.idle_lists = weakref.WeakSet()
+		if not hasattr(self.local, 'idle'):
+			self.local.idle = IdleList()
+			with self.lock:
+				self.idle_lists.add(self.local.idle)
+		return self.local.idle
+
+	def close_all(self):
+		"""
+		Closes the idle connections of every thread. This is only for just before
+		forking, when the thread that started the app is the only one using the pool.
+		"""
+		with self.lock:
+			for idle in list(self.idle_lists):
+				while idle:
+					idle.pop().close()
+
+	@staticmethod
+	def read_catalog_key():
+		"""
+		Identifies the file that the database path currently points to. This changes
+		when the catalog is refreshed.
+		"""
+		try:
+			stat = os.stat(database_path())
+		except FileNotFoundError:
+			return None
+		return stat.st_dev, stat.st_ino
+
+	def catalog_key(self):
+		"""The catalog key, read again if it hasn't been for recheck_seconds"""
+		key, checked = self.checked_key
+		if monotonic() - checked >= self.recheck_seconds:
+			key = self.read_catalog_key()
+			# Replaced as one tuple so other threads never see a mismatched pair
+			self.checked_key = (key, monotonic())
+		return key
+
+	def forget_catalog_key(self):
+		"""Makes the next acquire read the catalog key again"""
+		self.checked_key = (None, float('-inf'))
+
+	def acquire(self) -> sqlite3.Connection:
+		idle = self.idle()
+		key = self.catalog_key()
+		while idle:
+			db = idle.pop()
+			if db.catalog_key == key:
+				return db
+			# The catalog was swapped, so this connection is reading the old one
+			db.close()
+		db = connect_db(self.readonly)
+		db.catalog_key = key
+		return db
+
+	def release(self, db: sqlite3.Connection):
+		# Don't hand out a connection in the middle of someone else's transaction
+		if db.in_transaction:
+			db.rollback()
+		idle = self.idle()
+		if len(idle) < self.size:
+			idle.append(db)
+		else:
+			db.close()
+
+
+def get_pool(readonly=False) -> ConnectionPool:
+	pools = current_app.extensions['sqlite_pool']
+	return pools['readonly' if readonly else 'readwrite']
+
+def get_db(readonly=False) -> sqlite3.Connection:
+	"""
+	Gets the connection for the current request.
+
+	Args:
+		readonly (bool): Gets a separate, read-only connection. Pages that only
+			read should use this so they never wait on writers.
+	"""
+	name = 'readonly_db' if readonly else 'db'
+	if name not in g:
+		setattr(g, name, get_pool(readonly).acquire())
+	return getattr(g, name)
+
+def close_db(e=None):
+	"""Returns the request's connections to the pool"""
+	for name, readonly in (('db', False), ('readonly_db', True)):
+		db = g.pop(name, None)
+		if db is not None:
+			get_pool(readonly).release(db)
+
+def forget_catalog_keys():
+	"""Makes this worker's pools notice a catalog it just swapped in right away"""
+	for pool in current_app.extensions['sqlite_pool'].values():
+		pool.forget_catalog_key()
+
+def close_pools(app):
+	"""
+	Closes every idle connection. This is done once the app has started so that
+	workers forked from a preloaded app don't inherit the connections that were
+	opened while starting up, since SQLite connections must not cross a fork.
+	"""
+	for pool in app.extensions['sqlite_pool'].values():
+		pool.close_all()
+
+def init_app(app):
+	"""Sets up connection pooling for the app"""
+	size = app.config.get('SQLITE_POOL_SIZE', 2)
+	recheck_seconds = app.config.get('CATALOG_RECHECK_SECONDS', 1.0)
+	app.extensions['sqlite_pool'] = {
+		'readwrite': ConnectionPool(size, recheck_seconds=recheck_seconds),
+		'readonly': ConnectionPool(size, readonly=True,
+			recheck_seconds=recheck_seconds),
+	}
+	app.teardown_appcontext(close_db)
+
+def catalog_exists(db: sqlite3.Connection) -> bool:
+	"""Checks whether the database has already been populated"""
+	return bool(db.execute(
+		"select 1 from sqlite_master where type='table' and name='Film'"
+	).fetchone())
+
+def catalog_meta(db: sqlite3.Connection) -> dict:
+	"""
+	Returns the version of the catalog and when it was last modified, keyed by
+	'version' and 'modified'. Either is missing if the catalog doesn't have it.
+	"""
+	try:
+		return dict(db.execute(
+			"select key_, value from CatalogMeta where key_ in ('version', 'modified')"
+		))
+	except sqlite3.OperationalError:
+		# The database was populated before catalogs were versioned
+		return {}
+
+def catalog_version(db: sqlite3.Connection):
+	"""Returns the version of the catalog in the database, or None if it has none"""
+	return catalog_meta(db).get('version')
+
+def userdata_schema() -> str:
+	"""The name of the attached database holding the user tables"""
+	return 'userdata' if current_app.config.get('USER_DATABASE') else 'main'
+
+def migrate_db(db: sqlite3.Connection = None):
+	"""
+	Applies any migrations that the catalog and user tables are missing. Tables
+	that don't exist yet are skipped.
+	"""
+	db = db or get_db()
+	if catalog_exists(db):
+		migrations.migrate(db, 'catalog')
+	schema = userdata_schema()
+	if db.execute(
+		f"select 1 from {schema}.sqlite_master where type='table' and name='User'"
+	).fetchone():
+		migrations.migrate(db, 'userdata', schema)
+
+def init_userdata():
+	"""Creates the User, Sess, and Comment tables if they don't exist yet"""
+	db = sqlite3.connect(user_database_path())
+	db.executescript(read_script('query-create-userdata.sql'))
+	db.close()
+
+def init_db(testing=False, incremental=False):
+	"""
+	Creates the schema and populates it from netflix_titles.csv. If incremental is
+	true and the database was already populated, only the films that changed in the
+	csv are rewritten and everything else, including users and comments, is kept.
+	If testing is true and there are no users yet, fake users and comments are added.
+	"""
+	import populate_db
+
 	print('Initializing db')
+	init_userdata()
 	db = get_db()
+	if incremental and catalog_exists(db):
+		stats = populate_db.sync('netflix_titles.csv', db)
+		print(populate_db.format_sync_stats(stats))
+		migrate_db(db)
+		print('done')
+		return
+
+	# The user tables are kept, so fake users and comments are only added the first
+	# time. Otherwise every restart would add another batch of them.
+	if testing and db.execute('select 1 from User limit 1').fetchone():
+		print('Users already exist, not adding fake ones')
+		testing = False
+
 	# Initialize the database 
-	with current_app.open_resource('../query-create-database.sql') as f:
-		db.executescript(f.read().decode('utf-8'))
+	db.executescript(read_script('query-create-database.sql'))
 	db.commit() 
 	# Populate it using the dataset
-	populate_db.run('netflix_titles.csv', out=db.execute, testing=testing)
-	db.commit() 
+	stats = populate_db.ingest('netflix_titles.csv', db, testing=testing,
+		workers=current_app.config.get('IMPORT_WORKERS'))
+	print(populate_db.format_stats(stats))
+	migrate_db(db)
 	print('done')
 
+def build_catalog(db: sqlite3.Connection, csv_path='netflix_titles.csv'):
+	"""
+	Creates the catalog tables in an empty database and populates them from the csv.
+	The user tables are not created.
+
+	Returns:
+		tuple[IngestStats, str]: How the import went and the new catalog version
+	"""
+	import populate_db
+
+	db.executescript(read_script('query-create-database.sql'))
+	stats = populate_db.ingest(csv_path, db,
+		workers=current_app.config.get('IMPORT_WORKERS'))
+	print(populate_db.format_stats(stats))
+	# Indexes are quicker to build after everything is inserted
+	migrations.migrate(db, 'catalog')
+	return stats, catalog_version(db)
+
+def validate_catalog(db: sqlite3.Connection, n_films: int):
+	"""Raises a CatalogValidationError if a freshly built catalog looks wrong"""
+	integrity = db.execute('pragma integrity_check').fetchone()[0]
+	if integrity != 'ok':
+		raise CatalogValidationError(f'Integrity check failed: {integrity}')
+
+	counts = {
+		table: db.execute(f'select count(*) from {table}').fetchone()[0]
+		for table in CATALOG_TABLES
+	}
+	if not n_films or counts['Film'] != n_films:
+		raise CatalogValidationError(
+			f'Expected {n_films} films, found {counts["Film"]}'
+		)
+	if counts['FilmFingerprint'] != counts['Film']:
+		raise CatalogValidationError('Some films are missing fingerprints')
+	# The search index is keyed by the rowids of the films, so those have to match
+	indexed = db.execute('''
+		select count(*) from FilmSearch join Film on Film.rowid = FilmSearch.rowid
+		where Film.film_id = FilmSearch.film_id
+	''').fetchone()[0]
+	if counts['FilmSearch'] != counts['Film'] or indexed != counts['Film']:
+		raise CatalogValidationError('Some films are missing from the search index')
+	for table in ('Directed', 'Acted', 'Produced', 'Listed'):
+		if not counts[table]:
+			raise CatalogValidationError(f'{table} is empty')
+
+def build_snapshot(csv_path='netflix_titles.csv', out_dir='snapshots') -> str:
+	"""
+	Builds a ready-to-serve catalog from the csv and saves it in out_dir, named
+	after its catalog version. Nothing is written to the app's database.
+
+	Returns:
+		str: The path to the snapshot
+	"""
+	os.makedirs(out_dir, exist_ok=True)
+	# Build into a tempfile in the same directory so the snapshot only shows up once
+	# it is complete
+	db_fd, tmp_path = mkstemp(suffix='.tmp', dir=out_dir)
+	os.close(db_fd)
+	try:
+		db = sqlite3.connect(tmp_path)
+		stats, version = build_catalog(db, csv_path)
+		validate_catalog(db, stats.films)
+		db.execute('vacuum')
+		db.close()
+	except BaseException:
+		os.unlink(tmp_path)
+		raise
+
+	snapshot_path = os.path.join(out_dir, f'catalog-{version}.sqlite')
+	os.replace(tmp_path, snapshot_path)
+	return snapshot_path
+
+def carry_over_userdata(new_db: sqlite3.Connection, old_path: str):
+	"""
+	Copies the user tables from the old database into the new one. The new tables
+	are migrated first, so that columns added by migrations are copied too.
+	"""
+	new_db.executescript(read_script('query-create-userdata.sql'))
+	migrations.migrate(new_db, 'userdata')
+	new_db.execute('attach database ? as old', [old_path])
+	old_tables = {row[0] for row in new_db.execute(
+		"select name from old.sqlite_master where type='table'"
+	)}
+	for table in USER_TABLES:
+		if table in old_tables:
+			old_columns = {row[1] for row in new_db.execute(
+				f'pragma old.table_info({table})'
+			)}
+			columns = ', '.join(
+				row[1] for row in new_db.execute(f'pragma main.table_info({table})')
+				if row[1] in old_columns
+			)
+			new_db.execute(
+				f'insert into main.{table}({columns}) select {columns} from old.{table}'
+			)
+	new_db.commit()
+	new_db.execute('detach database old')
+
+def swap_catalog(db_path: str, catalog_path: str):
+	"""
+	Atomically points db_path at catalog_path. db_path becomes a symlink so that
+	every catalog version has its own file, and with it its own journal.
+	"""
+	link_path = f'{db_path}.{secrets.token_hex(8)}.link'
+	os.symlink(os.path.basename(catalog_path), link_path)
+	os.replace(link_path, db_path)
+
+def refresh_catalog(csv_path='netflix_titles.csv', offline=False) -> str:
+	"""
+	Rebuilds the catalog without any downtime. The new catalog is built in a
+	separate file and validated, and then the database path is atomically switched
+	over to it. Connections opened after the switch see the new catalog, and ones
+	opened before it keep reading the old one until they close.
+
+	If USER_DATABASE is configured, the user tables are left where they are.
+	Otherwise, they have to be copied into the new catalog, and connections that
+	are already open could keep writing to the old file after the copy. That is
+	only safe when nothing else has the database open, so offline has to be set to
+	say so, or a CatalogRefreshError is raised.
+
+	Returns:
+		str: The path to the file holding the new catalog
+	"""
+	carry_over = not current_app.config.get('USER_DATABASE')
+	if carry_over and not offline:
+		raise CatalogRefreshError(
+			'Set USER_DATABASE to refresh the catalog of a running server, or '
+			'refresh it offline to copy the user tables into the new catalog'
+		)
+
+	db_path = os.path.abspath(database_path())
+	old_path = os.path.realpath(db_path)
+	db_fd, tmp_path = mkstemp(suffix='.tmp', dir=os.path.dirname(db_path))
+	os.close(db_fd)
+	old_db = sqlite3.connect(old_path, isolation_level=None)
+	try:
+		new_db = sqlite3.connect(tmp_path)
+		stats, version = build_catalog(new_db, csv_path)
+		catalog_path = f'{db_path}.{version}'
+		if catalog_path == old_path:
+			print('The catalog is already up to date')
+			new_db.close()
+			os.unlink(tmp_path)
+			return catalog_path
+		# Validated before the old database is locked, so that writes to it only
+		# wait for the user tables to be copied
+		validate_catalog(new_db, stats.films)
+
+		if carry_over:
+			# Hold the write lock on the old database until the switch so that no
+			# comments are lost in between
+			old_db.execute('begin immediate')
+			carry_over_userdata(new_db, old_path)
+		new_db.close()
+		os.replace(tmp_path, catalog_path)
+		swap_catalog(db_path, catalog_path)
+		forget_catalog_keys()
+	except BaseException:
+		if os.path.exists(tmp_path):
+			os.unlink(tmp_path)
+		raise
+	finally:
+		if old_db.in_transaction:
+			old_db.rollback()
+		# Fold the old file's WAL back into it, since nothing opens it by its name
+		# anymore to do that. Anything that still has the old catalog open keeps it
+		# until it is closed.
+		old_db.execute('pragma wal_checkpoint(truncate)')
+		old_db.close()
+
+	# SQLite names the WAL files after the file a link points to, so the new catalog
+	# never uses the old ones. On the first refresh, the old file is the database
+	# path itself, which now holds the link.
+	old_files = [f'{old_path}-wal', f'{old_path}-shm']
+	if old_path != db_path:
+		old_files.append(old_path)
+	for path in old_files:
+		if os.path.exists(path):
+			os.unlink(path)
+	return catalog_path
+
+def file_catalog_version(path: str):
+	"""Returns the catalog version of the database file at path, or None"""
+	db = sqlite3.connect(path)
+	try:
+		return catalog_version(db)
+	finally:
+		db.close()
+
+def copy_snapshot(snapshot_path: str, db_path: str):
+	"""
+	Replaces the database at db_path with a copy of the snapshot. The copy is made
+	in a tempfile in the same directory and then moved into place, so db_path is
+	never left half copied. Without USER_DATABASE, the user tables are carried over
+	from the old database. Nothing else may have the database open.
+	"""
+	db_path = os.path.abspath(db_path)
+	old_path = os.path.realpath(db_path)
+	populated = os.path.exists(old_path) and os.path.getsize(old_path) > 0
+	db_fd, tmp_path = mkstemp(suffix='.tmp', dir=os.path.dirname(db_path))
+	os.close(db_fd)
+	try:
+		shutil.copyfile(snapshot_path, tmp_path)
+		if populated:
+			# Fold the old WAL back into its file so the user tables are read in full,
+			# and so the WAL isn't left around for the copy to pick up
+			old_db = sqlite3.connect(old_path)
+			old_db.execute('pragma wal_checkpoint(truncate)')
+			old_db.close()
+			if not current_app.config.get('USER_DATABASE'):
+				new_db = sqlite3.connect(tmp_path)
+				carry_over_userdata(new_db, old_path)
+				new_db.close()
+		os.replace(tmp_path, db_path)
+		forget_catalog_keys()
+	except BaseException:
+		if os.path.exists(tmp_path):
+			os.unlink(tmp_path)
+		raise
+
+	# If db_path was a link made by a refresh, the catalog it pointed to is unused
+	old_files = [f'{old_path}-wal', f'{old_path}-shm']
+	if old_path != db_path:
+		old_files.append(old_path)
+	for path in old_files:
+		if os.path.exists(path):
+			os.unlink(path)
+
+def use_snapshot(snapshot_path, mode='copy'):
+	"""
+	Serves the app from a snapshot made by build_snapshot without parsing the csv.
+
+	Args:
+		snapshot_path (str): The snapshot to serve from
+		mode (str): 'copy' copies the snapshot to the configured database unless
+			that database already has the snapshot's catalog version. 'attach' serves
+			from the snapshot file
+			itself, and needs USER_DATABASE so the user tables are kept out of it.
+	"""
+	if not os.path.isfile(snapshot_path):
+		raise FileNotFoundError(f'No snapshot at {snapshot_path}')
+
+	if mode == 'attach':
+		# Otherwise the users and their comments would be written into the snapshot,
+		# and lost along with it when the next snapshot is served
+		if not current_app.config.get('USER_DATABASE'):
+			raise ValueError('Set USER_DATABASE to serve from a snapshot in attach mode')
+		current_app.config['DATABASE'] = snapshot_path
+	elif mode != 'copy':
+		raise ValueError(f'Unknown snapshot mode {mode!r}')
+	else:
+		db_path = current_app.config['DATABASE']
+		version = file_catalog_version(snapshot_path)
+		if os.path.exists(db_path) and os.path.getsize(db_path) > 0 \
+				and file_catalog_version(db_path) == version:
+			print(f'{db_path} already has catalog {version}, not copying the snapshot')
+		else:
+			copy_snapshot(snapshot_path, db_path)
+			print(f'Copied {snapshot_path} to {db_path}')
+	init_userdata()
+
 @click.command('init-db')
 @with_appcontext
 def init_db_command():
 	init_db()
 	click.echo('Initilized the db.')
+
+@click.command('sync-db')
+@with_appcontext
+def sync_db_command():
+	init_db(incremental=True)
+	click.echo('Synced the db with the csv.')
+
+@click.command('build-snapshot')
+@click.option('--csv', 'csv_path', default='netflix_titles.csv',
+	help='The csv to build the catalog from.')
+@click.option('--out', 'out_dir', default='snapshots',
+	help='The directory to save the snapshot in.')
+@with_appcontext
+def build_snapshot_command(csv_path, out_dir):
+	snapshot_path = build_snapshot(csv_path, out_dir)
+	click.echo(f'Built {snapshot_path}')
+
+@click.command('refresh-catalog')
+@click.option('--csv', 'csv_path', default='netflix_titles.csv',
+	help='The csv to build the catalog from.')
+@click.option('--offline', is_flag=True,
+	help='Copy the user tables into the new catalog. Only use this when nothing '
+	'else has the database open.')
+@with_appcontext
+def refresh_catalog_command(csv_path, offline):
+	catalog_path = refresh_catalog(csv_path, offline)
+	click.echo(f'Now serving {catalog_path}')
@@ -0,0 +1,255 @@
+"""
+In-memory indexes for filtering the home page by type, genre, country, rating and
+release year, and for counting how many films match each option.
+
+Each worker builds a FacetIndex from the catalog when it starts, and rebuilds it
+when the catalog version changes. For every order the home page can be sorted by,
+the films are numbered by their position in that order, and every facet value has a
+bitmap, stored as a Python int, with the bits of the films that have it set.
+Filtering is then a few ORs and ANDs over ints, and a page of results is the next
+set bits after the position of the last film on the previous page, without going
+through SQLite.
+"""
+
+import re
+import sqlite3
+import threading
+from bisect import bisect_right
+from operator import attrgetter
+from time import perf_counter
+from typing import Dict, Iterator, List, NamedTuple, Optional
+
+from flask import current_app
+
+from app import stats
+from app.database import catalog_exists, catalog_version, get_db
+
+# Facets that are filtered by picking values. Values picked in the same facet are
+# alternatives, and the facets all have to match.
+FACETS = ("type", "genre", "country", "rating")
+ORDERS = ("feature", "title", "release_year")
+
+NONZERO_BYTE = re.compile(rb"[^\x00]")
+
+
+class Filters(NamedTuple):
+    # Maps each facet in FACETS to the values picked in it. Facets that aren't
+    # filtered by are left out.
+    values: Dict[str, List[str]] = {}
+    # The first and last release years to include, or None for no limit
+    year_from: Optional[int] = None
+    year_to: Optional[int] = None
+
+    def __bool__(self):
+        years = (self.year_from, self.year_to)
+        return bool(self.values) or any(year is not None for year in years)
+
+
+def make_bitmap(positions: List[int]) -> int:
+    bits = bytearray((max(positions, default=-1) + 8) // 8)
+    for position in positions:
+        bits[position >> 3] |= 1 << (position & 7)
+    return int.from_bytes(bits, "little")
+
+
+def set_bits(bitmap: int, start: int = 0) -> Iterator[int]:
+    """Yields the positions of the bits set in the bitmap from start on, in order"""
+    data = bitmap.to_bytes((bitmap.bit_length() + 7) // 8, "little")
+    match = NONZERO_BYTE.search(data, start >> 3)
+    while match:
+        i = match.start()
+        byte = data[i]
+        for bit in range(8):
+            position = (i << 3) | bit
+            if byte >> bit & 1 and position >= start:
+                yield position
+        match = NONZERO_BYTE.search(data, i + 1)
+
+
+class Film(NamedTuple):
+    film_id: str
+    feature: float
+    title: str
+    release_year: int
+    # The slots in FacetIndex.slots of the facet values the film has
+    slots: List[int]
+
+
+class OrderIndex:
+    """The films numbered by their position in one order, and the bitmaps for it"""
+
+    def __init__(self, order: str, films: List[Film], slots: list):
+        films = sorted(films, key=attrgetter(order, "film_id"))
+        # The position of every film in the order, to continue pages from
+        self.keys = [(getattr(film, order), film.film_id) for film in films]
+        self.film_ids = [film.film_id for film in films]
+
+        positions = [[] for _ in slots]
+        for position, film in enumerate(films):
+            for slot in film.slots:
+                positions[slot].append(position)
+        self.bitmaps = {facet: {} for facet in FACETS}
+        self.years = {}
+        for (facet, value), slot_positions in zip(slots, positions):
+            bitmap = make_bitmap(slot_positions)
+            if facet == "year":
+                self.years[value] = bitmap
+            else:
+                self.bitmaps[facet][value] = bitmap
+        self.all = (1 << len(films)) - 1
+
+    def matching(self, filters: Filters, exclude: str = None) -> int:
+        """The bitmap of the films matching the filters, except for facet `exclude`"""
+        result = self.all
+        for facet, values in filters.values.items():
+            if facet == exclude:
+                continue
+            bitmaps = self.bitmaps[facet]
+            picked = 0
+            for value in values:
+                picked |= bitmaps.get(value, 0)
+            result &= picked
+        if filters.year_from is not None or filters.year_to is not None:
+            year_from = filters.year_from if filters.year_from is not None else -1
+            year_to = filters.year_to if filters.year_to is not None else 1 << 31
+            picked = 0
+            for year, bitmap in self.years.items():
+                if year_from <= year <= year_to:
+                    picked |= bitmap
+            result &= picked
+        return result
+
+    def size(self) -> int:
+        """The approximate number of bytes used by the bitmaps"""
+        bitmaps = [b for values in self.bitmaps.values() for b in values.values()]
+        bitmaps += self.years.values()
+        return sum((bitmap.bit_length() + 7) // 8 for bitmap in bitmaps)
+
+
+class FacetIndex:
+    def __init__(self, version, films: List[Film], slots: list):
+        """
+        slots is the list of every (facet, value) pair, including ('year', year)
+        for the release years, that Film.slots refers to.
+        """
+        self.version = version
+        self.orders = {order: OrderIndex(order, films, slots) for order in ORDERS}
+        years = [film.release_year for film in films]
+        self.year_range = (min(years, default=None), max(years, default=None))
+
+    def __len__(self):
+        return len(self.orders[ORDERS[0]].film_ids)
+
+    def count(self, filters: Filters) -> int:
+        """The number of films matching the filters"""
+        return self.orders[ORDERS[0]].matching(filters).bit_count()
+
+    def facet_counts(self, filters: Filters) -> Dict[str, Dict[str, int]]:
+        """
+        Counts how many films each value of each facet would match. A facet's own
+        filter is left out when counting its values, so each count is the number
+        of films that would match if only that value were picked in its facet.
+        """
+        index = self.orders[ORDERS[0]]
+        counts = {}
+        for facet in FACETS:
+            matching = index.matching(filters, exclude=facet)
+            counts[facet] = {
+                value: (matching & bitmap).bit_count()
+                for value, bitmap in sorted(index.bitmaps[facet].items())
+            }
+        return counts
+
+    def page(
+        self, order: str, filters: Filters, after: list = None, limit: int = 50
+    ) -> List[str]:
+        """
+        Gets the ids of up to `limit` films matching the filters, in the order,
+        after the position `after` from film.parse_page_token.
+        """
+        index = self.orders[order]
+        start = bisect_right(index.keys, tuple(after)) if after else 0
+        film_ids = []
+        for position in set_bits(index.matching(filters), start):
+            if len(film_ids) == limit:
+                break
+            film_ids.append(index.film_ids[position])
+        return film_ids
+
+
+def build_index(db: sqlite3.Connection, version) -> FacetIndex:
+    """Builds the facet index from the catalog in the database"""
+    films = {}
+    slots = {}
+
+    def add(film_id, facet, value):
+        slot = slots.setdefault((facet, value), len(slots))
+        films[film_id].slots.append(slot)
+
+    for film_id, feature, title, release_year, film_type, rating in db.execute(
+        "select film_id, feature, title, release_year, film_type, rating from Film"
+    ):
+        films[film_id] = Film(film_id, feature, title, release_year, [])
+        add(film_id, "type", film_type)
+        add(film_id, "rating", rating)
+        add(film_id, "year", release_year)
+    for facet, sql in [
+        ("genre", "select film_id, genre_name from Listed"),
+        ("country", "select film_id, country_name from Produced"),
+    ]:
+        for film_id, value in db.execute(sql):
+            if film_id in films:
+                add(film_id, facet, value)
+    return FacetIndex(version, list(films.values()), list(slots))
+
+
+class IndexHolder:
+    """The worker's current FacetIndex, rebuilt when the catalog version changes"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.index = None
+        self.builds = 0
+        self.build_seconds = 0.0
+
+    def get(self, db: sqlite3.Connection, version) -> FacetIndex:
+        index = self.index
+        if index is not None and index.version == version:
+            return index
+        with self.lock:
+            # Another thread may have built it while this one was waiting
+            if self.index is None or self.index.version != version:
+                start = perf_counter()
+                self.index = build_index(db, version)
+                self.builds += 1
+                self.build_seconds = perf_counter() - start
+            return self.index
+
+    def stats(self) -> dict:
+        index = self.index
+        return {
+            "films": len(index) if index else 0,
+            "bytes": sum(o.size() for o in index.orders.values()) if index else 0,
+            "builds": self.builds,
+            "last_build_seconds": self.build_seconds,
+        }
+
+
+def get_index(db: sqlite3.Connection, version) -> FacetIndex:
+    """
+    Gets the facet index for the catalog version, building it from db if the
+    current one is for a different version.
+    """
+    return current_app.extensions["facet_index"].get(db, version)
+
+
+def warm():
+    """Builds the facet index for the current catalog, if there is one"""
+    db = get_db(readonly=True)
+    if catalog_exists(db):
+        get_index(db, catalog_version(db))
+
+
+def init_app(app):
+    holder = app.extensions["facet_index"] = IndexHolder()
+    stats.register(app, "facets", holder.stats)
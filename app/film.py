@@ -1,6 +1,10 @@
+import json
 import secrets
+import sys
+from base64 import urlsafe_b64decode, urlsafe_b64encode
 from datetime import datetime
-from sqlite3 import Cursor
+from sqlite3 import Connection, Cursor, Row
+from typing import Dict, List, NamedTuple, Optional
 
 from flask import Blueprint, request
 from flask.helpers import url_for
@@ -8,6 +12,7 @@ from flask.templating import render_template
 from flask.wrappers import Response
 from werkzeug.utils import redirect
 
+from app import cache, conditional
 from app.auth import get_sess_info
 
 from .database import get_db
@@ -19,7 +24,49 @@ class ArgumentValidationError(ValueError):
     ...
 
 
-def get_films(order: str = "feature", limit: int = 50) -> Cursor:
+def encode_token(position: list) -> str:
+    """Encodes a position in a list as an opaque, url-safe token"""
+    position = json.dumps(position)
+    return urlsafe_b64encode(position.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_token(token: str, types: tuple) -> list:
+    """
+    Decodes a token made by encode_token. Raises an ArgumentValidationError if the
+    token is malformed or its values don't have the given types.
+    """
+    try:
+        position = json.loads(urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+    except ValueError:
+        raise ArgumentValidationError()
+    if not isinstance(position, list) or len(position) != len(types):
+        raise ArgumentValidationError()
+    if not all(isinstance(value, type_) for value, type_ in zip(position, types)):
+        raise ArgumentValidationError()
+    return position
+
+
+def page_token(order: str, film_row) -> str:
+    """
+    Makes the opaque token for the page of films after film_row in the given order.
+    It holds the position of film_row in the order, with its film_id to break ties.
+    """
+    return encode_token([order, film_row[order], film_row["film_id"]])
+
+
+def parse_page_token(order: str, token: str) -> list:
+    """
+    Gets the position in the order from a token made by page_token. Raises an
+    ArgumentValidationError if the token is malformed or was made for a different
+    order.
+    """
+    token_order, value, film_id = decode_token(token, (str, (int, float, str), str))
+    if token_order != order:
+        raise ArgumentValidationError()
+    return [value, film_id]
+
+
+def get_films(order: str = "feature", limit: int = 50, after: str = None) -> Cursor:
     """
     Gets a list of films from the db.
 
@@ -27,22 +74,240 @@ def get_films(order: str = "feature", limit: int = 50) -> Cursor:
             limit:int - The number of entries to fetch
             order:str - The order by which to sort the results. Must be 'feature',
                     'title', or 'release_year'.
+            after:str - A token from page_token. If given, the films after the
+                    one the token was made from are fetched.
 
-            If the limit is not an integer or the order is invalid, an
-            ArgumentValidationError will be raised to curtail any possible sql
-            injection.
+            If the limit is not an integer, the order is invalid, or the token
+            is malformed, an ArgumentValidationError will be raised to curtail
+            any possible sql injection.
+
+    Films with the same value in the order are sorted by film_id, so every film
+    has a unique position to continue from. Continuing from a position is an
+    index seek, so every page costs the same however deep it is.
     """
 
     # Validate
     if order not in {"feature", "title", "release_year"} or not isinstance(limit, int):
         raise ArgumentValidationError()
 
-    db = get_db()
+    db = get_db(readonly=True)
 
-    films = db.execute(f"select * from Film order by {order} limit ?", [limit])
+    if after is None:
+        return db.execute(
+            f"select * from Film order by {order}, film_id limit ?", [limit]
+        )
+    films = db.execute(
+        f"""
+        select * from Film
+        where ({order}, film_id) > (?, ?)
+        order by {order}, film_id
+        limit ?
+        """,
+        [*parse_page_token(order, after), limit],
+    )
     return films
 
 
+def get_films_by_id(film_ids: List[str]) -> List[Row]:
+    """
+    Gets the films with the given ids from the db, in the same order as the ids.
+    Ids that don't exist are left out.
+    """
+    db = get_db(readonly=True)
+    films = db.execute(
+        "select * from Film where film_id in (select value from json_each(?))",
+        [json.dumps(list(film_ids))],
+    )
+    films = {film["film_id"]: film for film in films}
+    return [films[film_id] for film_id in film_ids if film_id in films]
+
+
+class FilmDetail(NamedTuple):
+    """Everything shown on a film's page"""
+
+    film_row: Row
+    tags: List[str]
+    directors: List[str]
+    cast: List[str]
+    # The first page of comments and the token for the next one
+    comments: List[dict]
+    more_comments: Optional[str]
+
+
+# Comments are shown this many at a time, newest first
+COMMENT_PAGE_SIZE = 20
+
+
+class CommentPage(NamedTuple):
+    comments: List[dict]
+    # The token for the next page, or None if this is the last one
+    more: Optional[str]
+
+
+def comment_page(comments: List[dict]) -> CommentPage:
+    """
+    Makes a page from up to COMMENT_PAGE_SIZE + 1 comments. The extra one is only
+    used to tell whether there is a next page.
+    """
+    if len(comments) <= COMMENT_PAGE_SIZE:
+        return CommentPage(comments, None)
+    comments = comments[:COMMENT_PAGE_SIZE]
+    last = comments[-1]
+    return CommentPage(comments, encode_token([last["date_"], last["comment_id"]]))
+
+
+# The film's tags, people and comments are aggregated into json arrays so that the
+# whole page is a single statement. The ids are passed as one json array, so the sql
+# is the same whatever the number of ids and stays in the statement cache.
+FILM_DETAIL_SQL = f"""
+    select Film.*,
+        (
+            select json_group_array(genre_name) from Listed
+            where Listed.film_id = Film.film_id
+        ) as tags,
+        (
+            select json_group_array(person_name) from Directed
+            where Directed.film_id = Film.film_id
+        ) as directors,
+        (
+            select json_group_array(person_name) from Acted
+            where Acted.film_id = Film.film_id
+        ) as cast,
+        (
+            select json_group_array(json_object(
+                'comment_id', comment_id,
+                'user_id_', user_id_,
+                'username', username,
+                'film_id', film_id,
+                'title', title,
+                'date_', date_,
+                'body', body
+            ))
+            from (
+                select comment_id, user_id_, username, Comment.film_id, Film.title,
+                    date_, body
+                from Comment natural join User
+                where Comment.film_id = Film.film_id
+                order by date_ desc, comment_id desc
+                limit {COMMENT_PAGE_SIZE + 1}
+            )
+        ) as comments
+    from Film
+    where film_id in (select value from json_each(?))
+"""
+
+
+def get_film_details(film_ids: List[str]) -> Dict[str, FilmDetail]:
+    """
+    Gets the details of many films in one query.
+
+    Params:
+            film_ids:List[str] - The ids of the films to fetch
+
+    Returns a dict from film_id to FilmDetail. Ids that don't exist are left out.
+    """
+    db = get_db(readonly=True)
+    details = {}
+    for row in db.execute(FILM_DETAIL_SQL, [json.dumps(list(film_ids))]):
+        comments = comment_page(json.loads(row["comments"]))
+        details[row["film_id"]] = FilmDetail(
+            film_row=row,
+            tags=json.loads(row["tags"]),
+            directors=json.loads(row["directors"]),
+            cast=json.loads(row["cast"]),
+            comments=comments.comments,
+            more_comments=comments.more,
+        )
+    return details
+
+
+def get_film_detail(film_id: str):
+    """
+    Gets a film, its tags, directors, cast, and first page of comments in one
+    query. Returns a FilmDetail, or None if there is no such film.
+    """
+    return get_film_details([film_id]).get(film_id)
+
+
+def film_exists(db: Connection, film_id: str) -> bool:
+    return bool(db.execute("select 1 from Film where film_id=?", [film_id]).fetchone())
+
+
+def get_comments(column: str, key: str, before: str = None) -> CommentPage:
+    """
+    Gets a page of the comments on a film or by a user, newest first.
+
+    Params:
+            column:str - 'film_id' to get the comments on the film `key`, or
+                    'user_id_' to get the comments by the user `key`
+            before:str - The token of the page to get, from CommentPage.more. If
+                    it isn't given, the first page is fetched.
+
+    Like with get_films, the page continues from the position of the last comment
+    on the previous page, so every page costs the same.
+    """
+    if column not in {"film_id", "user_id_"}:
+        raise ArgumentValidationError()
+
+    position = []
+    keyset = ""
+    if before is not None:
+        position = decode_token(before, (str, str))
+        keyset = "and (date_, comment_id) < (?, ?)"
+
+    db = get_db(readonly=True)
+    comments = db.execute(
+        f"""
+        select comment_id, user_id_, username, Comment.film_id, title, date_, body
+        from Comment natural join User join Film on Film.film_id = Comment.film_id
+        where Comment.{column} = ? {keyset}
+        order by date_ desc, comment_id desc
+        limit ?
+        """,
+        [key, *position, COMMENT_PAGE_SIZE + 1],
+    )
+    return comment_page([dict(comment) for comment in comments])
+
+
+def more_comments_url(page: CommentPage, endpoint: str, **values) -> Optional[str]:
+    """The url of the page after this one from the endpoint, if there is one"""
+    return url_for(endpoint, before=page.more, **values) if page.more else None
+
+
+def comments_size(comments: List[dict]) -> int:
+    return sum(
+        sys.getsizeof(value) for comment in comments for value in comment.values()
+    )
+
+
+def cached_comments(
+    film_id: str, version: conditional.Version, detail: FilmDetail = None
+) -> CommentPage:
+    """
+    Gets the first page of comments on a film from the comment cache, or from
+    detail or the db if they aren't cached. Entries are stored with the version of
+    the comments, so writes made by other workers are picked up too.
+    """
+    comment_cache = cache.get_cache("film_comments")
+    entry = comment_cache.get(film_id)
+    if entry and entry[0] == version.version:
+        return entry[1]
+    generation = comment_cache.generation
+    if detail:
+        page = CommentPage(detail.comments, detail.more_comments)
+    else:
+        page = get_comments("film_id", film_id)
+    comment_cache.set(
+        film_id, (version.version, page), comments_size(page.comments), generation
+    )
+    return page
+
+
+def invalidate_comments(film_id: str):
+    """Drops the film's cached comments. Call this after changing them."""
+    cache.get_cache("film_comments").pop(film_id)
+
+
 @bp.route("/<film_id>", methods=["GET"])
 def film_page(film_id) -> str:
     """
@@ -56,58 +321,73 @@ def film_page(film_id) -> str:
         return Response("Bad film id", status=400)
 
     if request.method == "GET":
-        # Get the film
-        db = get_db()
-        film_row = db.execute(
-            f'select * from Film where film_id="{film_id}"'
-        ).fetchone()
-        if not film_row:
+        db = get_db(readonly=True)
+        # Check first, since the validators of a missing film would match those of
+        # any film without comments
+        if not film_exists(db, film_id):
             return Response(status=404)
-
-        # Tags
-        tags = db.execute(
-            f"select genre_name from Listed where " f'film_id="{film_id}"'
-        ).fetchall()
-        tags = [t["genre_name"] for t in tags]
-
-        # Directors
-        directors = db.execute(
-            f"select person_name from Directed where " f'film_id="{film_id}"'
-        ).fetchall()
-        directors = [d["person_name"] for d in directors]
-
-        # Cast
-        cast = db.execute(
-            f"select person_name from Acted where " f'film_id="{film_id}"'
-        ).fetchall()
-        cast = [c["person_name"] for c in cast]
-
-        # Comments
-        comments = db.execute(
-            """
-			select comment_id, user_id_, username, film_id, title, date_, body
-			from Comment natural join User natural join (
-				select film_id, title
-				from Film
-				where film_id=?
-			)
-			order by date_ desc;
-			""",
-            [film_id],
-        ).fetchall()
-
-        return render_template(
-            "films/film.html",
-            film_row=film_row,
-            tags=tags,
-            directors=directors,
-            cast=cast,
-            comments=comments,
+        catalog_version = conditional.catalog_version(db)
+        comments_version = conditional.film_comments_version(db, film_id)
+        validators = conditional.validators(catalog_version, comments_version)
+        response = conditional.not_modified(validators)
+        if response:
+            return response
+
+        # The catalog part of the page only changes when the catalog does, so it is
+        # rendered once per catalog version. The comments are cached separately
+        # and invalidated whenever they change.
+        page_cache = cache.get_cache("film_pages")
+        catalog_html = page_cache.get((film_id, catalog_version.version))
+        detail = None
+        if catalog_html is None:
+            detail = get_film_detail(film_id)
+            if not detail:
+                return Response(status=404)
+            catalog_html = render_template(
+                "films/film_catalog.html",
+                film_row=detail.film_row,
+                tags=detail.tags,
+                directors=detail.directors,
+                cast=detail.cast,
+            )
+            page_cache.set((film_id, catalog_version.version), catalog_html)
+
+        comments = cached_comments(film_id, comments_version, detail)
+        return conditional.respond(
+            render_template(
+                "films/film.html",
+                film_id=film_id,
+                catalog_html=catalog_html,
+                comments=comments.comments,
+                comment_count=comments_version.comments,
+                more_comments=more_comments_url(
+                    comments, "film.film_comments", film_id=film_id
+                ),
+            ),
+            validators,
         )
     else:
         return Response(status=300)
 
 
+@bp.route("/<film_id>/comments", methods=["GET"])
+def film_comments(film_id: str):
+    """Renders just the page of the film's comments given by `before`"""
+    before = request.args.get("before")
+    try:
+        comments = get_comments("film_id", film_id, before)
+    except ArgumentValidationError:
+        return Response("Invalid request", status=400)
+    return render_template(
+        "films/comment_list.html",
+        show_film=False,
+        comments=comments.comments,
+        more_comments=more_comments_url(
+            comments, "film.film_comments", film_id=film_id
+        ),
+    )
+
+
 @bp.route("/<film_id>/comment", methods=["POST"])
 def submit_comment(film_id: str):
     # Get the comment
@@ -134,6 +414,7 @@ def submit_comment(film_id: str):
         [comment_id, sess_info["user_id_"], film_id, str(datetime.now()), body],
     )
     db.commit()
+    invalidate_comments(film_id)
 
     return redirect(f'{url_for("film.film_page", film_id=film_id)}#{comment_id}')
 
@@ -174,6 +455,7 @@ def edit_comment(film_id, comment_id):
         [body, film_id, comment_id, sess_info["user_id_"]],
     )
     db.commit()
+    invalidate_comments(film_id)
     cursor.close()
 
     return redirect(f'{url_for("film.film_page", film_id=film_id)}#{comment_id}')
@@ -214,6 +496,22 @@ def delete_comment(film_id, comment_id):
         [film_id, comment_id, sess_info["user_id_"]],
     )
     db.commit()
+    invalidate_comments(film_id)
     cursor.close()
 
     return redirect(url_for("film.film_page", film_id=film_id))
+
+
+def init_app(app):
+    cache.add_cache(
+        app,
+        "film_pages",
+        app.config.get("FILM_PAGE_CACHE_ENTRIES", 4096),
+        app.config.get("FILM_PAGE_CACHE_BYTES", 64 * 2**20),
+    )
+    cache.add_cache(
+        app,
+        "film_comments",
+        app.config.get("FILM_COMMENT_CACHE_ENTRIES", 4096),
+        app.config.get("FILM_COMMENT_CACHE_BYTES", 16 * 2**20),
+    )
@@ -2,17 +2,99 @@ from flask import Blueprint, request
 from flask.templating import render_template
 from flask.wrappers import Response
 
-from app.film import ArgumentValidationError, get_films
+from app import conditional, facets
+from app.database import get_db
+from app.film import (
+    ArgumentValidationError,
+    get_films,
+    get_films_by_id,
+    page_token,
+    parse_page_token,
+)
 
 bp = Blueprint("home", __name__)
 
+PAGE_SIZE = 50
+
+FACET_LABELS = {
+    "type": "Type",
+    "genre": "Genre",
+    "country": "Country",
+    "rating": "Rating",
+}
+
+
+def parse_year(name: str):
+    year = request.args.get(name, "")
+    if not year:
+        return None
+    try:
+        return int(year)
+    except ValueError:
+        raise ArgumentValidationError()
+
+
+def parse_filters() -> facets.Filters:
+    """Gets the filters from the query string"""
+    values = {}
+    for facet in facets.FACETS:
+        picked = request.args.getlist(facet)
+        if picked:
+            values[facet] = picked
+    return facets.Filters(values, parse_year("year_from"), parse_year("year_to"))
+
 
 @bp.route("/")
 def home() -> str:
     # Get the sorting method and default to "feature" if none is specified
     sort = request.args.get("sort", "feature")
+    db = get_db(readonly=True)
+    catalog_version = conditional.catalog_version(db)
+    validators = conditional.validators(catalog_version)
+    response = conditional.not_modified(validators)
+    if response:
+        return response
+
+    # `after` is the token for the page to show, which is the first page if it
+    # isn't given. One extra film is fetched to tell whether there's a next page.
+    after = request.args.get("after")
     try:
-        films = get_films(order=sort)
+        filters = parse_filters()
+        index = facets.get_index(db, catalog_version.version)
+        if not filters:
+            films = get_films(order=sort, limit=PAGE_SIZE + 1, after=after).fetchall()
+        elif sort in facets.ORDERS:
+            position = parse_page_token(sort, after) if after else None
+            films = get_films_by_id(index.page(sort, filters, position, PAGE_SIZE + 1))
+        else:
+            raise ArgumentValidationError()
     except ArgumentValidationError:
         return Response("Invalid request", status=400)
-    return render_template("home.html", films=films, sort=sort)
+    next_page = None
+    if len(films) > PAGE_SIZE:
+        films = films[:PAGE_SIZE]
+        next_page = page_token(sort, films[-1])
+
+    # The filters, to keep when going to another page or changing the order
+    filter_args = dict(filters.values)
+    if filters.year_from is not None:
+        filter_args["year_from"] = filters.year_from
+    if filters.year_to is not None:
+        filter_args["year_to"] = filters.year_to
+
+    return conditional.respond(
+        render_template(
+            "home.html",
+            films=films,
+            sort=sort,
+            first_page=after is None,
+            next_page=next_page,
+            filters=filters,
+            filter_args=filter_args,
+            facet_labels=FACET_LABELS,
+            facet_counts=index.facet_counts(filters),
+            film_count=index.count(filters),
+            year_range=index.year_range,
+        ),
+        validators,
+    )
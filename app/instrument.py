@@ -0,0 +1,188 @@
+"""
+Records how many queries each request makes and how long they take.
+
+This is turned on with the QUERY_STATS config key. Every statement executed
+through get_db while handling a request is timed, including the time spent
+fetching its rows. When the request finishes:
+    * the totals are added to per-route statistics, which are served by
+      /_stats/ when EXPOSE_STATS is set
+    * statements slower than SLOW_QUERY_MS are logged along with their query plan.
+      Only the types of their parameters are logged, since they can be session ids
+      or password hashes.
+    * a Server-Timing header is added to the response if SERVER_TIMING is set
+"""
+
+import sqlite3
+import threading
+from time import perf_counter
+
+from flask import current_app, g, has_request_context, request
+
+from app import stats
+
+
+class Statement:
+    """A statement and the time spent executing it and fetching its rows"""
+
+    __slots__ = ("sql", "params", "seconds", "db")
+
+    def __init__(self, sql: str, params, db: sqlite3.Connection):
+        self.sql = sql
+        self.params = params
+        self.seconds = 0.0
+        self.db = db
+
+
+class QueryStats:
+    """The statements executed while handling one request"""
+
+    def __init__(self):
+        self.statements = []
+
+    @property
+    def count(self) -> int:
+        return len(self.statements)
+
+    @property
+    def seconds(self) -> float:
+        return sum(statement.seconds for statement in self.statements)
+
+    @property
+    def slowest(self) -> Statement:
+        return max(self.statements, key=lambda statement: statement.seconds)
+
+
+def current_stats():
+    """Returns the stats for the current request, or None if they aren't recorded"""
+    if not has_request_context() or not current_app.config.get("QUERY_STATS"):
+        return None
+    if "query_stats" not in g:
+        g.query_stats = QueryStats()
+    return g.query_stats
+
+
+class TimedCursor(sqlite3.Cursor):
+    """A cursor that adds the time spent on its statement to the request's stats"""
+
+    statement = None
+
+    def timed(self, method, *args):
+        start = perf_counter()
+        try:
+            return method(*args)
+        finally:
+            if self.statement is not None:
+                self.statement.seconds += perf_counter() - start
+
+    def execute(self, sql, parameters=()):
+        self.statement = Statement(sql, parameters, self.connection)
+        query_stats = current_stats()
+        if query_stats is not None:
+            query_stats.statements.append(self.statement)
+        return self.timed(super().execute, sql, parameters)
+
+    def fetchone(self):
+        return self.timed(super().fetchone)
+
+    def fetchmany(self, size=None):
+        if size is None:
+            return self.timed(super().fetchmany)
+        return self.timed(super().fetchmany, size)
+
+    def fetchall(self):
+        return self.timed(super().fetchall)
+
+    def __next__(self):
+        return self.timed(super().__next__)
+
+
+class RouteStats:
+    """Query totals for every route, shared by all of a worker's threads"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.routes = {}
+
+    def add(self, endpoint: str, query_stats: QueryStats):
+        slowest = query_stats.slowest
+        with self.lock:
+            route = self.routes.setdefault(
+                endpoint,
+                {
+                    "requests": 0,
+                    "queries": 0,
+                    "seconds": 0.0,
+                    "slowest_seconds": 0.0,
+                    "slowest_sql": None,
+                },
+            )
+            route["requests"] += 1
+            route["queries"] += query_stats.count
+            route["seconds"] += query_stats.seconds
+            if slowest.seconds > route["slowest_seconds"]:
+                route["slowest_seconds"] = slowest.seconds
+                route["slowest_sql"] = " ".join(slowest.sql.split())
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {endpoint: dict(route) for endpoint, route in self.routes.items()}
+
+
+def query_plan(statement: Statement) -> list:
+    # Go through sqlite3.Connection directly so that this isn't recorded too
+    plan = sqlite3.Connection.execute(
+        statement.db, f"explain query plan {statement.sql}", statement.params
+    ).fetchall()
+    return [step[3] for step in plan]
+
+
+def describe_params(params) -> str:
+    """The types of a statement's parameters, without their values"""
+    if isinstance(params, dict):
+        types = [f"{name}={type(value).__name__}" for name, value in params.items()]
+    else:
+        types = [type(value).__name__ for value in params]
+    return f"({', '.join(types)})"
+
+
+def log_slow_queries(query_stats: QueryStats):
+    threshold = current_app.config.get("SLOW_QUERY_MS", 100) / 1000
+    for statement in query_stats.statements:
+        if statement.seconds < threshold:
+            continue
+        try:
+            plan = query_plan(statement)
+        except sqlite3.Error as e:
+            plan = [f"could not explain: {e}"]
+        current_app.logger.warning(
+            "Slow query on %s (%.1f ms): %s %s\n  plan: %s",
+            request.endpoint,
+            statement.seconds * 1000,
+            " ".join(statement.sql.split()),
+            describe_params(statement.params),
+            "; ".join(plan),
+        )
+
+
+def finish_request(response):
+    query_stats = g.pop("query_stats", None)
+    if not query_stats or not query_stats.count:
+        return response
+
+    current_app.extensions["route_stats"].add(
+        request.endpoint or "<unknown>", query_stats
+    )
+    log_slow_queries(query_stats)
+    if current_app.config.get("SERVER_TIMING"):
+        response.headers.add(
+            "Server-Timing",
+            f'db;dur={query_stats.seconds * 1000:.2f};desc="{query_stats.count} '
+            'queries"',
+        )
+    return response
+
+
+def init_app(app):
+    app.extensions["route_stats"] = RouteStats()
+    app.after_request(finish_request)
+    stats.register(app, "queries", app.extensions["route_stats"].snapshot)
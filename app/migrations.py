@@ -0,0 +1,292 @@
+"""
+Versioned changes to the schema of existing databases.
+
+query-create-database.sql and query-create-userdata.sql only create the original
+tables. Everything added since then is a migration here, so that databases that
+were already populated are brought up to date in place, without being rebuilt.
+The catalog and the user tables can live in different files, so each has its own
+list of migrations and its own version.
+
+Migrations are only ever appended to. Each one is a script where {schema} is
+replaced with the name of the attached database holding its tables.
+"""
+
+import re
+import sqlite3
+
+CATALOG_MIGRATIONS = [
+    # 1: Indexes for looking people up on the person page and for ordering the
+    # home page
+    """
+    create index if not exists {schema}.Directed_person
+        on Directed(person_name, film_id);
+    create index if not exists {schema}.Acted_person on Acted(person_name, film_id);
+    create index if not exists {schema}.Film_feature on Film(feature);
+    create index if not exists {schema}.Film_title on Film(title);
+    create index if not exists {schema}.Film_release_year on Film(release_year);
+    """,
+    # 2: Replace the home page's order indexes with ones that end in film_id, the
+    # tiebreaker for paging through the home page
+    """
+    drop index if exists {schema}.Film_feature;
+    drop index if exists {schema}.Film_title;
+    drop index if exists {schema}.Film_release_year;
+    create index {schema}.Film_feature on Film(feature, film_id);
+    create index {schema}.Film_title on Film(title, film_id);
+    create index {schema}.Film_release_year on Film(release_year, film_id);
+    """,
+    # 3: Full-text search. Catalogs imported since then already have FilmSearch,
+    # so only the films missing from it are added.
+    """
+    create virtual table if not exists {schema}.FilmSearch using fts5(
+        film_id unindexed, title, film_desc, people,
+        tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3'
+    );
+    insert into {schema}.FilmSearch(rowid, film_id, title, film_desc, people)
+    select Film.rowid, film_id, title, film_desc, (
+        select group_concat(person_name, ', ') from (
+            select person_name from {schema}.Directed
+            where Directed.film_id = Film.film_id
+            union all
+            select person_name from {schema}.Acted where Acted.film_id = Film.film_id
+        )
+    )
+    from {schema}.Film
+    where Film.rowid not in (select rowid from {schema}.FilmSearch);
+    """,
+]
+
+USERDATA_MIGRATIONS = [
+    # 1: Indexes for listing comments on film and user pages, newest first, and for
+    # looking users up by name when they log in
+    """
+    create index if not exists {schema}.Comment_film on Comment(film_id, date_);
+    create index if not exists {schema}.Comment_user on Comment(user_id_, date_);
+    create index if not exists {schema}.User_username
+        on User(username collate nocase);
+    """,
+    # 2: Versions of each film's and each user's comments, for conditional GETs.
+    # They are bumped by triggers so that every write to Comment is counted,
+    # whichever worker or process makes it.
+    """
+    create table if not exists {schema}.FilmCommentVersion (
+        film_id varchar(16) not null,
+        version int not null,
+        modified varchar(32) not null,
+
+        primary key (film_id)
+    );
+    create table if not exists {schema}.UserCommentVersion (
+        user_id_ varchar(96) not null,
+        version int not null,
+        modified varchar(32) not null,
+
+        primary key (user_id_)
+    );
+    insert or ignore into {schema}.FilmCommentVersion
+        select film_id, 1, strftime('%Y-%m-%dT%H:%M:%S+00:00')
+        from {schema}.Comment group by film_id;
+    insert or ignore into {schema}.UserCommentVersion
+        select user_id_, 1, strftime('%Y-%m-%dT%H:%M:%S+00:00')
+        from {schema}.Comment group by user_id_;
+
+    create trigger if not exists {schema}.Comment_insert_version
+    after insert on Comment begin
+        insert into FilmCommentVersion
+            values(new.film_id, 1, strftime('%Y-%m-%dT%H:%M:%S+00:00'))
+            on conflict(film_id) do update
+            set version = version + 1, modified = excluded.modified;
+        insert into UserCommentVersion
+            values(new.user_id_, 1, strftime('%Y-%m-%dT%H:%M:%S+00:00'))
+            on conflict(user_id_) do update
+            set version = version + 1, modified = excluded.modified;
+    end;
+    create trigger if not exists {schema}.Comment_update_version
+    after update on Comment begin
+        insert into FilmCommentVersion
+            values(new.film_id, 1, strftime('%Y-%m-%dT%H:%M:%S+00:00'))
+            on conflict(film_id) do update
+            set version = version + 1, modified = excluded.modified;
+        insert into UserCommentVersion
+            values(new.user_id_, 1, strftime('%Y-%m-%dT%H:%M:%S+00:00'))
+            on conflict(user_id_) do update
+            set version = version + 1, modified = excluded.modified;
+    end;
+    create trigger if not exists {schema}.Comment_delete_version
+    after delete on Comment begin
+        insert into FilmCommentVersion
+            values(old.film_id, 1, strftime('%Y-%m-%dT%H:%M:%S+00:00'))
+            on conflict(film_id) do update
+            set version = version + 1, modified = excluded.modified;
+        insert into UserCommentVersion
+            values(old.user_id_, 1, strftime('%Y-%m-%dT%H:%M:%S+00:00'))
+            on conflict(user_id_) do update
+            set version = version + 1, modified = excluded.modified;
+    end;
+    """,
+    # 3: Page through comments newest first, with comment_id to break ties, and
+    # keep a count of each film's and each user's comments next to their versions
+    """
+    drop index if exists {schema}.Comment_film;
+    drop index if exists {schema}.Comment_user;
+    create index {schema}.Comment_film on Comment(film_id, date_, comment_id);
+    create index {schema}.Comment_user on Comment(user_id_, date_, comment_id);
+
+    alter table {schema}.FilmCommentVersion
+        add column comments int not null default 0;
+    alter table {schema}.UserCommentVersion
+        add column comments int not null default 0;
+    update {schema}.FilmCommentVersion set comments = (
+        select count(*) from {schema}.Comment
+        where Comment.film_id = FilmCommentVersion.film_id
+    );
+    update {schema}.UserCommentVersion set comments = (
+        select count(*) from {schema}.Comment
+        where Comment.user_id_ = UserCommentVersion.user_id_
+    );
+
+    drop trigger {schema}.Comment_insert_version;
+    drop trigger {schema}.Comment_update_version;
+    drop trigger {schema}.Comment_delete_version;
+    create trigger {schema}.Comment_insert_version
+    after insert on Comment begin
+        insert into FilmCommentVersion(film_id, version, modified, comments)
+            values(new.film_id, 1, strftime('%Y-%m-%dT%H:%M:%S+00:00'), 1)
+            on conflict(film_id) do update
+            set version = version + 1, modified = excluded.modified,
+                comments = comments + 1;
+        insert into UserCommentVersion(user_id_, version, modified, comments)
+            values(new.user_id_, 1, strftime('%Y-%m-%dT%H:%M:%S+00:00'), 1)
+            on conflict(user_id_) do update
+            set version = version + 1, modified = excluded.modified,
+                comments = comments + 1;
+    end;
+    create trigger {schema}.Comment_update_version
+    after update on Comment begin
+        insert into FilmCommentVersion(film_id, version, modified, comments)
+            values(new.film_id, 1, strftime('%Y-%m-%dT%H:%M:%S+00:00'), 0)
+            on conflict(film_id) do update
+            set version = version + 1, modified = excluded.modified;
+        insert into UserCommentVersion(user_id_, version, modified, comments)
+            values(new.user_id_, 1, strftime('%Y-%m-%dT%H:%M:%S+00:00'), 0)
+            on conflict(user_id_) do update
+            set version = version + 1, modified = excluded.modified;
+    end;
+    create trigger {schema}.Comment_delete_version
+    after delete on Comment begin
+        insert into FilmCommentVersion(film_id, version, modified, comments)
+            values(old.film_id, 1, strftime('%Y-%m-%dT%H:%M:%S+00:00'), 0)
+            on conflict(film_id) do update
+            set version = version + 1, modified = excluded.modified,
+                comments = comments - 1;
+        insert into UserCommentVersion(user_id_, version, modified, comments)
+            values(old.user_id_, 1, strftime('%Y-%m-%dT%H:%M:%S+00:00'), 0)
+            on conflict(user_id_) do update
+            set version = version + 1, modified = excluded.modified,
+                comments = comments - 1;
+    end;
+    """,
+    # 4: Authentication challenges shared by all of the app's processes, for the
+    # sqlite auth state backend
+    """
+    create table {schema}.AuthChallenge (
+        challenge varchar(96) not null,
+        sess_id varchar(96) not null,
+        exp_time real not null,
+
+        primary key (challenge)
+    );
+    create index {schema}.AuthChallenge_exp_time on AuthChallenge(exp_time);
+    """,
+    # 5: When each session was issued and last seen, in seconds since the epoch,
+    # so that abandoned sessions expire. Existing sessions count as new.
+    """
+    alter table {schema}.Sess add column issued real;
+    alter table {schema}.Sess add column last_seen real;
+    update {schema}.Sess set issued = (julianday('now') - 2440587.5) * 86400.0;
+    update {schema}.Sess set last_seen = issued;
+    create index {schema}.Sess_issued on Sess(issued);
+    create index {schema}.Sess_last_seen on Sess(last_seen);
+    """,
+    # 6: Count each session's outstanding challenges, to limit them
+    """
+    create index {schema}.AuthChallenge_sess_id on AuthChallenge(sess_id, exp_time);
+    """,
+    # 7: A count of the sessions ever deleted, whichever worker or process deleted
+    # them, so that workers can tell when the sessions they cached may be gone
+    """
+    create table {schema}.SessVersion (
+        id integer not null,
+        version int not null,
+
+        primary key (id)
+    );
+    insert into {schema}.SessVersion values(1, 0);
+    create trigger {schema}.Sess_delete_version after delete on Sess begin
+        update SessVersion set version = version + 1 where id = 1;
+    end;
+    """,
+]
+
+MIGRATIONS = {
+    "catalog": CATALOG_MIGRATIONS,
+    "userdata": USERDATA_MIGRATIONS,
+}
+
+
+def schema_version(db: sqlite3.Connection, component: str, schema="main") -> int:
+    """Returns how many of the component's migrations have been applied"""
+    db.execute(f"""
+        create table if not exists {schema}.SchemaVersion (
+            component varchar(16) not null,
+            version int not null,
+
+            primary key (component)
+        )
+        """)
+    row = db.execute(
+        f"select version from {schema}.SchemaVersion where component=?", [component]
+    ).fetchone()
+    return row[0] if row else 0
+
+
+def migrate(db: sqlite3.Connection, component: str, schema="main") -> int:
+    """
+    Applies any of the component's migrations that haven't been applied yet. Each
+    migration is applied in its own transaction.
+
+    Args:
+        db (sqlite3.Connection): The connection to migrate through
+        component (str): 'catalog' or 'userdata'
+        schema (str): The name of the attached database holding the component
+
+    Returns:
+        int: The version the component is at now
+    """
+    migrations = MIGRATIONS[component]
+    version = schema_version(db, component, schema)
+    db.commit()
+    for version, script in enumerate(migrations[version:], start=version + 1):
+        try:
+            db.executescript(f"""
+                begin;
+                {script.format(schema=schema)}
+                insert or replace into {schema}.SchemaVersion
+                    values('{component}', {version});
+                commit;
+                """)
+        except sqlite3.Error:
+            if db.in_transaction:
+                db.rollback()
+            raise
+    return version
+
+
+def full_table_scans(db: sqlite3.Connection, sql: str, params=()) -> list:
+    """
+    Runs EXPLAIN QUERY PLAN on the query and returns the steps that scan a whole
+    table without an index. Scanning an index in order, like for an order by with a
+    limit, is not counted.
+    """
+    plan = db.execute(f"explain query plan {sql}", params).fetchall()
+    return [step[3] for step in plan if re.fullmatch(r"SCAN \w+", step[3])]
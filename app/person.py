@@ -1,19 +1,43 @@
+import sqlite3
 from urllib.parse import unquote_plus
 
 from flask import Blueprint, escape
 from flask.templating import render_template
 from flask.wrappers import Response
 
+from . import conditional
 from .database import get_db
 
 bp = Blueprint("person", __name__, url_prefix="/person")
 
 
+def person_exists(db: sqlite3.Connection, name: str) -> bool:
+    """Whether the person directed or acted in any film"""
+    return bool(
+        db.execute(
+            """
+            select exists (select 1 from Directed where person_name = :name)
+                or exists (select 1 from Acted where person_name = :name)
+            """,
+            {"name": name},
+        ).fetchone()[0]
+    )
+
+
 @bp.route("/<name>", methods=["GET"])
 def person_page(name):
-    db = get_db()
+    db = get_db(readonly=True)
     # Convert the name from a url-safe encoding to its actual value
     name = unquote_plus(name)
+    # Checked first, since the validators only depend on the catalog
+    if not person_exists(db, name):
+        # If they did nothing, then how did they make it into the database?
+        return Response("We don't know who this person is", status=404)
+
+    validators = conditional.validators(conditional.catalog_version(db))
+    response = conditional.not_modified(validators)
+    if response:
+        return response
 
     # Get everything they directed
     directed = db.execute(
@@ -26,9 +50,11 @@ def person_page(name):
     ).fetchall()
 
     if not directed and not acted:
-        # If they did nothing, then how did they make it into the database?
         return Response("We don't know who this person is", status=404)
     else:
-        return render_template(
-            "films/person.html", name=escape(name), directed=directed, acted=acted
+        return conditional.respond(
+            render_template(
+                "films/person.html", name=escape(name), directed=directed, acted=acted
+            ),
+            validators,
         )
@@ -0,0 +1,220 @@
+"""
+Full-text search over the titles, descriptions and credits of the films, backed by
+the FilmSearch FTS5 table that populate_db keeps in sync with the catalog.
+"""
+
+import json
+import re
+from typing import List, NamedTuple, Optional
+from urllib.parse import quote_plus
+
+from flask import Blueprint, current_app, jsonify, render_template, request, url_for
+from flask.wrappers import Response
+from markupsafe import Markup, escape
+
+from app import conditional, typeahead
+from app.database import get_db
+from app.film import ArgumentValidationError
+
+bp = Blueprint("search", __name__, url_prefix="/search")
+
+PAGE_SIZE = 50
+MAX_LIMIT = 100
+SUGGESTIONS = 8
+
+# Words in the query, with an optional * to search for them as a prefix
+TERM = re.compile(r"(\w+)(\*?)")
+# The last term of a query is searched as a prefix too, as long as it is at least
+# this long. Shorter prefixes aren't in the prefix indexes and match too much.
+MIN_PREFIX = 2
+
+# bm25 weights for the film_id, title, film_desc and people columns
+WEIGHTS = ", ".join(map(str, (0, 10, 1, 4)))
+# Marks the matched words in snippets. They are replaced with <mark> tags after the
+# rest of the snippet is escaped.
+MARK_START = "\x02"
+MARK_END = "\x03"
+
+# Every match is ranked. Ordering by FTS5's rank column with a limit lets it keep
+# only the best `limit` matches as it goes instead of sorting all of them.
+RANK_SQL = f"""
+    select rowid from FilmSearch
+    where FilmSearch match :query and rank match 'bm25({WEIGHTS})'
+    order by rank limit :limit
+"""
+# Snippets are made in a separate query for just the films on the page, since
+# making them for every match costs more than ranking. Only the range of rowids
+# between the first and last of them is searched again. Looking them up one by one
+# instead would redo the work of expanding prefixes every time.
+RESULTS_SQL = """
+    select Film.*, FilmSearch.rowid as search_rowid,
+        highlight(FilmSearch, 1, :start, :end) as title_marked,
+        snippet(FilmSearch, 2, :start, :end, '…', 24) as desc_snippet,
+        snippet(FilmSearch, 3, :start, :end, '…', 12) as people_snippet
+    from FilmSearch join Film using (film_id)
+    where FilmSearch match :query
+        and FilmSearch.rowid between :first and :last
+        and +FilmSearch.rowid in (select value from json_each(:rowids))
+"""
+
+
+class SearchResult(NamedTuple):
+    film_id: str
+    title: Markup
+    release_year: int
+    film_type: str
+    rating: str
+    # Parts of the description and credits with the matched words marked. They are
+    # empty if nothing in them matched.
+    desc_snippet: Markup
+    people_snippet: Markup
+
+
+def fts_query(text: str) -> Optional[str]:
+    """
+    Turns what was typed in the search box into an FTS5 query that matches films
+    with all of the words. Words ending in * and the last word are matched as
+    prefixes. Returns None if there are no words to search for.
+    """
+    terms = TERM.findall(text)
+    if not terms:
+        return None
+    query = []
+    for i, (word, star) in enumerate(terms):
+        last = i == len(terms) - 1
+        prefix = star or (last and len(word) >= MIN_PREFIX)
+        query.append(f'"{word}"' + ("*" if prefix else ""))
+    return " ".join(query)
+
+
+def mark(snippet: Optional[str]) -> Markup:
+    """Escapes a snippet and replaces the markers around matched words with tags"""
+    html = str(escape(snippet or ""))
+    return Markup(html.replace(MARK_START, "<mark>").replace(MARK_END, "</mark>"))
+
+
+def search_films(text: str, limit: int = PAGE_SIZE) -> List[SearchResult]:
+    """Gets up to `limit` films matching the search, best matches first"""
+    query = fts_query(text)
+    if query is None:
+        return []
+    db = get_db(readonly=True)
+    rowids = [row[0] for row in db.execute(RANK_SQL, {"query": query, "limit": limit})]
+    if not rowids:
+        return []
+    rows = db.execute(
+        RESULTS_SQL,
+        {
+            "query": query,
+            "first": min(rowids),
+            "last": max(rowids),
+            "rowids": json.dumps(rowids),
+            "start": MARK_START,
+            "end": MARK_END,
+        },
+    ).fetchall()
+    rank = {rowid: i for i, rowid in enumerate(rowids)}
+    rows.sort(key=lambda row: rank[row["search_rowid"]])
+    results = []
+    for row in rows:
+        people = mark(row["people_snippet"])
+        results.append(
+            SearchResult(
+                row["film_id"],
+                mark(row["title_marked"]),
+                row["release_year"],
+                row["film_type"],
+                row["rating"],
+                mark(row["desc_snippet"]),
+                # Only show the credits when a name matched
+                people if "<mark>" in people else Markup(""),
+            )
+        )
+    return results
+
+
+def parse_limit(default: int, maximum: int) -> int:
+    try:
+        limit = int(request.args.get("limit", default))
+    except ValueError:
+        raise ArgumentValidationError()
+    if not 0 < limit <= maximum:
+        raise ArgumentValidationError()
+    return limit
+
+
+@bp.route("/", methods=["GET"])
+def search():
+    text = request.args.get("q", "")
+    db = get_db(readonly=True)
+    validators = conditional.validators(conditional.catalog_version(db))
+    response = conditional.not_modified(validators)
+    if response:
+        return response
+
+    return conditional.respond(
+        render_template("search.html", query=text, results=search_films(text)),
+        validators,
+    )
+
+
+@bp.route("/json", methods=["GET"])
+def search_json():
+    """
+    The search results as JSON. The title and snippets are HTML, with the matched
+    words in <mark> tags.
+    """
+    text = request.args.get("q", "")
+    try:
+        limit = parse_limit(PAGE_SIZE, MAX_LIMIT)
+    except ArgumentValidationError:
+        return Response("Invalid request", status=400)
+    if fts_query(text) is None:
+        return Response("Invalid request", status=400)
+
+    db = get_db(readonly=True)
+    validators = conditional.validators(conditional.catalog_version(db))
+    response = conditional.not_modified(validators)
+    if response:
+        return response
+
+    results = [result._asdict() for result in search_films(text, limit)]
+    return conditional.respond(jsonify(query=text, results=results), validators)
+
+
+@bp.route("/suggest", methods=["GET"])
+def suggest():
+    """
+    The people and titles with a word starting with what has been typed, with the
+    most credited first. These come from the worker's typeahead index, without
+    going to the database.
+    """
+    text = request.args.get("q", "")
+    try:
+        limit = parse_limit(SUGGESTIONS, typeahead.MAX_LIMIT)
+    except ArgumentValidationError:
+        return Response("Invalid request", status=400)
+
+    index = typeahead.get_typeahead()
+    people = [
+        {
+            "name": person.text,
+            "credits": person.credits,
+            # Encoded the same way as the links to person pages in the templates
+            "url": url_for("person.person_page", name=quote_plus(person.text)),
+        }
+        for person in index.people.top(text, limit)
+    ]
+    titles = [
+        {
+            "film_id": title.film_id,
+            "title": title.text,
+            "credits": title.credits,
+            "url": url_for("film.film_page", film_id=title.film_id),
+        }
+        for title in index.titles.top(text, limit)
+    ]
+    response = jsonify(query=text, people=people, titles=titles)
+    response.cache_control.public = True
+    response.cache_control.max_age = current_app.config.get("TYPEAHEAD_MAX_AGE", 60)
+    return response
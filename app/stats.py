@@ -0,0 +1,25 @@
+"""
+Serves the app's internal statistics, like query timings and cache hit rates, as
+JSON. Modules register a function returning their statistics with `register`.
+/_stats/ only responds when EXPOSE_STATS is set, since it reveals which queries
+the app makes.
+"""
+
+from flask import Blueprint, current_app, jsonify
+from flask.wrappers import Response
+
+bp = Blueprint("stats", __name__, url_prefix="/_stats")
+
+
+def register(app, name: str, provider) -> None:
+    """Serves the return value of provider() under `name` on /_stats/"""
+    app.extensions.setdefault("stats_providers", {})[name] = provider
+
+
+@bp.route("/", methods=["GET"])
+def stats_page():
+    if not current_app.config.get("EXPOSE_STATS"):
+        return Response(status=404)
+
+    providers = current_app.extensions.get("stats_providers", {})
+    return jsonify({name: provider() for name, provider in providers.items()})
@@ -0,0 +1,222 @@
+"""
+In-memory prefix indexes for suggesting people and titles as a search is typed.
+
+Each worker builds the indexes from the catalog when it starts, so answering a
+keystroke never touches the database. The catalog version is checked again at most
+every TYPEAHEAD_RECHECK_SECONDS, and the indexes are rebuilt when it has changed.
+
+Names and titles are matched from the start of any of their words, ignoring case,
+accents and punctuation, so "hanks" and "tom h" both find "Tom Hanks". Entries are
+numbered best first, by their number of credits, so the top matches for a prefix
+are the smallest entry numbers among the keys starting with it. Those are
+precomputed for every prefix that more than MAX_SCAN keys start with, so no lookup
+goes through more than MAX_SCAN keys.
+"""
+
+import heapq
+import re
+import sqlite3
+import threading
+import unicodedata
+from array import array
+from bisect import bisect_left
+from itertools import groupby
+from time import monotonic, perf_counter
+from typing import List, NamedTuple
+
+from flask import current_app
+
+from app import stats
+from app.database import catalog_exists, catalog_version, get_db
+
+MAX_LIMIT = 20
+MAX_SCAN = 256
+
+NON_WORD = re.compile(r"[\W_]+")
+
+
+def normalize(text: str) -> str:
+    """Lowercases the text and strips accents and punctuation from it"""
+    decomposed = unicodedata.normalize("NFKD", text.casefold())
+    stripped = "".join(c for c in decomposed if not unicodedata.combining(c))
+    return NON_WORD.sub(" ", stripped).strip()
+
+
+class Entry(NamedTuple):
+    # The person's name or the film's title, as shown
+    text: str
+    credits: int
+    # The film the title is for, or None for people
+    film_id: str = None
+
+
+class PrefixIndex:
+    """
+    A sorted array of keys, one for every word of every entry, each key being the
+    entry's normalized text from that word on. Keys are stored as the entry number
+    and the offset of the word rather than as strings.
+    """
+
+    def __init__(self, entries: List[Entry]):
+        # Best first, so an entry's number is its rank
+        self.entries = sorted(entries, key=lambda e: (-e.credits, e.text))
+        self.texts = [normalize(entry.text) for entry in self.entries]
+
+        keys = [
+            (entry, match.start())
+            for entry, text in enumerate(self.texts)
+            for match in re.finditer(r"\S+", text)
+        ]
+        keys.sort(key=lambda key: self.texts[key[0]][key[1] :])
+        self.key_entries = array("I", (entry for entry, _ in keys))
+        self.key_offsets = array("I", (offset for _, offset in keys))
+
+        # The top matches for every prefix with too many keys to go through. Keys
+        # with the same prefix are next to each other, since they are sorted, and
+        # only the ranges that were too long for one prefix are split up by the
+        # next character.
+        self.precomputed = {}
+        ranges = [range(len(keys))]
+        length = 1
+        while ranges:
+            long_ranges = []
+            for keys_range in ranges:
+                for prefix, group in groupby(
+                    keys_range, key=lambda i: self.key(i)[:length]
+                ):
+                    group = list(group)
+                    if len(prefix) == length and len(group) > MAX_SCAN:
+                        entries = {self.key_entries[i] for i in group}
+                        self.precomputed[prefix] = array(
+                            "I", heapq.nsmallest(MAX_LIMIT, entries)
+                        )
+                        long_ranges.append(range(group[0], group[-1] + 1))
+            ranges = long_ranges
+            length += 1
+
+    def __len__(self):
+        return len(self.key_entries)
+
+    def key(self, i: int) -> str:
+        return self.texts[self.key_entries[i]][self.key_offsets[i] :]
+
+    def top(self, prefix: str, limit: int) -> List[Entry]:
+        """The best `limit` entries with a word starting with the normalized prefix"""
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+        if prefix in self.precomputed:
+            ranks = self.precomputed[prefix][:limit]
+        else:
+            n_keys = len(self.key_entries)
+            start = bisect_left(range(n_keys), prefix, key=self.key)
+            end = bisect_left(range(n_keys), prefix + "\U0010ffff", key=self.key)
+            ranks = heapq.nsmallest(limit, set(self.key_entries[start:end]))
+        return [self.entries[rank] for rank in ranks]
+
+    def size(self) -> int:
+        """The approximate number of bytes used by the keys and precomputed matches"""
+        arrays = [self.key_entries, self.key_offsets, *self.precomputed.values()]
+        return sum(a.itemsize * len(a) for a in arrays) + sum(map(len, self.texts))
+
+
+class Typeahead(NamedTuple):
+    version: object
+    people: PrefixIndex
+    titles: PrefixIndex
+
+
+# Everyone who acted in or directed a film, with their number of credits
+PEOPLE_SQL = """
+    select person_name, count(*) from (
+        select person_name from Acted
+        union all
+        select person_name from Directed
+    )
+    group by person_name
+"""
+# Every film, with the number of people credited on it
+TITLES_SQL = """
+    select film_id, title,
+        (select count(*) from Acted where Acted.film_id = Film.film_id)
+        + (select count(*) from Directed where Directed.film_id = Film.film_id)
+    from Film
+"""
+
+
+def build_typeahead(db: sqlite3.Connection, version) -> Typeahead:
+    """Builds the prefix indexes from the catalog in the database"""
+    people = [Entry(name, credits) for name, credits in db.execute(PEOPLE_SQL)]
+    titles = [
+        Entry(title, credits, film_id)
+        for film_id, title, credits in db.execute(TITLES_SQL)
+    ]
+    return Typeahead(version, PrefixIndex(people), PrefixIndex(titles))
+
+
+class TypeaheadHolder:
+    """
+    The worker's current Typeahead. The catalog version is only read again once
+    `recheck_seconds` have passed since it was last read.
+    """
+
+    def __init__(self, recheck_seconds: float):
+        self.lock = threading.Lock()
+        self.recheck_seconds = recheck_seconds
+        self.typeahead = None
+        self.checked = None
+        self.builds = 0
+        self.build_seconds = 0.0
+        self.lookups = 0
+
+    def stale(self) -> bool:
+        """Whether the catalog version needs to be read again"""
+        if self.typeahead is None:
+            return True
+        return monotonic() - self.checked >= self.recheck_seconds
+
+    def get(self) -> Typeahead:
+        self.lookups += 1
+        if not self.stale():
+            return self.typeahead
+        with self.lock:
+            # Another thread may have checked while this one was waiting
+            if self.stale():
+                db = get_db(readonly=True)
+                version = catalog_version(db)
+                if self.typeahead is None or self.typeahead.version != version:
+                    start = perf_counter()
+                    self.typeahead = build_typeahead(db, version)
+                    self.builds += 1
+                    self.build_seconds = perf_counter() - start
+                self.checked = monotonic()
+            return self.typeahead
+
+    def stats(self) -> dict:
+        typeahead = self.typeahead
+        indexes = [typeahead.people, typeahead.titles] if typeahead else []
+        return {
+            "people": len(typeahead.people.entries) if typeahead else 0,
+            "titles": len(typeahead.titles.entries) if typeahead else 0,
+            "keys": sum(map(len, indexes)),
+            "bytes": sum(index.size() for index in indexes),
+            "builds": self.builds,
+            "last_build_seconds": self.build_seconds,
+            "lookups": self.lookups,
+        }
+
+
+def get_typeahead() -> Typeahead:
+    return current_app.extensions["typeahead"].get()
+
+
+def warm():
+    """Builds the prefix indexes for the current catalog, if there is one"""
+    if catalog_exists(get_db(readonly=True)):
+        get_typeahead()
+
+
+def init_app(app):
+    recheck_seconds = app.config.get("TYPEAHEAD_RECHECK_SECONDS", 5)
+    holder = app.extensions["typeahead"] = TypeaheadHolder(recheck_seconds)
+    stats.register(app, "typeahead", holder.stats)
@@ -1,33 +1,62 @@
-from flask import Blueprint, render_template
+from flask import Blueprint, render_template, request
 from flask.wrappers import Response
 
+from app import conditional
 from app.database import get_db
+from app.film import ArgumentValidationError, get_comments, more_comments_url
 
 bp = Blueprint("User", __name__, url_prefix="/user")
 
 
 @bp.route("/<user_id>", methods=["GET"])
 def user_page(user_id: str):
-    # Get the user's info
-    db = get_db()
+    # Get the user's info. This is checked first, since the validators of a missing
+    # user would match those of any user without comments.
+    db = get_db(readonly=True)
     user_row = db.execute(
         "select username from User where user_id_=?", [user_id]
     ).fetchone()
     if not user_row:
         return Response("User does not exist!", status=404)
 
-    # Get the user's comments
-    comments = db.execute(
-        """
-		select comment_id, user_id_, username, film_id, title, date_, body
-		from Comment natural join User natural join (
-			select film_id, title
-			from Film
-		)
-		where user_id_=?
-		order by date_ desc;
-		""",
-        [user_id],
-    ).fetchall()
-
-    return render_template("user.html", user_row=user_row, comments=comments)
+    comments_version = conditional.user_comments_version(db, user_id)
+    validators = conditional.validators(
+        conditional.catalog_version(db), comments_version
+    )
+    response = conditional.not_modified(validators)
+    if response:
+        return response
+
+    # Get the first page of the user's comments
+    comments = get_comments("user_id_", user_id)
+
+    return conditional.respond(
+        render_template(
+            "user.html",
+            user_row=user_row,
+            comments=comments.comments,
+            comment_count=comments_version.comments,
+            more_comments=more_comments_url(
+                comments, "User.user_comments", user_id=user_id
+            ),
+        ),
+        validators,
+    )
+
+
+@bp.route("/<user_id>/comments", methods=["GET"])
+def user_comments(user_id: str):
+    """Renders just the page of the user's comments given by `before`"""
+    before = request.args.get("before")
+    try:
+        comments = get_comments("user_id_", user_id, before)
+    except ArgumentValidationError:
+        return Response("Invalid request", status=400)
+    return render_template(
+        "films/comment_list.html",
+        show_film=True,
+        comments=comments.comments,
+        more_comments=more_comments_url(
+            comments, "User.user_comments", user_id=user_id
+        ),
+    )
@@ -0,0 +1,81 @@
+"""
+Compares pulling the whole catalog from /api/films, which streams it from the
+cursor, against building the same response with fetchall(), on netflix_titles.csv
+replicated a number of times. Reports how long each takes and the most memory
+Python allocated while doing it.
+
+Usage: python3 -m benchmarks.bench_api [path to csv] [--copies N]
+"""
+
+import os
+import tracemalloc
+from argparse import ArgumentParser
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+import populate_db
+from app import api, create_app, database
+from benchmarks.bench_import import replicate
+
+
+def pull_streamed(client) -> int:
+    """Reads the NDJSON stream a chunk at a time, like a downstream job would"""
+    response = client.get("/api/films", buffered=False)
+    assert response.status_code == 200
+    n_bytes = sum(len(chunk) for chunk in response.response)
+    response.close()
+    return n_bytes
+
+
+def pull_materialized(app) -> int:
+    """Builds the same response body from every row at once"""
+    with app.app_context():
+        db = database.get_db(readonly=True)
+        rows = db.execute(api.FILMS_SQL, {"after": "", "limit": -1}).fetchall()
+        body = "".join(row[0] + "\n" for row in rows)
+    return len(body.encode())
+
+
+def measure(pull) -> tuple:
+    tracemalloc.start()
+    start = perf_counter()
+    n_bytes = pull()
+    seconds = perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return n_bytes, seconds, peak
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("csv_path", nargs="?", default="netflix_titles.csv")
+    parser.add_argument("--copies", type=int, default=10)
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as tmp_dir:
+        csv_path = os.path.join(tmp_dir, "replicated.csv")
+        replicate(args.csv_path, args.copies, csv_path)
+        app = create_app({"flask": {"DATABASE": os.path.join(tmp_dir, "bench.sqlite")}})
+        with app.app_context():
+            database.init_userdata()
+            db = database.get_db()
+            db.executescript(database.read_script("query-create-database.sql"))
+            stats = populate_db.ingest(csv_path, db)
+            database.migrate_db()
+        print(f"{stats.films} films")
+
+        client = app.test_client()
+        for label, pull in [
+            ("streamed", lambda: pull_streamed(client)),
+            ("fetchall", lambda: pull_materialized(app)),
+        ]:
+            n_bytes, seconds, peak = measure(pull)
+            print(
+                f"{label:>8}: {n_bytes / 2**20:6.1f} MiB in {seconds:5.2f}s "
+                f"({n_bytes / 2**20 / seconds:5.1f} MiB/s), "
+                f"peak allocated {peak / 2**20:7.2f} MiB"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Times issuing and completing authentication challenges with each AUTH_STATE backend
+while 100k other challenges are outstanding. Completing a challenge includes
+checking its Ed25519 signature, which is also timed on its own for comparison.
+
+Usage: python3 -m benchmarks.bench_challenges [--outstanding N] [--operations N]
+"""
+
+import os
+from argparse import ArgumentParser
+from statistics import median, quantiles
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from time import time as now
+
+from flask import session
+from nacl.signing import SigningKey
+
+from app import auth, authstate, create_app, database
+
+
+def fill(app, state: authstate.AuthState, n: int):
+    """Adds n challenges that won't expire during the benchmark, 4 per session"""
+    exp_time = now() + 3600
+    infos = [
+        authstate.ChallengeInfo(f"authchallenge_fill{i}", f"sess_{i // 4}", exp_time)
+        for i in range(n)
+    ]
+    if isinstance(state, authstate.MemoryAuthState):
+        for info in infos:
+            state.add_challenge(info)
+    else:
+        with app.app_context():
+            db = database.get_db()
+            db.executemany("insert into AuthChallenge values(?, ?, ?)", infos)
+            db.commit()
+
+
+def timed(samples: list, function, *args):
+    start = perf_counter()
+    result = function(*args)
+    samples.append(perf_counter() - start)
+    return result
+
+
+def print_times(label: str, samples: list):
+    p99 = quantiles(samples, n=100)[-1]
+    print(
+        f"{label:>18}: {len(samples) / sum(samples):8.0f}/s, "
+        f"median {median(samples) * 1e6:7.1f}us, p99 {p99 * 1e6:7.1f}us"
+    )
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--outstanding", type=int, default=100000)
+    parser.add_argument("--operations", type=int, default=5000)
+    args = parser.parse_args()
+
+    key = SigningKey.generate()
+    pub_key = key.verify_key.encode().hex()
+
+    with TemporaryDirectory() as tmp_dir:
+        for backend in authstate.BACKENDS:
+            app = create_app(
+                {
+                    "flask": {
+                        "DATABASE": os.path.join(tmp_dir, f"{backend}.sqlite"),
+                        "AUTH_STATE": backend,
+                        "CHALLENGE_CAPACITY": args.outstanding + args.operations,
+                    }
+                }
+            )
+            with app.app_context():
+                database.init_userdata()
+                database.migrate_db()
+            state = app.extensions["auth_state"]
+            fill(app, state, args.outstanding)
+            print(f"{backend}, {args.outstanding} outstanding challenges")
+
+            issue, complete, verify = [], [], []
+            with app.test_request_context():
+                for i in range(args.operations):
+                    session["sess_id"] = f"sess_bench{i}"
+                    challenge = timed(issue, auth.generate_challenge)
+                    signature = key.sign(challenge.encode()).hex()
+                    timed(verify, key.verify_key.verify, bytes.fromhex(signature))
+                    assert timed(complete, auth.complete_challenge, signature, pub_key)
+            print_times("issue", issue)
+            print_times("complete", complete)
+            print_times("signature check", verify)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+Times the facet index on netflix_titles.csv replicated a number of times: how long
+it takes to build, and how long filtering, counting and getting a page of results
+take for a few combinations of filters.
+
+Usage: python3 -m benchmarks.bench_facets [path to csv] [--copies N]
+"""
+
+import os
+import sqlite3
+from argparse import ArgumentParser
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+import populate_db
+from app import facets
+from app.facets import Filters
+from benchmarks.bench_import import replicate
+
+FILTERS = {
+    "movies": Filters({"type": ["Movie"]}),
+    "dramas, us": Filters({"genre": ["Dramas"], "country": ["United States"]}),
+    "tv, 2 ratings, 2015+": Filters(
+        {"type": ["TV Show"], "rating": ["TV-MA", "TV-14"]}, year_from=2015
+    ),
+    "4 facets, 1990-2005": Filters(
+        {
+            "type": ["Movie"],
+            "genre": ["Comedies", "Dramas"],
+            "country": ["United States", "India"],
+            "rating": ["PG-13", "R"],
+        },
+        1990,
+        2005,
+    ),
+}
+
+
+def time_per_call(function, repeat: int) -> float:
+    start = perf_counter()
+    for _ in range(repeat):
+        function()
+    return (perf_counter() - start) / repeat
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("csv_path", nargs="?", default="netflix_titles.csv")
+    parser.add_argument("--copies", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=1000)
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as tmp_dir:
+        csv_path = os.path.join(tmp_dir, "replicated.csv")
+        replicate(args.csv_path, args.copies, csv_path)
+        db = sqlite3.connect(os.path.join(tmp_dir, "bench.sqlite"))
+        with open("query-create-database.sql") as f:
+            db.executescript(f.read())
+        populate_db.ingest(csv_path, db)
+
+        start = perf_counter()
+        index = facets.build_index(db, None)
+        build = perf_counter() - start
+        size = sum(order.size() for order in index.orders.values())
+        print(
+            f"{len(index)} films: built in {build:.2f}s, "
+            f"bitmaps take {size / 2**20:.1f} MiB"
+        )
+
+        for label, filters in FILTERS.items():
+            matching = time_per_call(
+                lambda: index.orders["title"].matching(filters), args.repeat
+            )
+            page = time_per_call(
+                lambda: index.page("title", filters, limit=51), args.repeat
+            )
+            counts = time_per_call(lambda: index.facet_counts(filters), args.repeat)
+            print(
+                f"{label:>22} ({index.count(filters):6} films): "
+                f"intersect {matching * 1e6:7.1f}us, page {page * 1e6:7.1f}us, "
+                f"facet counts {counts * 1e6:8.1f}us"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""
+Compares the single-query film detail lookup used by the film page against the five
+queries it replaced, and the batch lookup against looking films up one at a time.
+Each lookup is run from several threads at once, like a busy server would, with a
+few comments on every film.
+
+Usage: python3 -m benchmarks.bench_film_detail [path to csv] [--lookups N]
+    [--threads N]
+"""
+
+import os
+import random
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from app import create_app, database, film
+
+
+def film_detail_five_queries(film_id: str):
+    """The queries film_page made before it used get_film_detail"""
+    db = database.get_db(readonly=True)
+    film_row = db.execute(f'select * from Film where film_id="{film_id}"').fetchone()
+    if not film_row:
+        return None
+    tags = db.execute(
+        f'select genre_name from Listed where film_id="{film_id}"'
+    ).fetchall()
+    directors = db.execute(
+        f'select person_name from Directed where film_id="{film_id}"'
+    ).fetchall()
+    cast = db.execute(
+        f'select person_name from Acted where film_id="{film_id}"'
+    ).fetchall()
+    comments = db.execute(
+        """
+        select comment_id, user_id_, username, film_id, title, date_, body
+        from Comment natural join User natural join (
+            select film_id, title
+            from Film
+            where film_id=?
+        )
+        order by date_ desc;
+        """,
+        [film_id],
+    ).fetchall()
+    return film_row, tags, directors, cast, comments
+
+
+def add_comments(app, film_ids: list, per_film: int) -> None:
+    with app.app_context():
+        db = database.get_db()
+        db.execute("insert into User values('bench', 'bench', 'x', 'x')")
+        db.executemany(
+            "insert into Comment values(?, 'bench', ?, ?, ?)",
+            [
+                (f"{film_id}_{i}", film_id, f"2021-01-{i + 1:02}", f"Comment {i}")
+                for film_id in film_ids
+                for i in range(per_film)
+            ],
+        )
+        db.commit()
+
+
+def lookups_per_second(app, lookup, batches: list, threads: int) -> float:
+    """Runs lookup on every batch of ids from `threads` threads at once"""
+
+    def run(batch):
+        # Each request gets its own request context and connection, like in flask
+        with app.test_request_context():
+            lookup(batch)
+
+    with ThreadPoolExecutor(threads) as pool:
+        start = perf_counter()
+        list(pool.map(run, batches))
+        elapsed = perf_counter() - start
+    return sum(len(batch) for batch in batches) / elapsed
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("csv_path", nargs="?", default="netflix_titles.csv")
+    parser.add_argument("--lookups", type=int, default=20000)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--comments", type=int, default=5)
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as tmp_dir:
+        app = create_app(
+            {
+                "flask": {
+                    "DATABASE": os.path.join(tmp_dir, "bench.sqlite"),
+                    "SQLITE_PROFILE": "performance",
+                }
+            }
+        )
+        with app.app_context():
+            snapshot = database.build_snapshot(args.csv_path, tmp_dir)
+            database.use_snapshot(snapshot, mode="attach")
+            database.migrate_db()
+            db = database.get_db(readonly=True)
+            film_ids = [row[0] for row in db.execute("select film_id from Film")]
+        add_comments(app, film_ids, args.comments)
+
+        ids = random.Random(0).choices(film_ids, k=args.lookups)
+        singles = [[film_id] for film_id in ids]
+        pages = [ids[i : i + 50] for i in range(0, len(ids), 50)]
+
+        def each(lookup):
+            return lambda batch: [lookup(film_id) for film_id in batch]
+
+        results = [
+            ("five queries", each(film_detail_five_queries), singles),
+            ("get_film_detail", each(film.get_film_detail), singles),
+            ("five queries x50", each(film_detail_five_queries), pages),
+            ("get_film_detail x50", each(film.get_film_detail), pages),
+            ("get_film_details(50)", film.get_film_details, pages),
+        ]
+        for label, lookup, batches in results:
+            for threads in sorted({1, args.threads}):
+                rate = lookups_per_second(app, lookup, batches, threads)
+                print(f"{label:>22}, {threads:2} threads: {rate:10.0f} films/s")
+
+
+if __name__ == "__main__":
+    main()
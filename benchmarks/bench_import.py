@@ -0,0 +1,173 @@
+"""
+Compares the vectorized csv normalization in populate_db against the row-at-a-time
+normalization it replaced, and populate_db.ingest against the string-generation
+import it replaced, on netflix_titles.csv and on a copy of it replicated 100 times.
+
+Usage: python3 -m benchmarks.bench_import [path to csv] [--copies N]
+"""
+
+import os
+import sqlite3
+from argparse import ArgumentParser
+from datetime import datetime
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+import pandas as pd
+
+import populate_db
+
+
+def normalize_rowwise(chunk: pd.DataFrame) -> int:
+    """The per-row normalization populate_db used before it was vectorized"""
+    films = []
+    n_links = 0
+    for row in chunk.itertuples():
+        date_added = row.date_added
+        if isinstance(date_added, float):
+            date_added = f"January 1, {row.release_year}"
+        date_added = datetime.strptime(date_added.strip(), "%B %d, %Y")
+        date_added = date_added.strftime("%Y-%m-%d")
+        rating = row.rating if not isinstance(row.rating, float) else "UR*"
+        films.append((row.show_id, date_added, rating))
+
+        for column in populate_db.LINK_COLUMNS:
+            value = getattr(row, column)
+            if not isinstance(value, str):
+                continue
+            for name in set(value.split(", ")):
+                n_links += bool(name.strip())
+    return len(films) + n_links
+
+
+def escape(value: str) -> str:
+    return value.replace("'", "''")
+
+
+def import_strings(csv_path: str, db: sqlite3.Connection) -> int:
+    """
+    The import populate_db.ingest replaced: one hand-escaped statement per film and
+    per relationship, each passed to db.execute inside a single transaction. The
+    search index is built the same way ingest builds it, so both end up with the
+    same searchable catalog.
+    """
+    n_rows = 0
+    db.execute("begin transaction;")
+    for row in pd.read_csv(csv_path).itertuples():
+        date_added = row.date_added
+        if isinstance(date_added, float):
+            date_added = f"January 1, {row.release_year}"
+        date_added = datetime.strptime(date_added.strip(), "%B %d, %Y")
+        date_added = date_added.strftime("%Y-%m-%d")
+        rating = row.rating if not isinstance(row.rating, float) else "UR*"
+        duration = row.duration if not isinstance(row.duration, float) else ""
+        db.execute(
+            f"insert into Film values('{escape(row.show_id)}', "
+            f"'{escape(row.title)}', '{escape(row.type)}', {int(row.release_year)}, "
+            f"'{date_added}', '{escape(rating)}', '{escape(duration)}', "
+            f"'{escape(row.description)}', random());"
+        )
+        n_rows += 1
+
+        for column, table in populate_db.LINK_COLUMNS.items():
+            value = getattr(row, column)
+            if not isinstance(value, str):
+                continue
+            for name in set(value.split(", ")):
+                if name.strip():
+                    db.execute(
+                        f"insert into {table} values('{escape(row.show_id)}', "
+                        f"'{escape(name)}');"
+                    )
+                    n_rows += 1
+    db.execute(populate_db.SEARCH_TABLE_SQL)
+    db.execute(populate_db.INDEX_FILMS_SQL.format(film_ids="select film_id from Film"))
+    db.execute("end transaction;")
+    return n_rows
+
+
+def normalize_vectorized(chunk: pd.DataFrame) -> int:
+    """
+    The same work as normalize_rowwise, with populate_db's functions. The
+    fingerprints normalize_chunk also makes are left out, since the row loop never
+    made them.
+    """
+    n_rows = len(populate_db.normalize_films(chunk))
+    for column in populate_db.LINK_COLUMNS:
+        n_rows += len(populate_db.explode_links(chunk, column))
+    return n_rows
+
+
+def replicate(csv_path: str, copies: int, out_path: str) -> None:
+    """Writes the csv repeated `copies` times with unique show_ids"""
+    csv = pd.read_csv(csv_path)
+    frames = []
+    for i in range(copies):
+        copy = csv.copy()
+        copy["show_id"] = copy["show_id"] + f"_{i}"
+        frames.append(copy)
+    pd.concat(frames).to_csv(out_path, index=False)
+
+
+def time_normalize(csv_path: str, normalize) -> float:
+    """Times normalizing every chunk of the csv, not counting reading the csv"""
+    elapsed = 0.0
+    for chunk in populate_db.read_chunks(csv_path):
+        start = perf_counter()
+        normalize(chunk)
+        elapsed += perf_counter() - start
+    return elapsed
+
+
+def create_db(tmp_dir: str) -> sqlite3.Connection:
+    db_path = os.path.join(tmp_dir, "bench.sqlite")
+    if os.path.exists(db_path):
+        os.unlink(db_path)
+    db = sqlite3.connect(db_path)
+    with open("query-create-database.sql") as f:
+        db.executescript(f.read())
+    return db
+
+
+def time_import_strings(csv_path: str, tmp_dir: str) -> float:
+    db = create_db(tmp_dir)
+    start = perf_counter()
+    import_strings(csv_path, db)
+    elapsed = perf_counter() - start
+    db.close()
+    return elapsed
+
+
+def time_ingest(csv_path: str, tmp_dir: str) -> populate_db.IngestStats:
+    db = create_db(tmp_dir)
+    stats = populate_db.ingest(csv_path, db)
+    db.close()
+    return stats
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("csv_path", nargs="?", default="netflix_titles.csv")
+    parser.add_argument("--copies", type=int, default=100)
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as tmp_dir:
+        replicated = os.path.join(tmp_dir, "replicated.csv")
+        replicate(args.csv_path, args.copies, replicated)
+
+        for label, path in [("1x", args.csv_path), (f"{args.copies}x", replicated)]:
+            rowwise = time_normalize(path, normalize_rowwise)
+            vectorized = time_normalize(path, normalize_vectorized)
+            strings = time_import_strings(path, tmp_dir)
+            stats = time_ingest(path, tmp_dir)
+            print(
+                f"{label:>5}: normalize rowwise {rowwise:8.3f}s, "
+                f"vectorized {vectorized:8.3f}s ({rowwise / vectorized:5.1f}x) | "
+                f"import strings {strings:8.3f}s, "
+                f"ingest {stats.seconds:8.3f}s ({strings / stats.seconds:5.1f}x) | "
+                f"{populate_db.format_stats(stats)}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""
+Times full-text search on a synthetic catalog, 1M titles by default, with titles,
+descriptions and cast drawn from a made-up vocabulary with word frequencies like
+those of real text. Each query is also run once as a LIKE scan over the Film table
+to show what it would cost without the index.
+
+Usage: python3 -m benchmarks.bench_search [--films N] [--repeat N]
+"""
+
+import os
+from argparse import ArgumentParser
+from statistics import median, quantiles
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+
+import populate_db
+from app import create_app, database, search
+
+SYLLABLES = [c + v for c in "bdfghklmnprstvz" for v in ("a", "e", "i", "o", "u", "ai")]
+
+
+def make_words(rng: np.random.Generator, n: int, syllables: int) -> np.ndarray:
+    words = set()
+    while len(words) < n:
+        picked = rng.choice(SYLLABLES, size=(n, syllables))
+        words.update("".join(word) for word in picked)
+    # Shuffled, so that the common words don't all start the same way
+    return rng.permutation(sorted(words)[:n])
+
+
+def zipf_choice(rng: np.random.Generator, words: np.ndarray, size) -> np.ndarray:
+    """Picks words so that the n-th one is about n times rarer than the first"""
+    weights = 1 / np.arange(1, len(words) + 1)
+    return rng.choice(words, size=size, p=weights / weights.sum())
+
+
+def make_catalog(path: str, n_films: int, seed: int = 0) -> dict:
+    """
+    Writes a catalog csv of n_films films. Returns some of the words and names in
+    it, to search for.
+    """
+    rng = np.random.default_rng(seed)
+    words = make_words(rng, 50000, 3)
+    first_names = make_words(rng, 5000, 2)
+    last_names = make_words(rng, 5000, 3)
+    names = np.array(
+        [
+            f"{first.title()} {last.title()}"
+            for first, last in zip(first_names, last_names)
+        ]
+    )
+
+    def phrases(n_words: int, pool: np.ndarray, sep: str = " ") -> list:
+        picked = zipf_choice(rng, pool, (n_films, n_words))
+        return [sep.join(row) for row in picked]
+
+    csv = pd.DataFrame(
+        {
+            "show_id": [f"s{i}" for i in range(n_films)],
+            "type": rng.choice(["Movie", "TV Show"], n_films),
+            "title": [title.title() for title in phrases(3, words)],
+            "director": phrases(1, names),
+            "cast": phrases(4, names, ", "),
+            "country": "United States",
+            "date_added": "September 25, 2021",
+            "release_year": rng.integers(1950, 2022, n_films),
+            "rating": "TV-MA",
+            "duration": "90 min",
+            "listed_in": "Dramas",
+            "description": [desc.capitalize() + "." for desc in phrases(20, words)],
+        }
+    )
+    csv.to_csv(path, index=False)
+    return {"words": words.tolist(), "names": names.tolist()}
+
+
+def time_query(app, text: str, repeat: int) -> tuple:
+    times = []
+    with app.test_request_context():
+        for _ in range(repeat):
+            start = perf_counter()
+            results = search.search_films(text)
+            times.append(perf_counter() - start)
+    return times, len(results)
+
+
+def time_like_scan(app, text: str) -> float:
+    """
+    Finds the films with all of the words in their title or description by scanning
+    Film. Every match is counted, as they would all have to be found to rank them.
+    """
+    words = text.split()
+    where = " and ".join(["(title like ? or film_desc like ?)"] * len(words))
+    params = [f"%{word}%" for word in words for _ in range(2)]
+    with app.app_context():
+        db = database.get_db(readonly=True)
+        start = perf_counter()
+        db.execute(f"select count(*) from Film where {where}", params).fetchone()
+        return perf_counter() - start
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--films", type=int, default=1000000)
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as tmp_dir:
+        csv_path = os.path.join(tmp_dir, "catalog.csv")
+        start = perf_counter()
+        pool = make_catalog(csv_path, args.films)
+        print(f"Generated {args.films} films in {perf_counter() - start:.1f}s")
+
+        app = create_app(
+            {
+                "flask": {
+                    "DATABASE": os.path.join(tmp_dir, "bench.sqlite"),
+                    "SQLITE_PROFILE": "performance",
+                }
+            }
+        )
+        with app.app_context():
+            db = database.get_db()
+            db.executescript(database.read_script("query-create-database.sql"))
+            stats = populate_db.ingest(csv_path, db)
+            print(populate_db.format_stats(stats))
+            database.migrate_db()
+
+        words, names = pool["words"], pool["names"]
+        queries = {
+            "common word": words[0],
+            "rank 100 word": words[99],
+            "rank 10000 word": words[9999],
+            "two words": f"{words[5]} {words[200]}",
+            "three letter prefix": words[50][:3],
+            "two letter prefix": words[50][:2],
+            "person": names[10],
+            "title prefix": f"{words[1]} {words[30][:4]}",
+        }
+        for label, text in queries.items():
+            times, n_results = time_query(app, text, args.repeat)
+            p95 = quantiles(times, n=20)[-1] if len(times) > 1 else times[0]
+            like = time_like_scan(app, text)
+            print(
+                f"{label:>20} {text!r:>24} ({n_results:2} results): "
+                f"median {median(times) * 1e3:7.2f}ms, p95 {p95 * 1e3:7.2f}ms, "
+                f"like scan {like * 1e3:8.1f}ms"
+            )
+
+
+if __name__ == "__main__":
+    main()
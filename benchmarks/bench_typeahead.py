@@ -0,0 +1,103 @@
+"""
+Times the typeahead index on netflix_titles.csv replicated a number of times: how
+long it takes to build, how much memory it takes, and how long looking up
+suggestions takes for every prefix of some names and titles, as if they were being
+typed. Lookups are timed on their own and through the /search/suggest route.
+
+Usage: python3 -m benchmarks.bench_typeahead [path to csv] [--copies N]
+"""
+
+import os
+import random
+from argparse import ArgumentParser
+from collections import defaultdict
+from statistics import median, quantiles
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+import populate_db
+from app import create_app, database, typeahead
+from benchmarks.bench_import import replicate
+
+
+def typed_prefixes(texts: list) -> list:
+    """Every prefix of each text, like the searches made while typing it"""
+    return [text[:length] for text in texts for length in range(1, len(text) + 1)]
+
+
+def time_lookups(lookup, prefixes: list) -> dict:
+    """Times looking up each prefix, grouped by the length of the prefix"""
+    times = defaultdict(list)
+    for prefix in prefixes:
+        start = perf_counter()
+        lookup(prefix)
+        times[min(len(prefix), 8)].append(perf_counter() - start)
+    return times
+
+
+def print_times(label: str, times: dict):
+    for length, samples in sorted(times.items()):
+        p99 = quantiles(samples, n=100)[-1] if len(samples) > 1 else samples[0]
+        print(
+            f"{label:>6} {length}{'+' if length == 8 else ' '} chars: "
+            f"median {median(samples) * 1e6:7.1f}us, p99 {p99 * 1e6:7.1f}us "
+            f"({len(samples)} lookups)"
+        )
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("csv_path", nargs="?", default="netflix_titles.csv")
+    parser.add_argument("--copies", type=int, default=10)
+    parser.add_argument("--texts", type=int, default=200)
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as tmp_dir:
+        csv_path = os.path.join(tmp_dir, "replicated.csv")
+        replicate(args.csv_path, args.copies, csv_path)
+        app = create_app({"flask": {"DATABASE": os.path.join(tmp_dir, "bench.sqlite")}})
+        with app.app_context():
+            db = database.get_db()
+            db.executescript(database.read_script("query-create-database.sql"))
+            populate_db.ingest(csv_path, db)
+
+            start = perf_counter()
+            index = typeahead.build_typeahead(db, None)
+            build = perf_counter() - start
+        stats = {
+            "people": len(index.people.entries),
+            "titles": len(index.titles.entries),
+            "keys": len(index.people) + len(index.titles),
+            "bytes": index.people.size() + index.titles.size(),
+        }
+        print(
+            f"{stats['people']} people, {stats['titles']} titles, {stats['keys']} "
+            f"keys: built in {build:.2f}s, {stats['bytes'] / 2**20:.1f} MiB"
+        )
+
+        rng = random.Random(0)
+        names = [e.text for e in index.people.entries]
+        titles = [e.text for e in index.titles.entries]
+        names = rng.sample(names, min(args.texts, len(names)))
+        titles = rng.sample(titles, min(args.texts, len(titles)))
+        prefixes = typed_prefixes(names) + typed_prefixes(titles)
+
+        def lookup(prefix):
+            index.people.top(prefix, 8)
+            index.titles.top(prefix, 8)
+
+        print_times("index", time_lookups(lookup, prefixes))
+
+        app.extensions["typeahead"].typeahead = index
+        app.extensions["typeahead"].recheck_seconds = float("inf")
+        app.extensions["typeahead"].checked = 0
+        client = app.test_client()
+
+        def request(prefix):
+            client.get("/search/suggest", query_string={"q": prefix})
+
+        print_times("route", time_lookups(request, prefixes))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,16 @@
 # Usage: source make_db.sh <path to database file> <path to csv>
+# The new catalog is built and validated next to the old database and then swapped
+# in, and the users, sessions and comments in the old database are copied into it.
+# Nothing else may have the database open while this runs. To refresh the catalog
+# of a running server, set USER_DATABASE and use `flask refresh-catalog` instead.
 
-rm $1
-sqlite3 $1 < query-create-database.sql
-python3 populate_db.py $2 | sqlite3 $1
\ No newline at end of file
+python3 - "$1" "$2" <<'EOF'
+import sys
+
+from app import create_app, database
+
+db_path, csv_path = sys.argv[1:]
+app = create_app({'flask': {'DATABASE': db_path}})
+with app.app_context():
+	print(f'Now serving {database.refresh_catalog(csv_path, offline=True)}')
+EOF
@@ -1,135 +1,510 @@
 """
 Generates the sql to populate the database with the data from the given .csv.
-The sql commands are this.outputed to stdout. 
+The sql commands are this.outputed to stdout. If a database path is also given,
+the rows are instead bulk-inserted directly into that database.
 
-Usage: python3 populate_db.py <path to csv file>
+The csv is read in chunks of --chunk-size rows so memory use does not grow with
+the size of the csv. With --workers, the chunks are parsed in a pool of processes
+while this process writes them to the database in order. With --incremental, only
+the films that changed since the last import are written.
+
+Usage: python3 populate_db.py <path to csv file> [path to database]
+	[--chunk-size <rows>] [--workers <processes>] [--incremental]
 """
 
 import datetime as dt
 import secrets
-from collections import namedtuple
-from datetime import datetime
-from random import choice, random, randrange
-from sys import argv, modules, stderr
-from typing import Counter
+import sqlite3
+from argparse import ArgumentParser
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from hashlib import blake2b
+from random import choice, randrange
+from sys import modules, platform, stderr
+from time import perf_counter
 
 import pandas as pd
 
+try:
+	import resource
+except ImportError:
+	# Not available on Windows
+	resource = None
+
 this = modules[__name__]
 this.output = print
 this.testing = False
 
-def insert_film(row):
-	# Format the date
-	date_added = row.date_added
-	# Some are blank and are imported as nan
-	if isinstance(date_added, float):
-		date_added = f'January 1, {row.release_year}'
-	# Some have leading spaces
-	date_added = date_added.strip()
-	date_added = datetime.strptime(date_added, '%B %d, %Y')
-	date_added = date_added.strftime('%Y-%m-%d')
-	
-	# fixing the rating
-	rating = row.rating
-	if isinstance(rating, float):
-		rating = 'UR*'
-	
+# The number of csv rows that are parsed and written at a time. Every chunk costs
+# a few DataFrames, so much smaller chunks spend most of their time making those.
+CHUNK_SIZE = 10000
+
+# The columns of the Film table, in the order they are declared in
+# query-create-database.sql so rows can be passed straight to executemany
+FILM_COLUMNS = ['film_id', 'title', 'film_type', 'release_year', 'date_added',
+	'rating', 'duration', 'film_desc', 'feature']
+Comment = namedtuple('Comment', 'comment_id, user_id_, film_id, date_, body')
+
+# Maps the csv column holding a comma separated list to the table it populates
+LINK_COLUMNS = {
+	'cast': 'Acted',
+	'director': 'Directed',
+	'country': 'Produced',
+	'listed_in': 'Listed',
+}
+
+INSERT_SQL = {
+	'Film': 'insert into Film values(?, ?, ?, ?, ?, ?, ?, ?, ?)',
+	'Acted': 'insert into Acted values(?, ?)',
+	'Directed': 'insert into Directed values(?, ?)',
+	'Produced': 'insert into Produced values(?, ?)',
+	'Listed': 'insert into Listed values(?, ?)',
+	'FilmFingerprint': 'insert or replace into FilmFingerprint values(?, ?)',
+	'User': 'insert or ignore into User values(?, ?, ?, ?)',
+	'Comment': 'insert into Comment values(?, ?, ?, ?, ?)',
+}
+
+# The full-text search index over titles, descriptions and the names of everyone
+# who directed or acted in each film. Its rowids are the rowids of the films in
+# Film, so that entries can be found without scanning the index.
+SEARCH_TABLE_SQL = '''
+	create virtual table if not exists FilmSearch using fts5(
+		film_id unindexed, title, film_desc, people,
+		tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3'
+	)
+'''
+INDEX_FILMS_SQL = '''
+	insert into FilmSearch(rowid, film_id, title, film_desc, people)
+	select Film.rowid, film_id, title, film_desc, (
+		select group_concat(person_name, ', ') from (
+			select person_name from Directed where Directed.film_id = Film.film_id
+			union all
+			select person_name from Acted where Acted.film_id = Film.film_id
+		)
+	)
+	from Film where film_id in ({film_ids})
+'''
+
+def feature_scores(film_ids: pd.Series) -> pd.Series:
+	"""
+	Pseudo-random numbers in [0, 1) for ordering featured films. They are derived
+	from the film ids instead of random() so that every import gives the same result
+	no matter how the csv was chunked or which process parsed it.
+	"""
+	hashes = pd.util.hash_pandas_object(film_ids, index=False)
+	return hashes.to_numpy() / 2**64
+
+def normalize_films(chunk: pd.DataFrame) -> pd.DataFrame:
+	"""
+	Cleans up a chunk of the csv and returns it as a frame with FILM_COLUMNS.
+	Everything is done a column at a time. Nothing is escaped.
+	"""
+	release_year = chunk['release_year'].astype(int)
+
+	# Some dates are blank and are imported as nan, and some have leading spaces
+	date_added = chunk['date_added'].fillna('January 1, ' + release_year.astype(str))
+	date_added = pd.to_datetime(date_added.str.strip(), format='%B %d, %Y')
+
+	return pd.DataFrame({
+		'film_id': chunk['show_id'],
+		'title': chunk['title'],
+		'film_type': chunk['type'],
+		'release_year': release_year,
+		'date_added': date_added.dt.strftime('%Y-%m-%d'),
+		# fixing the rating
+		'rating': chunk['rating'].fillna('UR*'),
+		# A few rows have their duration in the rating column instead
+		'duration': chunk['duration'].fillna(''),
+		'film_desc': chunk['description'],
+		'feature': feature_scores(chunk['show_id']),
+	}, columns=FILM_COLUMNS)
+
+def explode_links(chunk: pd.DataFrame, column, deliminator=', ') -> pd.DataFrame:
+	"""
+	Splits one of the comma separated columns into a (film_id, name) frame with a
+	row for each unique, non-blank entry. Blank cells are imported as nan and give
+	no rows.
+
+	This goes through the column as a plain list. Splitting it with the .str methods
+	and exploding the result takes about four times as long, since pandas makes a
+	new object for every step of every row.
+	"""
+	film_ids = []
+	names = []
+	for film_id, value in zip(chunk['show_id'].tolist(), chunk[column].tolist()):
+		if not isinstance(value, str):
+			# nan is the only value that isn't equal to itself
+			if value != value:
+				continue
+			value = str(value)
+		# dict.fromkeys drops the duplicates but keeps the order they were listed in
+		for name in dict.fromkeys(value.split(deliminator)):
+			if name.strip():
+				film_ids.append(film_id)
+				names.append(name)
+	return pd.DataFrame({'film_id': film_ids, 'name': names})
+
+def fingerprint(chunk: pd.DataFrame) -> pd.DataFrame:
+	"""
+	Hashes every csv row in the chunk so an incremental import can tell which films
+	changed. Everything is hashed as text so the hash does not depend on the dtypes
+	pandas inferred for the chunk.
+	"""
+	hashes = pd.util.hash_pandas_object(chunk.astype(str), index=False)
+	return pd.DataFrame({
+		'film_id': chunk['show_id'],
+		'content_hash': [f'{hash_:016x}' for hash_ in hashes.tolist()],
+	})
+
+def fake_comments(film_id, users):
+	"""Makes a few fake comments on the given film for testing purposes"""
+	start_date = dt.date(2020, 1, 1)
+	end_date = dt.date(2021, 1, 1)
+	delta = (end_date - start_date).days
+	for i in range(randrange(2, 10)):
+		user = choice(users)
+		date = start_date + dt.timedelta(days=randrange(delta))
+		yield Comment(
+			f'commentid_{secrets.token_urlsafe(256//8)}',
+			user.user_id,
+			film_id,
+			str(date),
+			'This is a fake comment for testing purposes'
+		)
+
+def insert_film(film):
 	# Escape any single quotes. This is not a typo, sql uses double single
 	# quotes
-	show_id = row.show_id.replace("\'", "\'\'")
-	title = row.title.replace("\'", "\'\'")
-	type_ = row.type.replace("\'", "\'\'")
-	rating = rating.replace("\'", "\'\'")
-	duration = row.duration.replace("\'", "\'\'")
-	release_year = int(row.release_year)
-	description = row.description.replace("\'", "\'\'")
+	show_id = film.film_id.replace("\'", "\'\'")
+	title = film.title.replace("\'", "\'\'")
+	type_ = film.film_type.replace("\'", "\'\'")
+	rating = film.rating.replace("\'", "\'\'")
+	duration = film.duration.replace("\'", "\'\'")
+	release_year = film.release_year
+	date_added = film.date_added
+	description = film.film_desc.replace("\'", "\'\'")
 	this.output(f'insert into Film values(\'{show_id}\', \'{title}\', ' \
 		f'\'{type_}\', {release_year}, \'{date_added}\', \'{rating}\', ' \
-		f'\'{duration}\', \'{description}\', {random()});')
-	
+		f'\'{duration}\', \'{description}\', {film.feature});')
+
 	# In testing mode, we make fake comments
 	if this.testing:
-		start_date = dt.date(2020, 1, 1)
-		end_date = dt.date(2021, 1, 1)
-		delta = (end_date - start_date).days
-		for i in range(randrange(2, 10)):
-			user = choice(this.fake_users)
-			date = start_date + dt.timedelta(days=randrange(delta))
+		for comment in fake_comments(show_id, this.fake_users):
 			this.output(f'''
 				insert into Comment values(
-					"commentid_{secrets.token_urlsafe(256//8)}",
-					"{user.user_id}",
-					"{show_id}",
-					"{date}",
-					"This is a fake comment for testing purposes"
+					"{comment.comment_id}",
+					"{comment.user_id_}",
+					"{comment.film_id}",
+					"{comment.date_}",
+					"{comment.body}"
 				)
 			''')
 
-relationships = Counter()
 def insert_relationship(film_id, other_key, table):
-	if not other_key.strip():
-		return
-	
 	other_key = other_key.replace("\'", "\'\'")
 	this.output(f'insert into {table} values(\'{film_id}\', \'{other_key}\');')
-	relationships[f'insert into {table} values(\'{film_id}\', \'{other_key}\');'] += 1
-
-def insert_relationships(row, deliminator=', '):
-	# actors
-	cast = row.cast if isinstance(row.cast, str) else ''
-	for person in set(cast.split(deliminator)):
-		insert_relationship(row.show_id, person, 'Acted')
-	
-	# directors
-	director = row.director if isinstance(row.director, str) else ''
-	for person in set(director.split(deliminator)):
-		insert_relationship(row.show_id, person, 'Directed')
-	
-	# locations
-	country = row.country if isinstance(row.country, str) else ''
-	for country in set(country.split(deliminator)):
-		insert_relationship(row.show_id, country, 'Produced')
-	
-	listed_in = row.listed_in if isinstance(row.listed_in, str) else ''
-	# genres
-	for genre in set(listed_in.split(deliminator)):
-		insert_relationship(row.show_id, genre, 'Listed')
 
 User = namedtuple('User', 'user_id, username')
-fake_users = []
+this.fake_users = []
 n_fake_users = 10
 
-def run(csv_path, out=None, testing=False):
+def make_fake_users():
+	return [
+		User(f'userid_FAKE-{i}', f'FakeUser-{i}') for i in range(n_fake_users)
+	]
+
+class Batch:
+	"""The rows parsed from one chunk of the csv, as a frame for each table"""
+
+	def __init__(self, frames: dict):
+		self.frames = frames
+
+	def __len__(self):
+		return sum(len(frame) for frame in self.frames.values())
+
+	def rows(self, table):
+		"""
+		Iterates over the rows of the table as plain tuples. The columns are
+		converted to lists first, which is much quicker than itertuples.
+		"""
+		frame = self.frames[table]
+		return zip(*(frame[column].tolist() for column in frame.columns))
+
+	def write(self, db: sqlite3.Connection):
+		"""Inserts every row in the batch. The caller handles the transaction."""
+		for table in self.frames:
+			db.executemany(INSERT_SQL[table], self.rows(table))
+
+def peak_rss() -> int:
+	"""Returns the peak resident set size of this process in bytes, or 0 if unknown"""
+	if resource is None:
+		return 0
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	# Linux reports kilobytes, macOS reports bytes
+	return peak if platform == 'darwin' else peak * 1024
+
+def read_chunks(csv_path, chunk_size=CHUNK_SIZE):
+	"""Lazily reads the csv as DataFrames of at most chunk_size rows"""
+	return pd.read_csv(csv_path, chunksize=chunk_size)
+
+def normalize_chunk(chunk: pd.DataFrame) -> Batch:
+	"""Parses a chunk of the csv. This is run in the worker processes."""
+	frames = {'Film': normalize_films(chunk)}
+	for column, table in LINK_COLUMNS.items():
+		frames[table] = explode_links(chunk, column)
+	frames['FilmFingerprint'] = fingerprint(chunk)
+	return Batch(frames)
+
+def normalized_batches(csv_path, chunk_size=CHUNK_SIZE, workers=None):
+	"""
+	Yields a Batch for every chunk of the csv, in csv order. If workers is more than
+	one, the chunks are parsed in that many processes. At most two chunks per worker
+	are in flight at a time so a large csv is never read into memory all at once.
+	"""
+	chunks = read_chunks(csv_path, chunk_size)
+	if not workers or workers <= 1:
+		yield from map(normalize_chunk, chunks)
+		return
+
+	with ProcessPoolExecutor(workers) as pool:
+		pending = deque()
+		for chunk in chunks:
+			pending.append(pool.submit(normalize_chunk, chunk))
+			if len(pending) >= 2 * workers:
+				yield pending.popleft().result()
+		while pending:
+			yield pending.popleft().result()
+
+def update_catalog_version(db: sqlite3.Connection) -> str:
+	"""
+	Recomputes the catalog version from the fingerprints of every film and stores it
+	in CatalogMeta. The version only changes when the catalog does, and the time it
+	last changed is stored alongside it.
+	"""
+	hash_ = blake2b(digest_size=16)
+	for film_id, content_hash in db.execute(
+		'select film_id, content_hash from FilmFingerprint order by film_id'
+	):
+		hash_.update(f'{film_id}:{content_hash};'.encode('utf-8'))
+	version = hash_.hexdigest()
+
+	old_version = db.execute(
+		"select value from CatalogMeta where key_='version'"
+	).fetchone()
+	if not old_version or old_version[0] != version:
+		db.executemany('insert or replace into CatalogMeta values(?, ?)', [
+			('version', version),
+			('modified', datetime.now(timezone.utc).isoformat(timespec='seconds')),
+		])
+	return version
+
+IngestStats = namedtuple('IngestStats',
+	'rows, films, seconds, rows_per_sec, chunk_size, peak_rss')
+
+def format_stats(stats: IngestStats) -> str:
+	return f'Inserted {stats.rows} rows in {stats.seconds:.2f}s ' \
+		f'({stats.rows_per_sec:.0f} rows/s, chunks of {stats.chunk_size}, ' \
+		f'peak RSS {stats.peak_rss / 2**20:.1f} MiB)'
+
+def ingest(csv_path, db: sqlite3.Connection, testing=False,
+		chunk_size=CHUNK_SIZE, workers=None) -> IngestStats:
+	"""
+	Bulk-loads the csv into the database using parameterized executemany calls
+	inside of a single transaction. The schema must already exist. The csv is
+	streamed in chunks, and each chunk is written and dropped before the next one
+	is read, so memory use stays flat no matter how big the csv is.
+
+	If workers is given, the chunks are parsed by a pool of that many processes.
+	This process is the only writer and commits the chunks in csv order, so the
+	database is the same as with a serial import.
+
+	Returns:
+		IngestStats: The number of rows written and how quickly they were written
+	"""
+	start = perf_counter()
+	n_rows = n_films = 0
+
+	# in testing mode, we create some users and comment on every film
+	users = make_fake_users() if testing else []
+
+	with db:
+		if users:
+			db.executemany(INSERT_SQL['User'],
+				[(user.user_id, user.username, 'abcd', 'abcd') for user in users])
+			n_rows += len(users)
+
+		for batch in normalized_batches(csv_path, chunk_size, workers):
+			if testing:
+				comments = [comment for film_id in batch.frames['Film']['film_id']
+					for comment in fake_comments(film_id, users)]
+				batch.frames['Comment'] = pd.DataFrame(comments,
+					columns=Comment._fields)
+			batch.write(db)
+			n_rows += len(batch)
+			n_films += len(batch.frames['Film'])
+
+		# The search index is quicker to build in one go after everything is inserted
+		db.execute(SEARCH_TABLE_SQL)
+		db.execute(INDEX_FILMS_SQL.format(film_ids='select film_id from Film'))
+		update_catalog_version(db)
+
+	seconds = perf_counter() - start
+	return IngestStats(n_rows, n_films, seconds, n_rows / seconds, chunk_size,
+		peak_rss())
+
+SyncStats = namedtuple('SyncStats',
+	'inserted, updated, deleted, unchanged, seconds, peak_rss')
+
+def format_sync_stats(stats: SyncStats) -> str:
+	return f'Inserted {stats.inserted}, updated {stats.updated}, deleted ' \
+		f'{stats.deleted}, and kept {stats.unchanged} films in ' \
+		f'{stats.seconds:.2f}s (peak RSS {stats.peak_rss / 2**20:.1f} MiB)'
+
+def delete_films(db: sqlite3.Connection, film_ids: str):
+	"""
+	Deletes the films selected by the film_ids subquery along with their links and
+	their entries in the search index
+	"""
+	db.execute(f'''
+		delete from FilmSearch where rowid in
+			(select rowid from Film where film_id in ({film_ids}))
+	''')
+	for table in [*LINK_COLUMNS.values(), 'FilmFingerprint', 'Film']:
+		db.execute(f'delete from {table} where film_id in ({film_ids})')
+
+def sync(csv_path, db: sqlite3.Connection, chunk_size=CHUNK_SIZE) -> SyncStats:
+	"""
+	Incrementally updates a database that was already populated by ingest. Each csv
+	row is fingerprinted, and only films that are new, changed, or no longer in the
+	csv are written, along with their Acted, Directed, Produced, and Listed rows
+	and their entries in the search index. The User, Sess, and Comment tables are
+	left alone.
+
+	Returns:
+		SyncStats: How many films were inserted, updated, deleted, and unchanged
+	"""
+	start = perf_counter()
+	inserted = updated = unchanged = 0
+
+	with db:
+		# Databases populated before fingerprints existed are treated as if every
+		# film changed
+		db.execute('''
+			create table if not exists FilmFingerprint (
+				film_id varchar(16) not null,
+				content_hash varchar(16) not null,
+				primary key (film_id)
+			)
+		''')
+		db.execute('''
+			create table if not exists CatalogMeta (
+				key_ varchar(32) not null,
+				value varchar(128) not null,
+				primary key (key_)
+			)
+		''')
+		db.execute(SEARCH_TABLE_SQL)
+		db.execute('create temp table Incoming (film_id primary key, content_hash)')
+		db.execute('create temp table Seen (film_id primary key)')
+
+		for chunk in read_chunks(csv_path, chunk_size):
+			fingerprints = fingerprint(chunk)
+			db.execute('delete from temp.Incoming')
+			db.executemany('insert into temp.Incoming values(?, ?)',
+				fingerprints.itertuples(index=False, name=None))
+			db.execute('insert into temp.Seen select film_id from temp.Incoming')
+
+			# Only keep the films that are new or whose csv row changed
+			db.execute('''
+				delete from temp.Incoming where film_id in
+					(select film_id from FilmFingerprint natural join temp.Incoming)
+			''')
+			changed = dict(db.execute('''
+				select film_id, Film.film_id is null
+				from temp.Incoming left join Film using (film_id)
+			''').fetchall())
+			unchanged += len(chunk) - len(changed)
+			if not changed:
+				continue
+			n_new = sum(changed.values())
+			inserted += n_new
+			updated += len(changed) - n_new
+
+			# Replace the changed films and their links
+			delete_films(db, 'select film_id from temp.Incoming')
+			normalize_chunk(chunk[chunk['show_id'].isin(changed)]).write(db)
+			db.execute(INDEX_FILMS_SQL.format(
+				film_ids='select film_id from temp.Incoming'))
+
+		# Anything that is no longer in the csv gets deleted
+		deleted = db.execute(
+			'select count(*) from Film where film_id not in (select * from temp.Seen)'
+		).fetchone()[0]
+		delete_films(db, 'select film_id from Film where film_id not in ' \
+			'(select film_id from temp.Seen)')
+
+		update_catalog_version(db)
+
+	db.execute('drop table temp.Incoming')
+	db.execute('drop table temp.Seen')
+
+	seconds = perf_counter() - start
+	return SyncStats(inserted, updated, deleted, unchanged, seconds, peak_rss())
+
+def run(csv_path, out=None, testing=False, chunk_size=CHUNK_SIZE):
 	this.output = out or print
 	this.testing = testing
-	
+
 	this.output('begin transaction;')
-	
+
 	# in testing mode, we create some users
 	if testing:
-		for i in range(n_fake_users):
-			fake_user = User(f'userid_FAKE-{i}', f'FakeUser-{i}')
-			fake_users.append(fake_user)
+		this.fake_users = make_fake_users()
+		for fake_user in this.fake_users:
 			this.output(f'''insert into User values(
 				"{fake_user.user_id}",
 				"{fake_user.username}",
 				"abcd",
 				"abcd"
 			)''')
-	
-	csv = pd.read_csv(csv_path)
 
-	for row in csv.itertuples():
-		insert_film(row)
-		insert_relationships(row)
-	
+	for batch in normalized_batches(csv_path, chunk_size):
+		for film in batch.frames['Film'].itertuples(index=False):
+			insert_film(film)
+		# actors, directors, locations, and genres
+		for table in LINK_COLUMNS.values():
+			for film_id, other_key in batch.rows(table):
+				insert_relationship(film_id, other_key, table)
+
+	this.output(SEARCH_TABLE_SQL.strip() + ';')
+	this.output(INDEX_FILMS_SQL.format(film_ids='select film_id from Film').strip()
+		+ ';')
 	this.output('end transaction;')
 
 if __name__ == '__main__':
-	if len(argv) == 1:
-		this.output('Not enough arguments!', file=stderr)
-		this.output('Usage: python3 populate_db.py <path to csv file>', file=stderr)
-		exit(1)
-	
-	run(argv[1])
+	parser = ArgumentParser(description='Populates the database from the csv.')
+	parser.add_argument('csv_path', help='path to netflix_titles.csv')
+	parser.add_argument('db_path', nargs='?', help='bulk-insert into this ' \
+		'database instead of printing sql to stdout')
+	parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+		help='the number of csv rows to parse and write at a time')
+	parser.add_argument('--workers', type=int, default=None,
+		help='the number of processes to parse the csv with')
+	parser.add_argument('--incremental', action='store_true',
+		help='only write the films that changed since the database was populated')
+	args = parser.parse_args()
+
+	if args.db_path and args.incremental:
+		db = sqlite3.connect(args.db_path)
+		stats = sync(args.csv_path, db, chunk_size=args.chunk_size)
+		db.close()
+		print(format_sync_stats(stats), file=stderr)
+	elif args.db_path:
+		db = sqlite3.connect(args.db_path)
+		stats = ingest(args.csv_path, db, chunk_size=args.chunk_size,
+			workers=args.workers)
+		db.close()
+		print(format_stats(stats), file=stderr)
+	else:
+		run(args.csv_path, chunk_size=args.chunk_size)
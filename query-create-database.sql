@@ -1,7 +1,20 @@
 -- create database MoviesAndTV;
 
+-- This only creates the catalog. The tables for users and their comments are in
+-- query-create-userdata.sql so the catalog can be rebuilt without touching them.
+
 -- use MoviesAndTV;
 
+-- The catalog is recreated from scratch below, so none of its migrations have been
+-- applied to it anymore. The user tables' version is left alone.
+create table if not exists SchemaVersion (
+	component varchar(16) not null,
+	version int not null,
+
+	primary key (component)
+);
+delete from SchemaVersion where component = 'catalog';
+
 
 -- Entities
 
@@ -21,37 +34,6 @@ create table Film (
 	primary key (film_id)
 );
 
-drop table if exists User;
-create table User (
-	user_id_ varchar(96) not null,
-	username varchar(20) not null,
-	pass_hash varchar(96) not null,
-	pass_salt varchar(96) not null,
-	
-	primary key (user_id_)
-);
-
-drop table if exists Sess;
-create table Sess (
-	sess_id varchar(96) not null,
-	user_id_ varchar(96) not null,
-	
-	primary key (sess_id),
-	foreign key (user_id_) references User(user_id_)
-);
-
-drop table if exists Comment;
-create table Comment (
-	comment_id varchar(96) not null,
-	user_id_ varchar(96) not null,
-	film_id varchar(16) not null,
-	date_ date not null,
-	body varchar(1024) not null,
-	
-	primary key (comment_id)
-);
-
-
 drop table if exists Directed;
 create table Directed (
 	film_id varchar(16) not null,
@@ -87,3 +69,32 @@ create table Listed (
 	primary key (film_id, genre_name),
 	foreign key (film_id) references Film(film_id)
 );
+
+-- Full-text search over titles, descriptions, and the names of everyone who
+-- directed or acted in each film. Its rowids are the rowids of the films in Film.
+drop table if exists FilmSearch;
+create virtual table FilmSearch using fts5(
+	film_id unindexed, title, film_desc, people,
+	tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3'
+);
+
+-- A hash of the csv row each film was imported from, so that incremental imports
+-- only rewrite the films that changed
+drop table if exists FilmFingerprint;
+create table FilmFingerprint (
+	film_id varchar(16) not null,
+	content_hash varchar(16) not null,
+	
+	primary key (film_id),
+	foreign key (film_id) references Film(film_id)
+);
+
+-- Information about the catalog as a whole, such as the version of the csv it was
+-- imported from
+drop table if exists CatalogMeta;
+create table CatalogMeta (
+	key_ varchar(32) not null,
+	value varchar(128) not null,
+	
+	primary key (key_)
+);
\ No newline at end of file
@@ -0,0 +1,31 @@
+-- The tables for users, their sessions, and their comments. These are only
+-- created if they don't exist yet so that rebuilding the catalog with
+-- query-create-database.sql never loses user data. They can live in the same file
+-- as the catalog or in a separate database that is attached to it.
+
+create table if not exists User (
+	user_id_ varchar(96) not null,
+	username varchar(20) not null,
+	pass_hash varchar(96) not null,
+	pass_salt varchar(96) not null,
+	
+	primary key (user_id_)
+);
+
+create table if not exists Sess (
+	sess_id varchar(96) not null,
+	user_id_ varchar(96) not null,
+	
+	primary key (sess_id),
+	foreign key (user_id_) references User(user_id_)
+);
+
+create table if not exists Comment (
+	comment_id varchar(96) not null,
+	user_id_ varchar(96) not null,
+	film_id varchar(16) not null,
+	date_ date not null,
+	body varchar(1024) not null,
+	
+	primary key (comment_id)
+);
\ No newline at end of file
@@ -0,0 +1,97 @@
+import json
+
+from app import api, database
+from tests.conftest import AuthedClient
+from flask import Flask
+from flask.testing import FlaskClient
+
+
+def ndjson(response) -> list:
+    assert response.status_code == 200
+    assert response.is_streamed
+    assert response.mimetype == "application/x-ndjson"
+    return [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+
+def test_films(client: FlaskClient, app: Flask):
+    """Every film should be streamed once, with its credits"""
+    films = ndjson(client.get("/api/films"))
+    with app.app_context():
+        db = database.get_db()
+        film_ids = [row[0] for row in db.execute("select film_id from Film")]
+        cast = [
+            row[0]
+            for row in db.execute("select person_name from Acted where film_id='s633'")
+        ]
+    assert sorted(film["film_id"] for film in films) == sorted(film_ids)
+
+    avatar = next(film for film in films if film["film_id"] == "s633")
+    assert avatar["title"] == "Avatar: The Last Airbender"
+    assert sorted(avatar["cast"]) == sorted(cast)
+    assert avatar["countries"] == ["United States"]
+
+
+def test_films_resumed(client: FlaskClient, monkeypatch):
+    """Pulling the films in pieces should get the same films as pulling them at once"""
+    # Make the streams take several batches
+    monkeypatch.setattr(api, "STREAM_BATCH", 7)
+    everything = ndjson(client.get("/api/films"))
+    pieces = []
+    while True:
+        after = pieces[-1]["film_id"] if pieces else ""
+        query = {"after": after, "limit": 50}
+        piece = ndjson(client.get("/api/films", query_string=query))
+        if not piece:
+            break
+        assert len(piece) <= 50
+        pieces += piece
+    assert pieces == everything
+
+
+def test_film(auth_client: AuthedClient):
+    client = auth_client.client
+    client.post("/film/s633/comment", data={"comment": "Love this show!"})
+    response = client.get("/api/films/s633")
+    assert response.status_code == 200
+    film = response.get_json()
+    assert film["title"] == "Avatar: The Last Airbender"
+    assert film["comment_count"] == 1
+
+    comments = ndjson(client.get("/api/films/s633/comments"))
+    assert [comment["body"] for comment in comments] == ["Love this show!"]
+    assert comments[0]["username"] == auth_client.username
+    assert ndjson(client.get("/api/films/s1/comments")) == []
+
+    # The comment changes the ETag of the film but not of the catalog
+    etag = response.headers["ETag"]
+    client.post("/film/s633/comment", data={"comment": "Still love it"})
+    response = client.get("/api/films/s633", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.get_json()["comment_count"] == 2
+
+
+def test_person(client: FlaskClient):
+    response = client.get("/api/person/Quentin Tarantino")
+    assert response.status_code == 200
+    person = response.get_json()
+    assert person["name"] == "Quentin Tarantino"
+    assert "Kill Bill: Vol. 1" in [film["title"] for film in person["directed"]]
+    assert isinstance(person["acted"], list)
+
+
+def test_api_not_modified(client: FlaskClient):
+    response = client.get("/api/films")
+    response.get_data()
+    response = client.get(
+        "/api/films", headers={"If-None-Match": response.headers["ETag"]}
+    )
+    assert response.status_code == 304
+
+
+def test_api_errors(client: FlaskClient):
+    assert client.get("/api/films/nonexistent").status_code == 404
+    assert client.get("/api/films/nonexistent/comments").status_code == 404
+    response = client.get("/api/person/Nobody At All")
+    assert response.status_code == 404
+    assert response.get_json() == {"error": "Person does not exist"}
+    assert client.get("/api/films?limit=all").status_code == 400
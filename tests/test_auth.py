@@ -8,6 +8,7 @@ from app.database import get_db
 from flask import current_app
 from flask.app import Flask
 from flask.testing import FlaskClient
+from tests.conftest import AuthedClient
 
 
 def test_auth_page(client: FlaskClient):
@@ -151,3 +152,90 @@ def test_register_login_mixed_case(
         ).fetchone()
 
         assert not sess_row
+
+
+def test_session_cache(auth_client: AuthedClient, app: Flask):
+    """
+    Checks that the session is looked up at most once per request, and that a logged
+    out session can't be used from the cache
+    """
+    app.config["EXPOSE_STATS"] = True
+    client = auth_client.client
+
+    def session_stats():
+        return client.get("/_stats/").json["caches"]["sessions"]
+
+    before = session_stats()
+    for _ in range(3):
+        assert auth_client.username in client.get("/").text
+    after = session_stats()
+    # Logging in emptied the cache, so only the first page view queried the db
+    assert after["misses"] - before["misses"] == 1
+    assert after["hits"] - before["hits"] == 2
+
+    # Requests without a session don't look anything up
+    assert app.test_client().get("/").status_code == 200
+    assert session_stats()["misses"] == after["misses"]
+
+    # Reusing the session cookie after logging out shouldn't log anyone in
+    cookie = next(cookie for cookie in client.cookie_jar if cookie.name == "session")
+    response = client.post("/auth/logout")
+    assert 300 <= response.status_code < 400
+    replay = app.test_client()
+    replay.set_cookie("localhost", "session", cookie.value)
+    assert auth_client.username not in replay.get("/").text
+
+
+def test_session_cache_other_worker(auth_client: AuthedClient, app: Flask):
+    """A session deleted by another worker shouldn't be used from this one's cache"""
+    client = auth_client.client
+    assert auth_client.username in client.get("/").text
+    assert auth_client.username in client.get("/").text
+
+    # Another worker logs the session out, so this worker's cache isn't told
+    with app.app_context():
+        db = get_db()
+        db.execute("delete from Sess where user_id_=?", [auth_client.user_id])
+        db.commit()
+    # The worker only notices once it rereads the session version
+    assert auth_client.username in client.get("/").text
+    app.config["SESSION_VERSION_SECONDS"] = 0
+    assert auth_client.username not in client.get("/").text
+
+
+def test_session_cache_no_queries(auth_client: AuthedClient, app: Flask):
+    """Pages for a cached session shouldn't query the db for it"""
+    app.config["EXPOSE_STATS"] = True
+    app.config["QUERY_STATS"] = True
+    client = auth_client.client
+    for _ in range(4):
+        assert auth_client.username in client.get("/auth/").text
+
+    # Only requests that made queries are counted, and only the first one looked the
+    # session up
+    queries = client.get("/_stats/").json["queries"]
+    assert queries["auth.auth_page"]["requests"] == 1
+
+
+def test_login_busy(auth_client: AuthedClient, app: Flask):
+    """Logins past the worker's limit should be told to retry, not kept waiting"""
+    app.config["EXPOSE_STATS"] = True
+    client = app.test_client()
+    gate = app.extensions["auth_gate"]
+    # Every slot is taken by logins on other threads
+    for _ in range(gate.limit):
+        assert gate.enter()
+
+    credentials = dict(username=auth_client.username, password=auth_client.pass_hash)
+    response = client.post("/auth/login", query_string=credentials)
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+    stats = client.get("/_stats/").json["auth"]
+    assert stats["in_flight"] == gate.limit and stats["rejected"] == 1
+
+    for _ in range(gate.limit):
+        gate.leave()
+    response = client.post("/auth/login", query_string=credentials)
+    assert 300 <= response.status_code < 400
+    stats = client.get("/_stats/").json["auth"]
+    assert stats["in_flight"] == 0 and stats["rejected"] == 1
@@ -0,0 +1,246 @@
+import multiprocessing
+import secrets
+from time import time
+
+import pytest
+from app import auth, authstate, create_app, database
+from flask import Flask, session
+from nacl.signing import SigningKey
+from tests.conftest import AuthedClient
+
+
+def make_app(db_path: str, backend: str) -> Flask:
+    return create_app(
+        {
+            "flask": {
+                "TESTING": True,
+                "DATABASE": db_path,
+                "SECRET_KEY": secrets.token_urlsafe(256 // 8),
+                "AUTH_STATE": backend,
+            }
+        }
+    )
+
+
+def sign(key: SigningKey, challenge: str) -> str:
+    return key.sign(challenge.encode()).hex()
+
+
+@pytest.mark.parametrize("backend", authstate.BACKENDS)
+def test_challenges(app: Flask, backend: str):
+    """Challenges should only be completed once, by their session, before they expire"""
+    app.extensions["auth_state"] = authstate.BACKENDS[backend]()
+    key = SigningKey.generate()
+    pub_key = key.verify_key.encode().hex()
+
+    with app.test_request_context():
+        session["sess_id"] = "sess_a"
+        challenge = auth.generate_challenge()
+        expired = auth.generate_challenge(time_lim=-1)
+    with app.test_request_context():
+        # Someone else can't complete it, or stop sess_a from completing it
+        session["sess_id"] = "sess_b"
+        assert not auth.complete_challenge(sign(key, challenge), pub_key)
+    with app.test_request_context():
+        session["sess_id"] = "sess_a"
+        assert not auth.complete_challenge(sign(key, expired), pub_key)
+        other_key = SigningKey.generate()
+        assert not auth.complete_challenge(sign(other_key, challenge), pub_key)
+        assert auth.complete_challenge(sign(key, challenge), pub_key)
+        assert not auth.complete_challenge(sign(key, challenge), pub_key)
+        assert not auth.complete_challenge(sign(key, "authchallenge_unknown"), pub_key)
+
+        # The expired one is still there until challenges are expired
+        assert authstate.get_state().expire_challenges() == 1
+        assert authstate.get_state().expire_challenges() == 0
+
+
+def issue_challenge(db_path: str, backend: str, sess_id: str, queue):
+    app = make_app(db_path, backend)
+    with app.test_request_context():
+        session["sess_id"] = sess_id
+        queue.put(auth.generate_challenge())
+
+
+def complete_challenges(db_path: str, backend: str, attempts: list, pub_key, queue):
+    app = make_app(db_path, backend)
+    results = []
+    for sess_id, signature in attempts:
+        with app.test_request_context():
+            session["sess_id"] = sess_id
+            results.append(auth.complete_challenge(signature, pub_key))
+    queue.put(results)
+
+
+@pytest.mark.parametrize(
+    "backend, completed",
+    [("sqlite", [False, True, False]), ("memory", [False, False, False])],
+)
+def test_challenge_across_processes(app: Flask, backend: str, completed: list):
+    """
+    A challenge issued by one worker process should be completed by another with the
+    sqlite backend, but not with the in-process one
+    """
+    db_path = app.config["DATABASE"]
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+
+    issuer = context.Process(
+        target=issue_challenge, args=(db_path, backend, "sess_a", queue)
+    )
+    issuer.start()
+    challenge = queue.get(timeout=60)
+    issuer.join()
+
+    key = SigningKey.generate()
+    signature = sign(key, challenge)
+    attempts = [("sess_b", signature), ("sess_a", signature), ("sess_a", signature)]
+    completer = context.Process(
+        target=complete_challenges,
+        args=(db_path, backend, attempts, key.verify_key.encode().hex(), queue),
+    )
+    completer.start()
+    assert queue.get(timeout=60) == completed
+    completer.join()
+
+
+def test_unknown_backend(tmp_path):
+    with pytest.raises(ValueError):
+        make_app(str(tmp_path / "db.sqlite"), "carrier pigeon")
+
+
+def test_incomplete_backend():
+    """A backend missing any of the operations should not be usable"""
+
+    class ChallengesOnly(authstate.AuthState):
+        def add_challenge(self, info):
+            pass
+
+    with pytest.raises(TypeError):
+        ChallengesOnly()
+
+
+def expire_session(app: Flask, user_id: str, column: str, seconds_ago: float):
+    """Backdates the user's session and drops it from the worker's cache"""
+    with app.app_context():
+        db = database.get_db()
+        db.execute(
+            f"update Sess set {column}=? where user_id_=?",
+            [time() - seconds_ago, user_id],
+        )
+        db.commit()
+    app.extensions["caches"]["sessions"].clear()
+
+
+@pytest.mark.parametrize("column", ["last_seen", "issued"])
+def test_session_expiry(auth_client: AuthedClient, app: Flask, column: str):
+    """Sessions idle for too long, or issued too long ago, should be logged out"""
+    app.config["SESSION_IDLE_SECONDS"] = 60
+    app.config["SESSION_MAX_SECONDS"] = 120
+    client = auth_client.client
+
+    expire_session(app, auth_client.user_id, column, 30)
+    assert auth_client.username in client.get("/").text
+    expire_session(app, auth_client.user_id, column, 150)
+    assert auth_client.username not in client.get("/").text
+
+
+def test_session_touch(auth_client: AuthedClient, app: Flask):
+    """Looking a session up should mark it as seen, but not on every request"""
+    app.config["SESSION_TOUCH_SECONDS"] = 60
+
+    def last_seen():
+        with app.app_context():
+            return (
+                database.get_db()
+                .execute(
+                    "select last_seen from Sess where user_id_=?", [auth_client.user_id]
+                )
+                .fetchone()[0]
+            )
+
+    expire_session(app, auth_client.user_id, "last_seen", 30)
+    seen = last_seen()
+    auth_client.client.get("/")
+    assert last_seen() == seen
+
+    expire_session(app, auth_client.user_id, "last_seen", 90)
+    auth_client.client.get("/")
+    assert last_seen() > time() - 5
+
+
+def test_sweep_sessions(auth_client: AuthedClient, app: Flask):
+    """Expired sessions and challenges should be deleted, leaving the live ones"""
+    with app.app_context():
+        db = database.get_db()
+        db.executemany(
+            "insert into Sess values(?, ?, ?, ?)",
+            [
+                (f"sess_{i}", auth_client.user_id, 0.0, time() if i % 2 else 0.0)
+                for i in range(1200)
+            ],
+        )
+        db.commit()
+        state = authstate.get_state()
+        state.add_challenge(authstate.ChallengeInfo("expired", "sess_0", time() - 1))
+
+    sweeper = authstate.SessionSweeper(app, 600, batch_size=500, pause=0)
+    assert sweeper.sweep() == 1200
+    assert state.challenge_stats()["outstanding"] == 0
+    assert sweeper.sweep() == 0
+    assert sweeper.stats()["swept"] == 1200
+    # The session the client logged in with is still there
+    assert auth_client.username in auth_client.client.get("/").text
+
+
+def test_challenge_store():
+    """Challenges expiring at the same time shouldn't collide, and expiry is lazy"""
+    store = authstate.ChallengeStore(capacity=100, per_session=100)
+    exp_time = time() + 60
+    for i in range(3):
+        store.add(authstate.ChallengeInfo(f"c{i}", "sess_a", exp_time))
+    assert len(store) == 3
+    assert store.expire(exp_time - 1) == 0
+    assert store.expire(exp_time, limit=2) == 2
+    assert store.expire(exp_time) == 1
+
+    # Completed challenges don't pile up in the heap
+    for i in range(1000):
+        store.add(authstate.ChallengeInfo(f"d{i}", "sess_a", time() + 60))
+        assert store.pop(f"d{i}", "sess_a")
+    assert len(store) == 0 and len(store.heap) <= 64
+    assert store.session_counts == {}
+
+
+@pytest.mark.parametrize("backend", authstate.BACKENDS)
+def test_challenge_limits(app: Flask, backend: str):
+    """Sessions and the whole store should only be able to hold so many challenges"""
+    app.extensions["auth_state"] = authstate.BACKENDS[backend](
+        capacity=4, per_session=2
+    )
+
+    def add(sess_id: str, time_lim: float = 30):
+        with app.test_request_context():
+            session["sess_id"] = sess_id
+            return auth.generate_challenge(time_lim)
+
+    add("sess_a")
+    add("sess_a", time_lim=-1)
+    # The expired one makes room for another
+    add("sess_a")
+    with pytest.raises(authstate.ChallengeLimitError):
+        add("sess_a")
+
+    challenge = add("sess_b")
+    add("sess_b")
+    with pytest.raises(authstate.ChallengeLimitError):
+        add("sess_c")
+
+    # Completing one makes room for another
+    with app.test_request_context():
+        assert authstate.get_state().pop_challenge(challenge, "sess_b")
+    add("sess_c")
+
+    with app.app_context():
+        stats = authstate.get_state().challenge_stats()
+        assert stats["outstanding"] == 4 and stats["rejected"] == 2
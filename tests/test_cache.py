@@ -0,0 +1,93 @@
+from app import cache
+from app.cache import LRUCache
+from flask import Flask
+from tests.conftest import AuthedClient
+
+
+def test_lru_eviction():
+    """The least recently used entries should be evicted past either limit"""
+    cache = LRUCache(max_entries=2, max_bytes=100)
+    cache.set("a", "a", size=10)
+    cache.set("b", "b", size=10)
+    assert cache.get("a") == "a"
+    cache.set("c", "c", size=10)
+    assert cache.get("b") is None
+    assert cache.get("a") == "a" and cache.get("c") == "c"
+
+    # Too big for what is left, so both a and c have to go
+    cache.set("d", "d", size=95)
+    assert cache.get("a") is None and cache.get("c") is None
+    assert cache.get("d") == "d"
+    # Too big for the whole cache
+    cache.set("e", "e", size=101)
+    assert cache.get("e") is None
+
+    stats = cache.stats()
+    assert stats["entries"] == 1 and stats["bytes"] == 95
+    assert stats["evictions"] == 3
+    assert stats["hits"] == 4 and stats["misses"] == 4
+
+
+def test_lru_generation():
+    """A value loaded before an invalidation shouldn't be stored after it"""
+    cache = LRUCache(max_entries=2, max_bytes=100)
+    generation = cache.generation
+    cache.pop("a")
+    cache.set("a", "stale", generation=generation)
+    assert cache.get("a") is None
+    cache.set("a", "fresh", generation=cache.generation)
+    assert cache.get("a") == "fresh"
+
+
+def test_film_page_cache(auth_client: AuthedClient, app: Flask):
+    """Cached film pages should still show comments as soon as they change"""
+    app.config["EXPOSE_STATS"] = True
+    client = auth_client.client
+
+    assert client.get("/film/s633").status_code == 200
+    response = client.post("/film/s633/comment", data={"comment": "Love this show!"})
+    assert response.status_code == 302
+    response = client.get("/film/s633")
+    assert "Avatar: The Last Airbender" in response.text
+    assert "Love this show!" in response.text
+
+    comment_id = response.html.select_one(".comment")["id"][len("comment_") :]
+    response = client.post(
+        f"/film/s633/comment/{comment_id}/edit",
+        data={"comment": "Love this show a lot!"},
+    )
+    assert response.status_code == 302
+    response = client.get("/film/s633")
+    assert "Love this show a lot!" in response.text
+
+    response = client.post(f"/film/s633/comment/{comment_id}/delete")
+    assert response.status_code == 302
+    response = client.get("/film/s633")
+    assert "Love this show" not in response.text
+    assert "Avatar: The Last Airbender" in response.text
+
+    caches = client.get("/_stats/").json["caches"]
+    assert caches["film_pages"] == {
+        **caches["film_pages"],
+        "entries": 1,
+        "hits": 3,
+        "misses": 1,
+    }
+    assert caches["film_comments"]["invalidations"] == 3
+    assert caches["film_comments"]["misses"] == 4
+
+
+def test_lru_ttl(monkeypatch):
+    """Entries older than the ttl should be treated as missing"""
+    clock = [100.0]
+    monkeypatch.setattr(cache, "monotonic", lambda: clock[0])
+    lru = LRUCache(max_entries=2, max_bytes=100, ttl=10)
+    lru.set("a", "a", size=10)
+    clock[0] += 9
+    assert lru.get("a") == "a"
+    clock[0] += 1
+    assert lru.get("a") is None
+
+    stats = lru.stats()
+    assert stats["entries"] == 0 and stats["bytes"] == 0
+    assert stats["expirations"] == 1 and stats["misses"] == 1
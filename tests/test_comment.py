@@ -1,4 +1,5 @@
 from flask import Flask
+from flask.testing import FlaskClient
 from app.database import get_db
 from tests.conftest import AuthedClient
 
@@ -111,3 +112,50 @@ def test_edit_comment_page(auth_client: AuthedClient, app: Flask):
     assert "Love this show a lot!" in response.text
 
 
+def test_comment_pages(auth_client: AuthedClient, app: Flask):
+    """
+    Follows the load more links on the film and user pages and checks that every
+    comment is shown exactly once, newest first, and that the counts are right.
+    """
+    client = auth_client.client
+    for i in range(45):
+        response = client.post("/film/s633/comment", data={"comment": f"Comment {i}"})
+        assert response.status_code == 302
+    response = client.post("/film/s5071/comment", data={"comment": "Another film"})
+    assert response.status_code == 302
+
+    with app.app_context():
+        db = get_db()
+        comment_id = db.execute(
+            "select comment_id from Comment where body = 'Comment 0'"
+        ).fetchone()["comment_id"]
+    response = client.post(f"/film/s633/comment/{comment_id}/delete")
+    assert response.status_code == 302
+
+    for url, count in [("/film/s633", 44), (f"/user/{auth_client.user_id}", 45)]:
+        response = client.get(url)
+        assert response.status_code == 200
+        assert f"Comments ({count})" in response.text
+
+        bodies = []
+        while True:
+            bodies += [
+                body.text.strip() for body in response.html.select(".commentbody")
+            ]
+            more = response.html.select_one(".load-more-comments a")
+            if not more:
+                break
+            response = client.get(more["href"])
+            assert response.status_code == 200
+            # Only the comments are rendered
+            assert "<html" not in response.text
+
+        expected = [f"Comment {i}" for i in range(44, 0, -1)]
+        if url.startswith("/user"):
+            expected.insert(0, "Another film")
+        assert bodies == expected
+
+
+def test_bad_comment_page_token(client: FlaskClient):
+    assert client.get("/film/s633/comments?before=nonsense").status_code == 400
+    assert client.get("/user/someone/comments?before=W10").status_code == 400
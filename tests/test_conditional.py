@@ -0,0 +1,110 @@
+from urllib.parse import quote_plus
+
+from flask import Flask, g
+from flask.testing import FlaskClient
+from tests.conftest import AuthedClient
+
+
+def test_not_modified(client: FlaskClient):
+    """Pages should answer conditional requests for their current version with 304s"""
+    for url in [
+        "/",
+        "/?sort=title",
+        "/film/s633",
+        f"/person/{quote_plus('Quentin Tarantino')}",
+    ]:
+        response = client.get(url)
+        assert response.status_code == 200
+        etag = response.headers["ETag"]
+        last_modified = response.headers["Last-Modified"]
+        assert "Cookie" in response.vary
+        assert response.cache_control.public and response.cache_control.no_cache
+
+        response = client.get(url, headers={"If-None-Match": etag})
+        assert response.status_code == 304, url
+        assert not response.data
+        assert response.headers["ETag"] == etag
+
+        response = client.get(url, headers={"If-Modified-Since": last_modified})
+        assert response.status_code == 304, url
+
+        response = client.get(url, headers={"If-None-Match": '"stale"'})
+        assert response.status_code == 200, url
+
+
+def test_missing_not_modified(client: FlaskClient):
+    """Missing films, users and people should be a 404 whatever the client has"""
+    # A film without comments has the same validators a missing film would have
+    etag = client.get("/film/s5071").headers["ETag"]
+    for url in [
+        "/film/s999999",
+        "/api/films/s999999",
+        "/api/films/s999999/comments",
+        "/user/userid_missing",
+        "/person/Nobody+At+All",
+        "/api/person/Nobody+At+All",
+    ]:
+        for headers in [{"If-None-Match": etag}, {"If-None-Match": "*"}]:
+            assert client.get(url, headers=headers).status_code == 404, url
+
+
+def test_not_modified_skips_queries(client: FlaskClient, app: Flask):
+    """A 304 shouldn't query the film or render the page"""
+    etag = client.get("/film/s633").headers["ETag"]
+
+    app.config["QUERY_STATS"] = True
+    statements = []
+
+    @app.after_request
+    def record(response):
+        statements.extend(g.query_stats.statements if "query_stats" in g else [])
+        return response
+
+    response = client.get("/film/s633", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert not any("json_group_array" in statement.sql for statement in statements)
+
+
+def test_comments_change_etag(auth_client: AuthedClient, client: FlaskClient):
+    """Commenting should change the ETags of the film's and the author's pages"""
+    film_etag = client.get("/film/s633").headers["ETag"]
+    user_url = f"/user/{auth_client.user_id}"
+    user_etag = client.get(user_url).headers["ETag"]
+
+    response = auth_client.client.post(
+        "/film/s633/comment", data={"comment": "Love this show!"}
+    )
+    assert response.status_code == 302
+
+    response = client.get("/film/s633", headers={"If-None-Match": film_etag})
+    assert response.status_code == 200
+    assert "Love this show!" in response.text
+    response = client.get(user_url, headers={"If-None-Match": user_etag})
+    assert response.status_code == 200
+    assert "Love this show!" in response.text
+    # Other films are unaffected
+    etag = client.get("/film/s5071").headers["ETag"]
+    assert client.get("/film/s5071", headers={"If-None-Match": etag}).status_code == 304
+
+
+def test_logged_in_etag(auth_client: AuthedClient, client: FlaskClient):
+    """Logged in users should get their own private version of each page"""
+    anonymous = client.get("/film/s633")
+    response = auth_client.client.get("/film/s633")
+    assert response.headers["ETag"] != anonymous.headers["ETag"]
+    assert response.cache_control.private and not response.cache_control.public
+    assert not response.last_modified
+
+    response = auth_client.client.get(
+        "/film/s633",
+        headers={
+            "If-None-Match": anonymous.headers["ETag"],
+            "If-Modified-Since": anonymous.headers["Last-Modified"],
+        },
+    )
+    assert response.status_code == 200
+    assert auth_client.username in response.text
+
+    etag = response.headers["ETag"]
+    response = auth_client.client.get("/film/s633", headers={"If-None-Match": etag})
+    assert response.status_code == 304
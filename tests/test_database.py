@@ -0,0 +1,603 @@
+import gc
+import os
+import sqlite3
+import threading
+from urllib.parse import quote_plus
+
+import pandas as pd
+import populate_db
+import pytest
+from flask import Flask, g
+from flask.testing import FlaskClient
+
+from app import create_app, database, facets, film, migrations
+from tests.conftest import AuthedClient
+
+
+def test_incremental_init_keeps_comments(auth_client: AuthedClient, app: Flask):
+    """Re-initializing incrementally should keep the users and their comments"""
+    response = auth_client.client.post(
+        "/film/s633/comment", data={"comment": "Love this show!"}
+    )
+    assert response.status_code == 302
+
+    with app.app_context():
+        db = database.get_db()
+        n_films = db.execute("select count(*) from Film").fetchone()[0]
+
+        database.init_db(incremental=True)
+
+        # Nothing changed in the csv, so the catalog is the same
+        assert db.execute("select count(*) from Film").fetchone()[0] == n_films
+        # And the user and their comment are still there
+        user_row = db.execute(
+            "select * from User where user_id_=?", [auth_client.user_id]
+        ).fetchone()
+        assert user_row
+        comment_row = db.execute(
+            "select * from Comment where body=?", ["Love this show!"]
+        ).fetchone()
+        assert comment_row
+
+
+def test_snapshot(app: Flask, tmp_path):
+    """An app started from a snapshot should serve the catalog without importing"""
+    with app.app_context():
+        snapshot_path = database.build_snapshot(out_dir=str(tmp_path))
+
+    snapshot_app = create_app(
+        {
+            "flask": {"TESTING": True, "DATABASE": str(tmp_path / "served.sqlite")},
+            "snapshot": snapshot_path,
+        }
+    )
+    response = snapshot_app.test_client().get("/film/s633")
+    assert response.status_code == 200
+    assert "Avatar: The Last Airbender" in response.text
+
+
+def test_snapshot_newer(app: Flask, tmp_path):
+    """A newer snapshot should be copied over the served one, keeping the users"""
+    csv = pd.read_csv("netflix_titles.csv")
+    csv.loc[csv["show_id"] == "s633", "title"] = "Avatar: The Legend of Korra"
+    csv.to_csv(tmp_path / "newer.csv", index=False)
+    with app.app_context():
+        old_snapshot = database.build_snapshot(out_dir=str(tmp_path / "old"))
+        new_snapshot = database.build_snapshot(
+            str(tmp_path / "newer.csv"), out_dir=str(tmp_path / "new")
+        )
+
+    db_path = str(tmp_path / "served.sqlite")
+
+    def serve(snapshot_path):
+        snapshot_app = create_app(
+            {"flask": {"TESTING": True, "DATABASE": db_path}, "snapshot": snapshot_path}
+        )
+        return snapshot_app, snapshot_app.test_client()
+
+    old_app, client = serve(old_snapshot)
+    response = client.post(
+        "/auth/register",
+        query_string=dict(username="test_user", password="YmFkcGFzc3dvcmQ="),
+    )
+    assert response.status_code == 200
+    database.close_pools(old_app)
+
+    new_app, client = serve(new_snapshot)
+    assert "Avatar: The Legend of Korra" in client.get("/film/s633").text
+    with new_app.app_context():
+        db = database.get_db()
+        assert db.execute("select count(*) from User").fetchone()[0] == 1
+    database.close_pools(new_app)
+    # Nothing is left behind by the copy
+    assert sorted(os.listdir(tmp_path)) == ["new", "newer.csv", "old", "served.sqlite"]
+
+    # The same snapshot again is already being served, so it isn't copied
+    inode = os.stat(db_path).st_ino
+    serve(new_snapshot)
+    assert os.stat(db_path).st_ino == inode
+
+
+def test_snapshot_attach(app: Flask, tmp_path):
+    """Serving from the snapshot file should keep the user tables out of it"""
+    with app.app_context():
+        snapshot_path = database.build_snapshot(out_dir=str(tmp_path))
+
+    with pytest.raises(ValueError):
+        create_app(
+            {
+                "flask": {"TESTING": True, "DATABASE": str(tmp_path / "unused")},
+                "snapshot": snapshot_path,
+                "snapshot_mode": "attach",
+            }
+        )
+
+    user_db_path = str(tmp_path / "userdata.sqlite")
+    snapshot_app = create_app(
+        {
+            "flask": {
+                "TESTING": True,
+                "DATABASE": str(tmp_path / "unused"),
+                "USER_DATABASE": user_db_path,
+            },
+            "snapshot": snapshot_path,
+            "snapshot_mode": "attach",
+        }
+    )
+    response = snapshot_app.test_client().post(
+        "/auth/register",
+        query_string=dict(username="test_user", password="YmFkcGFzc3dvcmQ="),
+    )
+    assert response.status_code == 200
+
+    snapshot = sqlite3.connect(snapshot_path)
+    tables = {row[0] for row in snapshot.execute("select name from sqlite_master")}
+    snapshot.close()
+    assert not tables & set(database.USER_TABLES)
+    user_db = sqlite3.connect(user_db_path)
+    assert user_db.execute("select count(*) from User").fetchone()[0] == 1
+    user_db.close()
+
+
+def test_refresh_catalog(auth_client: AuthedClient, app: Flask):
+    """Refreshing the catalog should swap it in place and keep the comments"""
+    response = auth_client.client.post(
+        "/film/s633/comment", data={"comment": "Love this show!"}
+    )
+    assert response.status_code == 302
+
+    with app.app_context():
+        # Without USER_DATABASE, the user tables can only be copied offline
+        with pytest.raises(database.CatalogRefreshError):
+            database.refresh_catalog()
+        catalog_path = database.refresh_catalog(offline=True)
+        assert os.path.realpath(app.config["DATABASE"]) == catalog_path
+
+    # Connections opened before the refresh aren't handed out again
+    with app.app_context():
+        files = database.get_db().execute("pragma database_list").fetchall()
+        assert files[0][2] == catalog_path
+
+    # The new catalog is served and the comment was carried over to it
+    response = auth_client.client.get("/film/s633")
+    assert response.status_code == 200
+    assert "Avatar: The Last Airbender" in response.text
+    assert "Love this show!" in response.text
+
+    # Clean up the catalog file, the fixture only removes the symlink
+    os.unlink(catalog_path)
+
+
+def test_refresh_catalog_user_database(tmp_path):
+    """With USER_DATABASE, refreshing the catalog should not touch the user tables"""
+    app = create_app(
+        {
+            "flask": {
+                "TESTING": True,
+                "DATABASE": str(tmp_path / "catalog.sqlite"),
+                "USER_DATABASE": str(tmp_path / "users.sqlite"),
+            }
+        }
+    )
+    with app.app_context():
+        database.init_db()
+        db = database.get_db()
+        db.execute("insert into User values('userid_test', 'test', 'abcd', 'abcd')")
+        db.commit()
+
+    with app.app_context():
+        database.refresh_catalog()
+        db = database.get_db()
+        assert db.execute("select * from User where user_id_='userid_test'").fetchone()
+        # The catalog file has no user tables of its own
+        assert not db.execute(
+            "select * from main.sqlite_master where name='User'"
+        ).fetchone()
+
+
+def test_init_db_fake_data_once(tmp_path):
+    """Restarting with testing on shouldn't add more fake users and comments"""
+    config = {
+        "flask": {
+            "TESTING": True,
+            "DATABASE": str(tmp_path / "catalog.sqlite"),
+            "USER_DATABASE": str(tmp_path / "users.sqlite"),
+        },
+        "init_db": True,
+        "testing": True,
+    }
+    counts = []
+    for _ in range(2):
+        with create_app(config).app_context():
+            db = database.get_db()
+            counts.append(
+                db.execute(
+                    "select (select count(*) from User), (select count(*) from Comment)"
+                ).fetchone()[:]
+            )
+    assert counts[0][0] and counts[0][1]
+    assert counts[1] == counts[0]
+
+
+def test_refresh_catalog_wal(tmp_path):
+    """The first refresh shouldn't leave the replaced file's WAL files behind"""
+    db_path = str(tmp_path / "catalog.sqlite")
+    app = create_app(
+        {
+            "flask": {
+                "TESTING": True,
+                "DATABASE": db_path,
+                "USER_DATABASE": str(tmp_path / "users.sqlite"),
+                "SQLITE_PROFILE": "performance",
+            }
+        }
+    )
+    with app.app_context():
+        database.init_db()
+    assert os.path.exists(f"{db_path}-wal")
+
+    with app.app_context():
+        catalog_path = database.refresh_catalog()
+    assert os.path.islink(db_path)
+    assert os.path.exists(catalog_path)
+    assert not os.path.exists(f"{db_path}-wal")
+    assert not os.path.exists(f"{db_path}-shm")
+
+
+def test_connection_pool(app: Flask):
+    """Connections should be returned to the pool and reused by the next request"""
+    with app.app_context():
+        first = database.get_db()
+        # Leave a transaction open, it should be rolled back when it is returned
+        first.execute("insert into User values('userid_test', 'test', 'abcd', 'abcd')")
+
+    with app.app_context():
+        second = database.get_db()
+        assert second is first
+        assert not second.in_transaction
+        assert not second.execute(
+            "select * from User where user_id_='userid_test'"
+        ).fetchone()
+
+
+def test_no_connections_before_fork(app: Flask):
+    """Workers forked from a started app shouldn't inherit any open connections"""
+    # Warming the indexes at startup opens connections from both pools
+    started = create_app(
+        {"flask": {"TESTING": True, "DATABASE": app.config["DATABASE"]}, "warm": True}
+    )
+    for pool in started.extensions["sqlite_pool"].values():
+        assert len(pool.idle_lists)
+        assert not any(pool.idle_lists)
+
+    with started.app_context():
+        db = database.get_db()
+    database.close_pools(started)
+    with pytest.raises(sqlite3.ProgrammingError):
+        db.execute("select 1")
+
+
+def test_pool_threads(app: Flask):
+    """The connections of threads that have finished shouldn't be kept open"""
+
+    def request():
+        with app.app_context():
+            database.get_db().execute("select 1").fetchone()
+
+    for _ in range(50):
+        thread = threading.Thread(target=request)
+        thread.start()
+        thread.join()
+    gc.collect()
+    assert len(app.extensions["sqlite_pool"]["readwrite"].idle_lists) <= 1
+
+
+def test_pool_catalog_recheck(app: Flask, monkeypatch):
+    """The pool should only check for a swapped catalog every recheck_seconds"""
+    reads = []
+
+    def read_catalog_key(key):
+        reads.append(key)
+        return key
+
+    monkeypatch.setattr(
+        database.ConnectionPool,
+        "read_catalog_key",
+        staticmethod(lambda: read_catalog_key("old")),
+    )
+    pool = database.ConnectionPool(recheck_seconds=60)
+    with app.app_context():
+        db = pool.acquire()
+        for _ in range(10):
+            pool.release(db)
+            assert pool.acquire() is db
+        assert reads == ["old"]
+
+        # A catalog swapped in by this worker is used by the next acquire
+        pool.release(db)
+        pool.forget_catalog_key()
+        monkeypatch.setattr(
+            database.ConnectionPool,
+            "read_catalog_key",
+            staticmethod(lambda: read_catalog_key("new")),
+        )
+        new_db = pool.acquire()
+        assert new_db is not db and reads == ["old", "new"]
+        pool.release(new_db)
+
+    with pytest.raises(sqlite3.ProgrammingError):
+        db.execute("select 1")
+
+
+def test_performance_profile(tmp_path):
+    """The pragmas from the configured profile should be set on every connection"""
+    app = create_app(
+        {
+            "flask": {
+                "TESTING": True,
+                "DATABASE": str(tmp_path / "catalog.sqlite"),
+                "USER_DATABASE": str(tmp_path / "users.sqlite"),
+                "SQLITE_PROFILE": "performance",
+            }
+        }
+    )
+    profile = database.SQLITE_PROFILES["performance"]
+    with app.app_context():
+        database.init_db()
+        for readonly in (False, True):
+            db = database.get_db(readonly=readonly)
+            for schema in ("main", "userdata"):
+
+                def pragma(name):
+                    return db.execute(f"pragma {schema}.{name}").fetchone()[0]
+
+                assert pragma("journal_mode") == "wal"
+                # 1 is NORMAL
+                assert pragma("synchronous") == 1
+                assert pragma("mmap_size") == profile["mmap_size"]
+                assert pragma("cache_size") == profile["cache_size"]
+            # 2 is MEMORY
+            assert db.execute("pragma temp_store").fetchone()[0] == 2
+            assert db.execute("pragma busy_timeout").fetchone()[0] == 5000
+
+        # The read-only connection is separate and can't write
+        readonly_db = database.get_db(readonly=True)
+        assert readonly_db is not database.get_db()
+        with pytest.raises(sqlite3.OperationalError):
+            readonly_db.execute(
+                "insert into User values('userid_test', 'test', 'abcd', 'abcd')"
+            )
+
+
+def record_route_queries(app: Flask) -> list:
+    """Turns on QUERY_STATS and collects every statement executed by a request"""
+    app.config["QUERY_STATS"] = True
+    statements = []
+
+    @app.after_request
+    def record(response):
+        statements.extend(g.query_stats.statements if "query_stats" in g else [])
+        return response
+
+    return statements
+
+
+def test_route_queries_use_indexes(auth_client: AuthedClient, app: Flask):
+    """None of the queries made by the routes should scan a whole table"""
+    # Building the facet index reads the whole catalog, but only once, at startup
+    with app.app_context():
+        facets.warm()
+    statements = record_route_queries(app)
+    client = auth_client.client
+
+    response = client.post("/film/s633/comment", data={"comment": "Love this show!"})
+    assert response.status_code == 302
+    for url in [
+        "/?sort=feature",
+        "/?sort=title",
+        "/?sort=release_year",
+        "/?sort=title&genre=Dramas&type=Movie&year_from=2000",
+        "/?sort=title&after="
+        + film.page_token("title", {"title": "M", "film_id": "s1"}),
+        "/film/s633",
+        f"/person/{quote_plus('Quentin Tarantino')}",
+        f"/user/{auth_client.user_id}",
+        "/film/s633/comments?before=" + film.encode_token(["9999", "x"]),
+        f"/user/{auth_client.user_id}/comments?before="
+        + film.encode_token(["9999", "x"]),
+        "/search/?q=love stor",
+        "/search/json?q=Tarantino",
+        "/api/films?after=s1&limit=10",
+        "/api/films/s633",
+        "/api/films/s633/comments",
+        f"/api/person/{quote_plus('Quentin Tarantino')}",
+    ]:
+        assert client.get(url).status_code == 200
+    assert statements
+
+    with app.app_context():
+        db = database.get_db()
+        for statement in statements:
+            assert not migrations.full_table_scans(
+                db, statement.sql, statement.params
+            ), statement.sql
+
+
+def test_server_timing(client: FlaskClient, app: Flask):
+    """Query stats should be added to the response and to /_stats/"""
+    app.config.update(QUERY_STATS=True, SERVER_TIMING=True, EXPOSE_STATS=True)
+    response = client.get("/film/s633")
+    assert response.status_code == 200
+    assert response.headers["Server-Timing"].startswith("db;dur=")
+
+    response = client.get("/_stats/")
+    assert response.status_code == 200
+    assert response.json["queries"]["film.film_page"]["requests"] == 1
+    assert response.json["queries"]["film.film_page"]["queries"] >= 1
+
+
+def test_slow_query_log(auth_client: AuthedClient, app: Flask, caplog):
+    """Slow queries should be logged without the values of their parameters"""
+    app.config.update(QUERY_STATS=True, SLOW_QUERY_MS=0)
+    response = auth_client.client.get("/film/s633")
+    assert response.status_code == 200
+
+    messages = [record.getMessage() for record in caplog.records]
+    assert any(
+        message.startswith("Slow query on film.film_page") for message in messages
+    )
+    assert not any("s633" in message for message in messages)
+    assert not any(auth_client.user_id in message for message in messages)
+
+
+def test_migrations_applied(app: Flask):
+    """Every migration should have been applied to a freshly initialized database"""
+    with app.app_context():
+        db = database.get_db()
+        for component, component_migrations in migrations.MIGRATIONS.items():
+            assert migrations.schema_version(db, component) == len(component_migrations)
+
+
+def test_init_db_twice(app: Flask):
+    """Rebuilding the catalog in the same file should apply its migrations again"""
+    with app.app_context():
+        database.init_db()
+        db = database.get_db()
+        indexes = {
+            row[0]
+            for row in db.execute("select name from sqlite_master where type='index'")
+        }
+        for index in [
+            "Acted_person",
+            "Directed_person",
+            "Film_feature",
+            "Film_title",
+            "Film_release_year",
+        ]:
+            assert index in indexes
+        assert migrations.schema_version(db, "catalog") == len(
+            migrations.CATALOG_MIGRATIONS
+        )
+
+
+def test_ingest_stats(app: Flask, tmp_path):
+    """ingest should write every film and link and count the rows it wrote"""
+    db = sqlite3.connect(tmp_path / "ingest.sqlite")
+    with app.app_context():
+        db.executescript(database.read_script("query-create-database.sql"))
+    stats = populate_db.ingest("netflix_titles.csv", db)
+
+    tables = ["Film", "FilmFingerprint", *populate_db.LINK_COLUMNS.values()]
+    counts = {
+        table: db.execute(f"select count(*) from {table}").fetchone()[0]
+        for table in tables
+    }
+    assert stats.rows == sum(counts.values())
+    assert stats.films == counts["Film"] == counts["FilmFingerprint"]
+    assert stats.rows_per_sec > 0
+    # Quotes are stored as-is instead of being escaped by hand
+    assert db.execute("select 1 from Film where title like '%''%'").fetchone()
+    db.close()
+
+
+def test_sync(app: Flask, tmp_path):
+    """Syncing a changed csv should give the same catalog as importing it again"""
+    csv = pd.read_csv("netflix_titles.csv")
+    deleted_id = csv["show_id"].iloc[-1]
+    edited = csv["show_id"] == "s633"
+    csv.loc[edited, "title"] = "Avatar: The Legend of Korra"
+    csv.loc[edited, "cast"] = "Janet Varney, Mae Whitman"
+    added = csv[edited].assign(
+        show_id="s_new", title="Brand New Film", director="Nobody Else", cast=None
+    )
+    csv = pd.concat([csv[csv["show_id"] != deleted_id], added])
+    csv.to_csv(tmp_path / "changed.csv", index=False)
+
+    def create(name):
+        db = sqlite3.connect(tmp_path / name)
+        with app.app_context():
+            db.executescript(database.read_script("query-create-database.sql"))
+        return db
+
+    def dump(db):
+        tables = ["Film", "FilmFingerprint", *populate_db.LINK_COLUMNS.values()]
+        rows = {
+            table: sorted(db.execute(f"select * from {table}").fetchall())
+            for table in tables
+        }
+        rows["FilmSearch"] = sorted(
+            db.execute("select film_id, title, film_desc, people from FilmSearch")
+        )
+        rows["version"] = database.catalog_version(db)
+        return rows
+
+    def search(db, query):
+        rows = db.execute(
+            "select film_id from FilmSearch where FilmSearch match ?", [query]
+        )
+        return {row[0] for row in rows}
+
+    synced = create("synced.sqlite")
+    populate_db.ingest("netflix_titles.csv", synced)
+    old_version = database.catalog_version(synced)
+    stats = populate_db.sync(str(tmp_path / "changed.csv"), synced)
+    assert (stats.inserted, stats.updated, stats.deleted) == (1, 1, 1)
+    assert stats.unchanged == len(csv) - 2
+
+    assert database.catalog_version(synced) != old_version
+    film_ids = {row[0] for row in synced.execute("select film_id from Film")}
+    assert "s_new" in film_ids and deleted_id not in film_ids
+    cast = synced.execute("select person_name from Acted where film_id = 's633'")
+    assert sorted(row[0] for row in cast) == ["Janet Varney", "Mae Whitman"]
+    assert not synced.execute("select * from Acted where film_id = 's_new'").fetchall()
+    assert synced.execute(
+        "select person_name from Directed where film_id = 's_new'"
+    ).fetchall() == [("Nobody Else",)]
+    for table in populate_db.LINK_COLUMNS.values():
+        links = synced.execute(f"select * from {table} where film_id = ?", [deleted_id])
+        assert not links.fetchall()
+    assert search(synced, "title: korra") == {"s633"}
+    assert not search(synced, "title: airbender")
+    assert search(synced, "janet") == {"s633"}
+    assert search(synced, "nobody") == {"s_new"}
+
+    # Everything matches a fresh import of the changed csv
+    fresh = create("fresh.sqlite")
+    populate_db.ingest(str(tmp_path / "changed.csv"), fresh)
+    assert dump(synced) == dump(fresh)
+
+    # Syncing the same csv again changes nothing
+    stats = populate_db.sync(str(tmp_path / "changed.csv"), synced)
+    assert (stats.inserted, stats.updated, stats.deleted) == (0, 0, 0)
+    assert dump(synced) == dump(fresh)
+    synced.close()
+    fresh.close()
+
+
+def test_ingest_workers(app: Flask, tmp_path):
+    """Parsing the csv in worker processes should give the same database"""
+
+    def dump(workers, chunk_size):
+        db = sqlite3.connect(tmp_path / f"ingest_{workers}.sqlite")
+        with app.app_context():
+            db.executescript(database.read_script("query-create-database.sql"))
+        populate_db.ingest(
+            "netflix_titles.csv", db, chunk_size=chunk_size, workers=workers
+        )
+        tables = [
+            "Film",
+            "FilmFingerprint",
+            "FilmSearch",
+            *populate_db.LINK_COLUMNS.values(),
+        ]
+        rows = {
+            table: db.execute(f"select rowid, * from {table} order by rowid").fetchall()
+            for table in tables
+        }
+        db.close()
+        return rows
+
+    serial = dump(workers=None, chunk_size=populate_db.CHUNK_SIZE)
+    parallel = dump(workers=4, chunk_size=50)
+    assert serial["Film"]
+    assert parallel == serial
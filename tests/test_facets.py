@@ -0,0 +1,112 @@
+import pytest
+from app import database, facets
+from app.facets import Filters
+from flask import Flask
+from flask.testing import FlaskClient
+
+FILTERS = [
+    {"type": ["Movie"]},
+    {"genre": ["Dramas", "Comedies"], "country": ["United States"]},
+    {"type": ["TV Show"], "rating": ["TV-MA", "TV-14"], "year_from": 2015},
+    {"year_from": 1990, "year_to": 2005},
+]
+
+
+def expected_films(db, order: str, filters: dict) -> list:
+    """Gets the film ids matching the filters with sql"""
+    where = ["1"]
+    params = []
+    for facet, sql in [
+        ("type", "film_type in ({})"),
+        ("rating", "rating in ({})"),
+        ("genre", "film_id in (select film_id from Listed where genre_name in ({}))"),
+        (
+            "country",
+            "film_id in (select film_id from Produced where country_name in ({}))",
+        ),
+    ]:
+        if facet in filters:
+            where.append(sql.format(", ".join("?" * len(filters[facet]))))
+            params += filters[facet]
+    if "year_from" in filters:
+        where.append("release_year >= ?")
+        params.append(filters["year_from"])
+    if "year_to" in filters:
+        where.append("release_year <= ?")
+        params.append(filters["year_to"])
+    return [
+        row[0]
+        for row in db.execute(
+            f"select film_id from Film where {' and '.join(where)} "
+            f"order by {order}, film_id",
+            params,
+        )
+    ]
+
+
+def test_set_bits():
+    bitmap = facets.make_bitmap([0, 3, 8, 9, 100])
+    assert list(facets.set_bits(bitmap)) == [0, 3, 8, 9, 100]
+    assert list(facets.set_bits(bitmap, 4)) == [8, 9, 100]
+    assert list(facets.set_bits(bitmap, 9)) == [9, 100]
+    assert list(facets.set_bits(0)) == []
+
+
+@pytest.mark.parametrize("filters", FILTERS)
+@pytest.mark.parametrize("sort", ["feature", "title", "release_year"])
+def test_filtered_pages(client: FlaskClient, app: Flask, sort: str, filters: dict):
+    """Paging through filtered results should list the same films as sql"""
+    with app.app_context():
+        expected = expected_films(database.get_db(), sort, filters)
+    assert expected
+
+    film_ids = []
+    response = client.get("/", query_string={"sort": sort, **filters})
+    while True:
+        assert response.status_code == 200
+        film_ids += [
+            link["href"].split("/")[-1] for link in response.html.select(".filmtile a")
+        ]
+        next_link = response.html.find("a", string="Next page")
+        if not next_link:
+            break
+        response = client.get(next_link["href"])
+    assert film_ids == expected
+
+
+def test_facet_counts(app: Flask):
+    """Each value's count should be the number of films matching if it were picked"""
+    filters = {"type": ["Movie"], "genre": ["Dramas"]}
+    with app.test_request_context():
+        db = database.get_db()
+        index = facets.get_index(db, database.catalog_version(db))
+        counts = index.facet_counts(Filters(filters))
+
+        expected = expected_films(db, "title", filters)
+        assert index.count(Filters(filters)) == len(expected)
+        for value, count in counts["genre"].items():
+            # A genre's count is for picking it instead of Dramas
+            picked = {**filters, "genre": [value]}
+            assert count == len(expected_films(db, "title", picked))
+        for value, count in counts["country"].items():
+            picked = {**filters, "country": [value]}
+            assert count == len(expected_films(db, "title", picked))
+
+
+def test_index_rebuilt(app: Flask):
+    """The index should be rebuilt when the catalog version changes"""
+    with app.test_request_context():
+        db = database.get_db()
+        holder = app.extensions["facet_index"]
+        index = facets.get_index(db, "a")
+        assert facets.get_index(db, "a") is index
+        assert facets.get_index(db, "b") is not index
+        assert holder.stats()["builds"] >= 2
+
+
+def test_bad_filters(client: FlaskClient):
+    assert client.get("/?year_from=recent").status_code == 400
+    assert client.get("/?sort=feature&type=Movie&after=nonsense").status_code == 400
+    response = client.get("/?genre=Not a genre")
+    assert response.status_code == 200
+    assert not response.html.select(".filmtile")
@@ -1,5 +1,9 @@
+from app import film
+from flask import Flask
 from flask.testing import FlaskClient
 
+from tests.conftest import AuthedClient
+
 
 def test_tv_page(client: FlaskClient):
     """Checks the info on a tv show's page"""
@@ -25,3 +29,25 @@ def test_movie_page(client: FlaskClient):
     assert "Movie" in content
     assert "Bonnie Hunt" in content and "Lucinda Jenney" in content
     assert "Barry Levinson" in content
+
+
+def test_film_details(auth_client: AuthedClient, app: Flask):
+    """The batch query should return the same details as fetching films one by one"""
+    response = auth_client.client.post(
+        "/film/s633/comment", data={"comment": "Love this show!"}
+    )
+    assert response.status_code == 302
+
+    with app.test_request_context():
+        details = film.get_film_details(["s633", "s5071", "s0"])
+        assert set(details) == {"s633", "s5071"}
+        for film_id, detail in details.items():
+            assert film.get_film_detail(film_id) == detail
+        assert film.get_film_detail("s0") is None
+
+        avatar = details["s633"]
+        assert avatar.film_row["title"] == "Avatar: The Last Airbender"
+        assert "Dante Basco" in avatar.cast
+        assert [comment["body"] for comment in avatar.comments] == ["Love this show!"]
+        assert avatar.comments[0]["username"] == auth_client.username
+        assert "Barry Levinson" in details["s5071"].directors
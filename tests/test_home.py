@@ -1,5 +1,7 @@
 import pytest
 
+from app import database
+from flask import Flask
 from flask.testing import FlaskClient
 
 
@@ -64,3 +66,39 @@ def test_improper_sorting(client: FlaskClient, sort):
     """Checks that requesting an invalid sorting method returns a 400"""
     response = client.get("/", query_string={"sort": sort})
     assert response.status_code == 400
+
+
+@pytest.mark.parametrize("sort", ["feature", "title", "release_year"])
+def test_pagination(client: FlaskClient, app: Flask, sort: str):
+    """
+    Follows the next page links from the first page to the last and checks that
+    every film is listed exactly once, in order.
+    """
+    with app.app_context():
+        db = database.get_db()
+        expected = [
+            row["film_id"]
+            for row in db.execute(f"select film_id from Film order by {sort}, film_id")
+        ]
+
+    film_ids = []
+    url = f"/?sort={sort}"
+    while url:
+        response = client.get(url)
+        assert response.status_code == 200
+        film_ids += [
+            link["href"].split("/")[-1] for link in response.html.select(".filmtile a")
+        ]
+        next_link = response.html.find("a", string="Next page")
+        url = next_link["href"] if next_link else None
+    assert len(expected) > 50
+    assert film_ids == expected
+
+
+def test_bad_page_token(client: FlaskClient):
+    """Malformed tokens and tokens for another order should be rejected"""
+    first_page = client.get("/?sort=title")
+    after = first_page.html.find("a", string="Next page")["href"].split("after=")[1]
+    assert client.get(f"/?sort=title&after={after}").status_code == 200
+    assert client.get(f"/?sort=feature&after={after}").status_code == 400
+    assert client.get("/?sort=title&after=nonsense").status_code == 400
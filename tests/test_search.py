@@ -0,0 +1,127 @@
+from app import database, search
+from flask import Flask
+from flask.testing import FlaskClient
+
+
+def test_fts_query():
+    assert search.fts_query("star blu") == '"star" "blu"*'
+    assert search.fts_query("war* day 2") == '"war"* "day" "2"'
+    assert search.fts_query('"); drop table Film; --') == '"drop" "table" "Film"*'
+    assert search.fts_query(" -- ") is None
+
+
+def test_search_ranks_titles_first(client: FlaskClient, app: Flask):
+    with app.app_context():
+        db = database.get_db()
+        title = db.execute("select title from Film limit 1").fetchone()[0]
+    response = client.get("/search/json", query_string={"q": title, "limit": 5})
+    assert response.status_code == 200
+    results = response.get_json()["results"]
+    assert results
+    # The film with the exact title should beat films that only share some words
+    best = results[0]["title"].replace("<mark>", "").replace("</mark>", "")
+    assert best == title
+    assert "<mark>" in results[0]["title"]
+
+
+def test_search_ranks_every_match(client: FlaskClient, app: Flask):
+    """The best matches should be found however many films match"""
+    with app.app_context():
+        db = database.get_db()
+        db.execute(
+            "create virtual table temp.Terms using fts5vocab(main, FilmSearch, row)"
+        )
+        word = db.execute("select term from Terms order by doc desc").fetchone()[0]
+        scores = dict(
+            db.execute(
+                f"""
+                select film_id, bm25(FilmSearch, {search.WEIGHTS}) from FilmSearch
+                where FilmSearch match ?
+                """,
+                [search.fts_query(word)],
+            ).fetchall()
+        )
+    assert len(scores) > 5
+
+    response = client.get("/search/json", query_string={"q": word, "limit": 5})
+    film_ids = [result["film_id"] for result in response.get_json()["results"]]
+    assert [scores[film_id] for film_id in film_ids] == sorted(scores.values())[:5]
+
+
+def test_search_prefixes_and_credits(client: FlaskClient, app: Flask):
+    with app.app_context():
+        db = database.get_db()
+        film_id, name = db.execute(
+            "select film_id, person_name from Acted limit 1"
+        ).fetchone()
+        expected = {
+            row[0]
+            for row in db.execute(
+                "select film_id from Acted where person_name = ? union "
+                "select film_id from Directed where person_name = ?",
+                [name, name],
+            )
+        }
+    # Every film with the person should be found by their name, even if the last
+    # word is cut short
+    response = client.get(
+        "/search/json", query_string={"q": name[:-1], "limit": search.MAX_LIMIT}
+    )
+    results = response.get_json()["results"]
+    assert expected <= {result["film_id"] for result in results}
+    assert film_id in {result["film_id"] for result in results}
+    assert any("<mark>" in result["people_snippet"] for result in results)
+
+
+def test_search_page(client: FlaskClient):
+    response = client.get("/search/", query_string={"q": "description"})
+    assert response.status_code == 200
+    results = response.html.select(".search-result")
+    assert len(results) == search.PAGE_SIZE
+    assert results[0].find("mark")
+
+    response = client.get("/search/", query_string={"q": "<b>nothing</b>"})
+    assert response.status_code == 200
+    assert not response.html.select(".search-result")
+    assert not response.html.find("b", string="nothing")
+
+
+def test_search_synced(client: FlaskClient, app: Flask):
+    """An incremental import should reindex the films that changed"""
+    with app.app_context():
+        db = database.get_db()
+        title = db.execute("select title from Film where film_id = 's1'").fetchone()[0]
+        # Make s1 look changed and drop it from the index
+        db.execute("delete from FilmFingerprint where film_id = 's1'")
+        db.execute("delete from FilmSearch where film_id = 's1'")
+        db.commit()
+    results = client.get("/search/json", query_string={"q": title}).get_json()
+    assert "s1" not in {result["film_id"] for result in results["results"]}
+
+    with app.app_context():
+        database.init_db(incremental=True)
+        db = database.get_db()
+        n_films = db.execute("select count(*) from Film").fetchone()[0]
+        database.validate_catalog(db, n_films)
+    results = client.get("/search/json", query_string={"q": title}).get_json()
+    assert "s1" in {result["film_id"] for result in results["results"]}
+
+
+def test_search_migration(client: FlaskClient, app: Flask):
+    """Catalogs imported before there was search should be indexed by a migration"""
+    with app.app_context():
+        db = database.get_db()
+        db.execute("drop table FilmSearch")
+        db.execute("update SchemaVersion set version = 2 where component = 'catalog'")
+        db.commit()
+        database.migrate_db()
+        n_films = db.execute("select count(*) from Film").fetchone()[0]
+        database.validate_catalog(db, n_films)
+    assert client.get("/search/json?q=description").get_json()["results"]
+
+
+def test_bad_search(client: FlaskClient):
+    assert client.get("/search/json?q=").status_code == 400
+    assert client.get("/search/json?q=film&limit=0").status_code == 400
+    assert client.get("/search/json?q=film&limit=many").status_code == 400
+    assert client.get("/search/").status_code == 200
@@ -0,0 +1,136 @@
+import random
+
+import pytest
+from app import database, typeahead
+from app.typeahead import Entry, PrefixIndex
+from flask import Flask, g
+from flask.testing import FlaskClient
+
+
+def test_normalize():
+    assert typeahead.normalize("  Zoë  Kravitz-Smith ") == "zoe kravitz smith"
+    assert typeahead.normalize("Avatar: The Last Airbender") == (
+        "avatar the last airbender"
+    )
+    assert typeahead.normalize("?!") == ""
+
+
+def word_starts(text: str) -> list:
+    words = typeahead.normalize(text).split(" ")
+    return [" ".join(words[i:]) for i in range(len(words))]
+
+
+@pytest.mark.parametrize("max_scan", [4, 256])
+@pytest.mark.parametrize("seed", range(3))
+def test_prefix_index(monkeypatch, seed: int, max_scan: int):
+    """The index should find the same entries as checking every one of them"""
+    monkeypatch.setattr(typeahead, "MAX_SCAN", max_scan)
+    rng = random.Random(seed)
+    syllables = ["ba", "be", "bo", "ka", "ko", "ma", "mé", "ri"]
+    entries = [
+        Entry(
+            " ".join(
+                "".join(rng.choices(syllables, k=rng.randint(1, 3))).title()
+                for _ in range(rng.randint(1, 3))
+            ),
+            rng.randint(1, 20),
+        )
+        for _ in range(300)
+    ]
+    index = PrefixIndex(entries)
+    ranked = sorted(entries, key=lambda e: (-e.credits, e.text))
+    prefixes = ["b", "ME", "bab", "babo", "ka ", "ko ma", "riri", "x"]
+    prefixes += [entry.text[: rng.randint(1, len(entry.text))] for entry in entries]
+    for prefix in prefixes:
+        normalized = typeahead.normalize(prefix)
+        expected = [
+            entry
+            for entry in ranked
+            if any(key.startswith(normalized) for key in word_starts(entry.text))
+        ]
+        assert index.top(prefix, 5) == expected[:5], prefix
+
+
+def test_suggest(client: FlaskClient, app: Flask):
+    """Suggestions should be the most credited people and titles, best first"""
+    response = client.get("/search/suggest", query_string={"q": "quentin t"})
+    assert response.status_code == 200
+    people = response.get_json()["people"]
+    assert people[0]["name"] == "Quentin Tarantino"
+    assert client.get(people[0]["url"]).status_code == 200
+
+    response = client.get("/search/suggest", query_string={"q": "e", "limit": 20})
+    data = response.get_json()
+    assert 1 < len(data["people"]) <= 20
+    with app.app_context():
+        db = database.get_db()
+        for person in data["people"]:
+            expected = db.execute(
+                "select (select count(*) from Acted where person_name = :name)"
+                " + (select count(*) from Directed where person_name = :name)",
+                {"name": person["name"]},
+            ).fetchone()[0]
+            assert person["credits"] == expected
+    credits = [person["credits"] for person in data["people"]]
+    assert credits == sorted(credits, reverse=True)
+    for title in data["titles"]:
+        assert client.get(title["url"]).status_code == 200
+
+
+def test_suggest_without_database(client: FlaskClient, app: Flask):
+    """Suggestions should be served without making any queries"""
+    # The index is built when the app starts, which was before the test database
+    # was populated
+    with app.app_context():
+        typeahead.warm()
+    app.extensions["typeahead"].recheck_seconds = 3600
+    app.config["QUERY_STATS"] = True
+    statements = []
+
+    @app.after_request
+    def record(response):
+        statements.extend(g.query_stats.statements if "query_stats" in g else [])
+        return response
+
+    for prefix in ["a", "av", "avatar", "avatar the l", "tom h"]:
+        response = client.get("/search/suggest", query_string={"q": prefix})
+        assert response.status_code == 200
+    assert statements == []
+
+
+def test_suggest_rebuilt(client: FlaskClient, app: Flask):
+    """The index should be rebuilt once the catalog version has changed"""
+    app.extensions["typeahead"].recheck_seconds = 0
+    with app.app_context():
+        db = database.get_db()
+        db.execute("insert into Acted values('s633', 'Zyxwv Newcomer')")
+        db.execute("update CatalogMeta set value = 'changed' where key_ = 'version'")
+        db.commit()
+    response = client.get("/search/suggest", query_string={"q": "zyxw"})
+    assert [person["name"] for person in response.get_json()["people"]] == [
+        "Zyxwv Newcomer"
+    ]
+
+
+def test_suggest_url(client: FlaskClient, app: Flask):
+    """Suggested people should link to their page whatever is in their name"""
+    app.extensions["typeahead"].recheck_seconds = 0
+    name = "Zyxwv AC/DC + Friends?"
+    with app.app_context():
+        db = database.get_db()
+        db.execute("insert into Acted values('s633', ?)", [name])
+        db.execute("update CatalogMeta set value = 'changed' where key_ = 'version'")
+        db.commit()
+    response = client.get("/search/suggest", query_string={"q": "zyxw"})
+    person = response.get_json()["people"][0]
+    assert person["name"] == name
+    response = client.get(person["url"])
+    assert response.status_code == 200
+    assert "Avatar: The Last Airbender" in response.text
+
+
+def test_bad_suggest(client: FlaskClient):
+    assert client.get("/search/suggest?q=a&limit=0").status_code == 400
+    assert client.get("/search/suggest?q=a&limit=100").status_code == 400
+    response = client.get("/search/suggest?q=")
+    assert response.get_json() == {"query": "", "people": [], "titles": []}